@@ -0,0 +1,111 @@
+# /usr/bin/python
+
+# The interface of user storage
+
+from config import BULK_CHUNK_SIZE
+
+class StorageBackend(object):
+	"""
+	The operations the rest of the backend expects of the user storage
+	returned by db.getManager(). DBManager implements them on a single
+	SQLite file, sharding.ShardedBackend spreads users across several.
+	Statements that are not about users, e.g. those of permissions,
+	are run through execute() and friends. Those of sessions are run
+	by the manager holding the user's sessions, see sessionStorages().
+	"""
+
+	def execute(self, sql, bindings=()):
+		raise NotImplementedError
+
+	def executemany(self, sql, bindings):
+		raise NotImplementedError
+
+	def fetchone(self, sql, bindings=()):
+		raise NotImplementedError
+
+	def fetchall(self, sql, bindings=()):
+		raise NotImplementedError
+
+	def commit(self):
+		raise NotImplementedError
+
+	def rollback(self):
+		raise NotImplementedError
+
+	def release(self):
+		"""
+		Hands the calling thread's connections back, to be called by
+		threads that are done with the storage.
+		"""
+		raise NotImplementedError
+
+	def createTables(self):
+		raise NotImplementedError
+
+	def migrate(self):
+		raise NotImplementedError
+
+	def insertGroup(self, name):
+		raise NotImplementedError
+
+	def getAuthGroupId(self, name):
+		raise NotImplementedError
+
+	def getAuthGroupName(self, groupid):
+		raise NotImplementedError
+
+	def insertUser(self, user):
+		raise NotImplementedError
+
+	def insertUsers(self, users, chunksize=BULK_CHUNK_SIZE, inserted=None):
+		raise NotImplementedError
+
+	def activateByKey(self, key, now=None):
+		raise NotImplementedError
+
+	def authenticate(self, email, password, now=None):
+		raise NotImplementedError
+
+	def recordFailedLogin(self, username, now=None):
+		raise NotImplementedError
+
+	def userExists(self, username):
+		raise NotImplementedError
+
+	def getUser(self, username):
+		raise NotImplementedError
+
+	def getUserByEmail(self, email):
+		raise NotImplementedError
+
+	def getLockout(self, username):
+		raise NotImplementedError
+
+	def updateUser(self, userobj, immediate=False):
+		raise NotImplementedError
+
+	def deleteUser(self, username):
+		raise NotImplementedError
+
+	def sessionStorages(self):
+		"""
+		Returns the managers of the databases holding sessions, each
+		session is held by the one of its user, see sessionShard().
+		"""
+		raise NotImplementedError
+
+	def sessionShard(self, username):
+		raise NotImplementedError
+
+	def writeBehindQueue(self):
+		"""
+		Returns the write-behind queue statements of execute() can be
+		left to, None if they are to be written immediately.
+		"""
+		raise NotImplementedError
+
+	def expireUsers(self, now=None, purge=False):
+		raise NotImplementedError
+
+	def iterUsers(self, filter=None, columns=None):
+		raise NotImplementedError
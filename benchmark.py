@@ -0,0 +1,204 @@
+# /usr/bin/python
+
+# Benchmark of registration, activation, login and lookup
+#
+# Seeds databases of the given sizes through the public API and measures
+# throughput and latency percentiles of the user operations. Results are
+# written as JSON and can be compared against a stored baseline:
+#
+#	python benchmark.py --sizes 10000,100000 --output bench.json
+#	python benchmark.py --sizes 10000,100000 --compare bench.json
+
+import os
+import sys
+import time
+import math
+import json
+import random
+import platform
+from optparse import OptionParser
+import config
+import db
+import user
+import hashers
+from utils import *
+
+OPERATIONS = ['save', 'activate', 'login', 'login_wrong', 'logout', 'getUser', 'getUser_uncached']
+PASSWORD = 'benchmark'
+
+def percentile(values, fraction):
+	"""
+	Returns the nearest-rank percentile of sorted values.
+	"""
+	if not values:
+		return 0.0
+	index = int(math.ceil(fraction * len(values))) - 1
+	return values[min(max(index, 0), len(values) - 1)]
+
+def summarize(latencies):
+	"""
+	Returns throughput and latency percentiles in milliseconds.
+	"""
+	latencies = sorted(latencies)
+	total = sum(latencies)
+	if total > 0:
+		rate = len(latencies) / total
+	else:
+		rate = 0.0
+	return {'count' : len(latencies),
+		'ops_per_sec' : rate,
+		'p50_ms' : percentile(latencies, 0.50) * 1000,
+		'p95_ms' : percentile(latencies, 0.95) * 1000,
+		'p99_ms' : percentile(latencies, 0.99) * 1000}
+
+def timed(function, arguments, prepare=None):
+	"""
+	Calls function once per element of arguments and returns the latencies.
+	prepare(argument) is called before each call without being timed.
+	"""
+	latencies = []
+	for argument in arguments:
+		if prepare is not None:
+			prepare(argument)
+		start = time.time()
+		function(argument)
+		latencies.append(time.time() - start)
+	return latencies
+
+def createDatabase(path):
+	"""
+	Sets up an empty database at path and makes it the configured one.
+	"""
+	db.closePool(path)
+	for filename in (path, path + '-wal', path + '-shm'):
+		if os.path.exists(filename):
+			os.remove(filename)
+	config.DATABASE_PATH = path
+	manager = db.getManager(path)
+	manager.createTables()
+	manager.insertGroup('admin')
+	manager.insertGroup('non-admin')
+	return manager
+
+def seed(size):
+	"""
+	Registers size users in bulk. Their passwords are hashed once up
+	front, hashing is measured by the operations themselves.
+	Returns the registration keys by username.
+	"""
+	encoded = hashers.makePassword(PASSWORD)
+	keys = {}
+	def users():
+		for i in xrange(size):
+			username = 'user%d' % i
+			keys[username] = registrationKey(username)
+			yield user.User(username=username, password=encoded, email='%s@example.com' % username,
+					authgroup='non-admin', registration_key=keys[username])
+	user.User.saveMany(users(), notify=False)
+	return keys
+
+def benchmark(size, samples, path):
+	"""
+	Seeds a database of size users and measures every operation on
+	samples distinct users. Returns the summaries by operation.
+	"""
+	manager = createDatabase(path)
+	keys = seed(size)
+	samples = min(samples, size / 4)
+	# distinct users for the operations which change state
+	chosen = random.sample(xrange(size), samples * 3)
+	active, wrong, lookups = chosen[:samples], chosen[samples:samples * 2], chosen[samples * 2:]
+	usernames = lambda indices: ['user%d' % i for i in indices]
+	results = {}
+
+	newusers = [user.User(username='new%d' % i, password=PASSWORD, email='new%d@example.com' % i, authgroup='non-admin')
+			for i in xrange(samples)]
+	results['save'] = timed(lambda userobj: userobj.save(), newusers)
+	results['activate'] = timed(lambda username: manager.getUser(username).activate(keys[username]), usernames(active))
+	results['login'] = timed(lambda username: manager.getUser(username).login('%s@example.com' % username, PASSWORD),
+				usernames(active))
+	results['login_wrong'] = timed(lambda username: manager.getUser(username).login('%s@example.com' % username, 'wrong'),
+				usernames(wrong))
+	results['logout'] = timed(lambda username: manager.getUser(username).logout(), usernames(active))
+	results['getUser'] = timed(manager.getUser, usernames(active))
+	results['getUser_uncached'] = timed(manager.getUser, usernames(lookups), lambda username: manager.users.invalidate(username))
+	db.closePool(path)
+	return dict([(operation, summarize(latencies)) for operation, latencies in results.iteritems()])
+
+def run(sizes, samples, path):
+	"""
+	Runs the benchmark for every size. Returns the results as a dictionary.
+	"""
+	results = {'environment' : {'python' : platform.python_version(),
+				'sqlite' : db.sqlite3.sqlite_version,
+				'platform' : platform.platform(),
+				'password_hasher' : config.PASSWORD_HASHER,
+				'password_costs' : config.PASSWORD_COSTS},
+		'samples' : samples,
+		'sizes' : {}}
+	configured = config.DATABASE_PATH
+	try:
+		for size in sizes:
+			results['sizes'][str(size)] = benchmark(size, samples, path)
+	finally:
+		config.DATABASE_PATH = configured
+	return results
+
+def compare(results, baseline, threshold):
+	"""
+	Compares results against a baseline. Returns a list of regressions,
+	i.e. throughput falling or the 95th percentile rising by more than
+	the threshold fraction.
+	"""
+	regressions = []
+	for size, operations in results['sizes'].iteritems():
+		for operation, summary in operations.iteritems():
+			base = baseline.get('sizes', {}).get(size, {}).get(operation)
+			if base is None:
+				continue
+			if summary['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+				regressions.append('%s users, %s: %.1f ops/s, baseline %.1f ops/s'
+						% (size, operation, summary['ops_per_sec'], base['ops_per_sec']))
+			if summary['p95_ms'] > base['p95_ms'] * (1 + threshold):
+				regressions.append('%s users, %s: p95 %.3f ms, baseline %.3f ms'
+						% (size, operation, summary['p95_ms'], base['p95_ms']))
+	return regressions
+
+def report(results):
+	for size in sorted(results['sizes'], key=int):
+		print '%s users' % size
+		print '  %-18s %12s %10s %10s %10s' % ('operation', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms')
+		for operation in OPERATIONS:
+			summary = results['sizes'][size][operation]
+			print '  %-18s %12.1f %10.3f %10.3f %10.3f' % (operation, summary['ops_per_sec'],
+					summary['p50_ms'], summary['p95_ms'], summary['p99_ms'])
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='%prog [options]')
+	parser.add_option('--sizes', default='10000,100000,1000000',
+			help='comma separated numbers of seeded users')
+	parser.add_option('--samples', type='int', default=1000,
+			help='operations measured per operation and size')
+	parser.add_option('--database', default='./benchmark.db',
+			help='database file to seed, it is overwritten')
+	parser.add_option('--output', help='file to write the results to as JSON')
+	parser.add_option('--compare', help='baseline JSON file to compare the results against')
+	parser.add_option('--threshold', type='float', default=0.1,
+			help='fraction by which results may be worse than the baseline')
+	options, args = parser.parse_args()
+	sizes = [int(size) for size in options.sizes.split(',')]
+	results = run(sizes, options.samples, options.database)
+	report(results)
+	if options.output:
+		outfile = open(options.output, 'w')
+		json.dump(results, outfile, indent=2, sort_keys=True)
+		outfile.close()
+	if options.compare:
+		infile = open(options.compare)
+		baseline = json.load(infile)
+		infile.close()
+		regressions = compare(results, baseline, options.threshold)
+		for regression in regressions:
+			print 'REGRESSION %s' % regression
+		if regressions:
+			sys.exit(1)
@@ -0,0 +1,57 @@
+# /usr/bin/python
+
+# A Bloom filter
+#
+# Answers whether a key has possibly been added or definitely not, in
+# a fixed amount of memory. Used to tell taken usernames from free ones
+# without asking the database for most of the free ones.
+
+import math
+import hashlib
+import threading
+
+class BloomFilter(object):
+	"""
+	A set of keys that can't be listed or shrunk. Sized so that after
+	'capacity' keys have been added a key that hasn't is reported as
+	possibly added with a probability of at most 'errorrate'.
+	"""
+
+	def __init__(self, capacity, errorrate):
+		capacity = max(capacity, 1)
+		self.bits = int(math.ceil(-capacity * math.log(errorrate) / math.log(2) ** 2))
+		self.hashes = max(int(round(float(self.bits) / capacity * math.log(2))), 1)
+		self.array = bytearray((self.bits + 7) / 8)
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def positions(self, key):
+		"""
+		Returns the bit positions of a key by double hashing.
+		"""
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		digest = hashlib.md5(key).hexdigest()
+		first, second = int(digest[:16], 16), int(digest[16:], 16) | 1
+		return [(first + i * second) % self.bits for i in xrange(self.hashes)]
+
+	def add(self, key):
+		self.lock.acquire()
+		try:
+			for position in self.positions(key):
+				self.array[position >> 3] |= 1 << (position & 7)
+			self.count += 1
+		finally:
+			self.lock.release()
+
+	def mightContain(self, key):
+		"""
+		Returns False if the key has definitely not been added.
+		"""
+		for position in self.positions(key):
+			if not self.array[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+	def __contains__(self, key):
+		return self.mightContain(key)
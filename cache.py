@@ -0,0 +1,123 @@
+# /usr/bin/python
+
+# A bounded least-recently-used cache with expiring entries
+
+import threading
+import time
+
+# indices into a linked list node
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+	"""
+	A thread-safe cache holding at most 'size' entries. When it is full
+	the least recently used entry is evicted. Entries older than 'ttl'
+	seconds are treated as missing. Hits, misses, evictions and
+	expirations are counted.
+	"""
+
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.entries = {}
+		# circular doubly linked list, most recently used entries first
+		self.root = []
+		self.root[:] = [self.root, self.root, None, None, None]
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def unlink(self, node):
+		node[PREV][NEXT] = node[NEXT]
+		node[NEXT][PREV] = node[PREV]
+
+	def linkFirst(self, node):
+		node[PREV] = self.root
+		node[NEXT] = self.root[NEXT]
+		self.root[NEXT][PREV] = node
+		self.root[NEXT] = node
+
+	def get(self, key, default=None):
+		"""
+		Returns the cached value for key or default if it is missing or expired.
+		"""
+		self.lock.acquire()
+		try:
+			node = self.entries.get(key)
+			if node is None:
+				self.misses += 1
+				return default
+			if node[EXPIRES] < time.time():
+				self.unlink(node)
+				del self.entries[key]
+				self.expirations += 1
+				self.misses += 1
+				return default
+			self.unlink(node)
+			self.linkFirst(node)
+			self.hits += 1
+			return node[VALUE]
+		finally:
+			self.lock.release()
+
+	def put(self, key, value):
+		"""
+		Caches value for key, evicting the least recently used entry if necessary.
+		"""
+		self.lock.acquire()
+		try:
+			node = self.entries.get(key)
+			if node is not None:
+				self.unlink(node)
+			elif len(self.entries) >= self.size:
+				oldest = self.root[PREV]
+				self.unlink(oldest)
+				del self.entries[oldest[KEY]]
+				self.evictions += 1
+			node = [None, None, key, value, time.time() + self.ttl]
+			self.entries[key] = node
+			self.linkFirst(node)
+		finally:
+			self.lock.release()
+
+	def invalidate(self, key):
+		"""
+		Removes the entry for key if there is one.
+		"""
+		self.lock.acquire()
+		try:
+			node = self.entries.pop(key, None)
+			if node is not None:
+				self.unlink(node)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		"""
+		Removes all entries.
+		"""
+		self.lock.acquire()
+		try:
+			self.entries = {}
+			self.root[:] = [self.root, self.root, None, None, None]
+		finally:
+			self.lock.release()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def stats(self):
+		"""
+		Returns the counters and the current number of entries as a dictionary.
+		"""
+		self.lock.acquire()
+		try:
+			return {'size' : len(self.entries),
+				'hits' : self.hits,
+				'misses' : self.misses,
+				'evictions' : self.evictions,
+				'expirations' : self.expirations}
+		finally:
+			self.lock.release()
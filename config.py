@@ -8,6 +8,110 @@ DATABASE_PATH = './production.db'
 EXPIRATION_PERIOD = datetime.timedelta(days=2)
 LOCKOUT_PERIOD = datetime.timedelta(minutes=15)
 FAILED_LOGIN_TOLERANCE = 5
+# seconds within which failed logins of a source are counted
+FAILED_LOGIN_WINDOW = 900.0
+# failed logins from one source before it is blocked
+FAILED_LOGIN_SOURCE_TOLERANCE = 100
+# sources whose failed logins are tracked at most
+FAILED_LOGIN_TRACKED_KEYS = 100000
+
+# connection pool settings
+POOL_SIZE = 8
+POOL_TIMEOUT = 5.0
+POOL_HEALTH_CHECK_INTERVAL = 30.0
+JOURNAL_MODE = 'WAL'
+# milliseconds a connection waits for a lock before giving up
+BUSY_TIMEOUT = 5000
+# users inserted per executemany batch in bulk registrations
+BULK_CHUNK_SIZE = 500
+# rows fetched at once when iterating over users
+ITER_BATCH_SIZE = 1000
+
+# identity map of recently used users
+USER_CACHE_SIZE = 10000
+# seconds a cached user is served without rereading it
+USER_CACHE_TTL = 300.0
+
+# queue user updates and write them in batches in the background
+WRITE_BEHIND = False
+WRITE_BEHIND_BATCH_SIZE = 200
+# seconds between background writes
+WRITE_BEHIND_INTERVAL = 0.5
+
+# taken usernames are kept in a Bloom filter, see bloom.py, so that most
+# free ones are told without a query. Usernames registered by other
+# processes may be told free, saving them still fails as taken.
+USERNAME_FILTER = True
+# usernames the filter is sized for at least
+USERNAME_FILTER_CAPACITY = 1000000
+# probability of a free username having to be looked up
+USERNAME_FILTER_ERROR_RATE = 0.01
+
+# delivery of activation mails, see mailer.py
+# 'console', 'smtp', 'file' or 'memory'
+MAIL_TRANSPORT = 'console'
+MAIL_SENDER = 'noreply@localhost'
+MAIL_FILE = './mail.log'
+SMTP_HOST = 'localhost'
+SMTP_PORT = 25
+SMTP_USERNAME = None
+SMTP_PASSWORD = None
+SMTP_STARTTLS = False
+# mails sent per connection
+MAIL_BATCH_SIZE = 50
+# seconds the worker waits for more mails
+MAIL_INTERVAL = 1.0
+MAIL_RETRIES = 5
+# seconds before the first retry, doubled for every further one
+MAIL_BACKOFF = 2.0
+
+# record logins, logouts, activations and lockouts, see eventlog.py
+EVENT_LOG = True
+# directory of the segment files, by default the database's path + '.events'
+EVENT_LOG_DIRECTORY = None
+# events written at once at most
+EVENT_LOG_BATCH_SIZE = 1000
+# seconds between writes
+EVENT_LOG_INTERVAL = 0.5
+# bytes after which the next segment file is started
+EVENT_LOG_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# count and time every statement, see instrument.py
+INSTRUMENTATION = False
+# seconds after which a statement is logged as slow
+SLOW_QUERY_THRESHOLD = 0.1
+# durations kept per statement for percentiles
+INSTRUMENTATION_SAMPLES = 1024
+
+# worker threads of the non-blocking user service, each uses one pooled
+# connection, so there must be fewer than POOL_SIZE
+SERVICE_WORKERS = 4
+# operations waiting for a worker before submitting blocks
+SERVICE_QUEUE_SIZE = 1000
+
+# lifetime of session tokens issued upon login
+SESSION_TTL = datetime.timedelta(hours=12)
+# seconds a session known to a process is trusted before it is read
+# again, so that revocations by other processes take effect
+SESSION_RECHECK_INTERVAL = 5.0
+# seconds between two prunings of expired sessions
+SESSION_PRUNE_INTERVAL = 600.0
+
+# expiration of unactivated users, see sweeper.py
+# seconds between two sweeps
+SWEEP_INTERVAL = 3600.0
+# users expired or purged per transaction
+SWEEP_BATCH_SIZE = 1000
+# seconds to leave the write lock to others between two batches
+SWEEP_PAUSE = 0.01
+# delete expired users instead of only marking them
+SWEEP_PURGE = False
+
+# password hashing, costs are given per algorithm
+PASSWORD_HASHER = 'pbkdf2_sha256'
+PASSWORD_COSTS = {'pbkdf2_sha256' : 100000}
+# processes hashing passwords, with 0 passwords are hashed in the calling thread
+PASSWORD_HASHING_PROCESSES = 0
 
 # set up differently if testing
 TESTING = True
@@ -15,3 +119,6 @@ if TESTING:
 	DATABASE_PATH = './test.db'
 	EXPIRATION_PERIOD = datetime.timedelta(seconds=1)
 	LOCKOUT_PERIOD = datetime.timedelta(seconds=1)
+	PASSWORD_COSTS = {'pbkdf2_sha256' : 1000}
+	SESSION_TTL = datetime.timedelta(seconds=1)
+	EVENT_LOG = False
@@ -1,7 +1,23 @@
 # /usr/bin/python
 
 import sqlite3
-from config import DATABASE_PATH
+import atexit
+import threading
+import time
+from collections import namedtuple
+import config
+from config import POOL_SIZE, POOL_TIMEOUT, POOL_HEALTH_CHECK_INTERVAL, JOURNAL_MODE, BUSY_TIMEOUT, BULK_CHUNK_SIZE
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, WRITE_BEHIND, SWEEP_BATCH_SIZE, SWEEP_PAUSE, ITER_BATCH_SIZE
+from config import INSTRUMENTATION, LOCKOUT_PERIOD, FAILED_LOGIN_TOLERANCE
+from config import USERNAME_FILTER, USERNAME_FILTER_CAPACITY, USERNAME_FILTER_ERROR_RATE
+from cache import LRUCache
+from bloom import BloomFilter
+from writebehind import WriteBehindQueue
+from instrument import QueryStats
+from backend import StorageBackend
+import migrations
+import hashers
+import eventlog
 from utils import *
 from user import User
 
@@ -12,22 +28,505 @@ USER_TABLE_CREATION = """CREATE TABLE user (id INTEGER PRIMARY KEY, username TEX
 			activated BOOLEAN, expired BOOLEAN, logged_in BOOLEAN, failed_logins INTEGER, locked BOOLEAN,
 			locked_until TEXT)"""
 GROUP_INSERT = 'INSERT INTO authgroup VALUES(null, ?)'
-GROUP_GET_NAME = 'SELECT name FROM authgroup WHERE id = ?'
-USER_INSERT = 'INSERT INTO user VALUES(null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-USER_EXISTS = 'SELECT * FROM user WHERE username = ?'
+GROUP_INSERT_WITH_ID = 'INSERT OR IGNORE INTO authgroup VALUES(?, ?)'
+GROUP_GET_ALL = 'SELECT id, name FROM authgroup'
+TABLE_EXISTS = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+USER_INSERT_COLUMNS = """user (username, email, password, authgroup_id, registration_key, key_expires_at, activated,
+			expired, logged_in, failed_logins, locked, locked_until_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+USER_INSERT = 'INSERT INTO ' + USER_INSERT_COLUMNS
+USER_INSERT_OR_IGNORE = 'INSERT OR IGNORE INTO ' + USER_INSERT_COLUMNS
+USERS_EXISTING = 'SELECT username FROM user WHERE username IN (%s)'
+USER_EXISTS = 'SELECT 1 FROM user WHERE username = ? LIMIT 1'
+EMAIL_EXISTS = 'SELECT 1 FROM user WHERE email = ? LIMIT 1'
+KEY_EXISTS = 'SELECT 1 FROM user WHERE registration_key = ? LIMIT 1'
+USER_COUNT = 'SELECT COUNT(*) FROM user'
+USERNAMES = 'SELECT username FROM user'
+USERNAMES_AFTER = 'SELECT username FROM user WHERE id > ?'
+USER_LAST_ID = 'SELECT MAX(id) FROM user'
 USER_GET = 'SELECT * FROM user WHERE username = ?'
-USER_UPDATE = 'UPDATE user SET activated = ?, expired = ?, logged_in = ?, failed_logins = ?, locked = ?, locked_until = ? WHERE username = ?'
+USER_GET_WITH_GROUP = """SELECT user.username, user.email, user.password, authgroup.name, user.registration_key,
+			user.key_expires_on, user.activated, user.expired, user.logged_in, user.failed_logins, user.locked,
+			user.locked_until, user.key_expires_at, user.locked_until_at
+			FROM user JOIN authgroup ON authgroup.id = user.authgroup_id"""
+USER_GET_BY_USERNAME = USER_GET_WITH_GROUP + ' WHERE user.username = ?'
+USER_GET_BY_EMAIL = USER_GET_WITH_GROUP + ' WHERE user.email = ?'
+USER_UPDATE_COLUMNS = 'UPDATE user SET %s WHERE username = ?'
+USERS_OVERDUE = 'SELECT id, username FROM user WHERE activated = 0 AND key_expires_at < ? AND expired = 0 LIMIT ?'
+# both values of expired are named so that the whole index is used
+USERS_OVERDUE_ALL = 'SELECT id, username FROM user WHERE activated = 0 AND expired IN (0, 1) AND key_expires_at < ? LIMIT ?'
+USERS_EXPIRE = 'UPDATE user SET expired = 1 WHERE id IN (%s)'
+USERS_DELETE = 'DELETE FROM user WHERE id IN (%s)'
+USER_DELETE = 'DELETE FROM user WHERE username = ?'
+USER_ACTIVATE_BY_KEY = """UPDATE user SET activated = key_expires_at > ?, expired = key_expires_at <= ?
+			WHERE registration_key = ? AND activated = 0 AND expired = 0 AND key_expires_at IS NOT NULL"""
+USER_PENDING_KEY = """SELECT username, key_expires_at > ? FROM user
+			WHERE registration_key = ? AND activated = 0 AND expired = 0 AND key_expires_at IS NOT NULL"""
+USER_UNCONVERTED_KEY = 'SELECT username FROM user WHERE registration_key = ? AND key_expires_at IS NULL'
+USER_CREDENTIALS = """SELECT id, username, password, locked, locked_until_at, key_expires_on, locked_until
+			FROM user WHERE email = ?"""
+USER_LOCKOUT = 'SELECT locked, locked_until_at, locked_until FROM user WHERE username = ?'
+# a lockout without any timestamp is over, text ones are converted before
+USER_NOT_LOCKED = '(locked = 0 OR COALESCE(locked_until_at, 0) <= ?)'
+USER_LOGIN_SUCCEEDED = """UPDATE user SET logged_in = 1, failed_logins = 0, locked = 0, password = ?
+			WHERE username = ? AND """ + USER_NOT_LOCKED
+# the failures counted with a failed login, starting anew once a lockout is over
+USER_FAILURES = 'CASE WHEN locked = 1 THEN 1 ELSE COALESCE(failed_logins, 0) + 1 END'
+USER_LOGIN_FAILED = """UPDATE user SET logged_in = 0, failed_logins = %(failures)s, locked = %(failures)s > ?,
+			locked_until_at = CASE WHEN %(failures)s > ? THEN ? ELSE locked_until_at END
+			WHERE username = ? AND """ % {'failures' : USER_FAILURES} + USER_NOT_LOCKED
+USER_FAILED_LOGINS = 'SELECT failed_logins, locked FROM user WHERE username = ?'
 
-class DBManager(object):
+# UPDATE ... RETURNING is available as of SQLite 3.35
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# results of DBManager.activateByKey()
+ACTIVATED = 'activated'
+KEY_EXPIRED = 'expired'
+KEY_INVALID = 'invalid'
+
+# results of DBManager.authenticate()
+AUTH_OK = 'ok'
+AUTH_LOCKED = 'locked'
+AUTH_INVALID = 'invalid'
+
+# user attributes that can be updated mapped onto their columns
+USER_UPDATABLE_COLUMNS = {'password' : 'password',
+			'activated' : 'activated',
+			'expired' : 'expired',
+			'logged_in' : 'logged_in',
+			'failed_logins' : 'failed_logins',
+			'locked' : 'locked',
+			'locked_until' : 'locked_until_at'}
+# fields of user records as (name, selected columns, decoder) in table order
+USER_RECORD_FIELDS = [('id', ['user.id'], None),
+			('username', ['user.username'], None),
+			('email', ['user.email'], None),
+			('password', ['user.password'], None),
+			('authgroup', ['authgroup.name'], None),
+			('registration_key', ['user.registration_key'], None),
+			('key_expiration', ['user.key_expires_at', 'user.key_expires_on'], timestampFromColumns),
+			('activated', ['user.activated'], bool),
+			('expired', ['user.expired'], bool),
+			('logged_in', ['user.logged_in'], bool),
+			('failed_logins', ['user.failed_logins'], None),
+			('locked', ['user.locked'], bool),
+			('locked_until', ['user.locked_until_at', 'user.locked_until'], timestampFromColumns)]
+USER_RECORD_FIELD_NAMES = [name for name, columns, decoder in USER_RECORD_FIELDS]
+USER_ITER = 'SELECT %s FROM user%s%s ORDER BY user.id'
+USER_ITER_JOIN = ' JOIN authgroup ON authgroup.id = user.authgroup_id'
+
+# attributes that are never left to the write-behind queue
+USER_SECURITY_CRITICAL = frozenset(['password', 'locked', 'locked_until'])
+
+class ConnectionPool(object):
+	"""
+	A pool of SQLite3 connections to a single database file. Every thread
+	is bound to its own connection until it releases it again, and at most
+	'size' connections are open at the same time. Each connection gets the
+	journal mode and busy timeout, in milliseconds, set once when it is opened. Idle
+	connections are checked for health before being handed out again.
+	"""
+
+	def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT, healthCheckInterval=POOL_HEALTH_CHECK_INTERVAL,
+			journalMode=JOURNAL_MODE, busyTimeout=BUSY_TIMEOUT):
+		self.path = path
+		self.size = size
+		self.timeout = timeout
+		self.healthCheckInterval = healthCheckInterval
+		self.journalMode = journalMode
+		self.busyTimeout = busyTimeout
+		self.condition = threading.Condition()
+		self.local = threading.local()
+		# idle connections as [connection, time of release] pairs
+		self.idle = []
+		# borrowed connections mapped onto the thread holding them
+		self.borrowed = {}
+		self.opened = 0
+
+	def connect(self):
+		"""
+		Opens and sets up a new connection.
+		"""
+		conn = sqlite3.connect(self.path, timeout=self.busyTimeout / 1000.0, check_same_thread=False)
+		conn.execute('PRAGMA journal_mode = %s' % self.journalMode)
+		conn.execute('PRAGMA busy_timeout = %d' % self.busyTimeout)
+		return conn
+
+	def isHealthy(self, conn):
+		"""
+		Returns True if the connection still answers a trivial query.
+		"""
+		try:
+			conn.execute('SELECT 1').fetchone()
+			return True
+		except sqlite3.Error:
+			return False
+
+	def connection(self):
+		"""
+		Returns the connection bound to the calling thread, borrowing
+		one from the pool if the thread doesn't hold one yet.
+		"""
+		conn = getattr(self.local, 'conn', None)
+		if conn is None:
+			conn = self.checkout()
+			self.local.conn = conn
+		return conn
+
+	def checkout(self):
+		"""
+		Takes an idle connection or opens a new one if the pool isn't
+		full yet. Otherwise waits for a connection to be released.
+		"""
+		deadline = time.time() + self.timeout
+		self.condition.acquire()
+		try:
+			while True:
+				if self.idle:
+					conn, released = self.idle.pop()
+					if time.time() - released > self.healthCheckInterval and not self.isHealthy(conn):
+						# replace the broken connection with a fresh one
+						conn.close()
+						conn = self.connect()
+					break
+				if self.opened < self.size:
+					conn = self.connect()
+					self.opened += 1
+					break
+				if self.reclaim():
+					continue
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise PoolExhaustedException(self.path)
+				self.condition.wait(remaining)
+			self.borrowed[conn] = threading.currentThread()
+			return conn
+		finally:
+			self.condition.release()
+
+	def reclaim(self):
+		"""
+		Puts connections back whose borrowing threads have died.
+		Must be called with the condition held.
+		"""
+		reclaimed = False
+		for conn, thread in self.borrowed.items():
+			if not thread.isAlive():
+				del self.borrowed[conn]
+				conn.rollback()
+				self.idle.append([conn, time.time()])
+				reclaimed = True
+		return reclaimed
+
+	def release(self):
+		"""
+		Returns the calling thread's connection to the pool.
+		"""
+		conn = getattr(self.local, 'conn', None)
+		if conn is None:
+			return
+		self.local.conn = None
+		# never hand out a connection with a transaction pending
+		conn.rollback()
+		self.condition.acquire()
+		try:
+			self.borrowed.pop(conn, None)
+			self.idle.append([conn, time.time()])
+			self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def closeAll(self):
+		"""
+		Closes every connection of the pool, borrowed or idle.
+		"""
+		self.condition.acquire()
+		try:
+			for conn, released in self.idle:
+				conn.close()
+			for conn in self.borrowed.keys():
+				conn.close()
+			self.idle = []
+			self.borrowed = {}
+			self.opened = 0
+			self.local = threading.local()
+			self.condition.notifyAll()
+		finally:
+			self.condition.release()
+
+class AuthGroupMap(object):
+	"""
+	An in-memory bidirectional mapping of authgroup ids and names.
+	Authgroups hardly ever change so the mapping is loaded once and
+	only reloaded after it has been invalidated.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.ids = None
+		self.names = None
+
+	def isLoaded(self):
+		return self.ids is not None
+
+	def load(self, rows):
+		"""
+		Replaces the mapping by the given (id, name) rows.
+		"""
+		ids = {}
+		names = {}
+		for groupid, name in rows:
+			ids[name] = groupid
+			names[groupid] = name
+		self.lock.acquire()
+		try:
+			self.ids, self.names = ids, names
+		finally:
+			self.lock.release()
+		return ids
+
+	def invalidate(self):
+		self.lock.acquire()
+		try:
+			self.ids, self.names = None, None
+		finally:
+			self.lock.release()
+
+	def getId(self, name):
+		ids = self.ids
+		if ids is None:
+			return None
+		return ids.get(name)
+
+	def getName(self, groupid):
+		names = self.names
+		if names is None:
+			return None
+		return names.get(groupid)
+
+# process-wide state per database file: its pool, manager and caches
+_shared = {}
+_sharedLock = threading.RLock()
+
+def sharedState(path, name, factory):
+	"""
+	Returns the named piece of state of the given database file, by
+	default the configured one, creating it by factory(path) on first use.
+	"""
+	if path is None:
+		path = config.DATABASE_PATH
+	# the state exists on all but the first call, which needs no lock
+	existing = peekSharedState(path, name)
+	if existing is not None:
+		return existing
+	_sharedLock.acquire()
+	try:
+		state = _shared.setdefault(path, {})
+		if name not in state:
+			state[name] = factory(path)
+		return state[name]
+	finally:
+		_sharedLock.release()
+
+def peekSharedState(path, name):
+	"""
+	Returns the named piece of state of the given database file or None
+	if it hasn't been created.
+	"""
+	if path is None:
+		path = config.DATABASE_PATH
+	return _shared.get(path, {}).get(name)
+
+def popSharedState(path, name):
+	"""
+	Removes the named piece of state of the given database file and returns it.
+	"""
+	if path is None:
+		path = config.DATABASE_PATH
+	_sharedLock.acquire()
+	try:
+		return _shared.get(path, {}).pop(name, None)
+	finally:
+		_sharedLock.release()
+
+# record classes per projection of user fields
+_recordClasses = {}
+
+def userRecordClass(fields):
+	"""
+	Returns a read-only, tuple-backed record class with the given fields.
+	"""
+	fields = tuple(fields)
+	if fields not in _recordClasses:
+		_recordClasses[fields] = namedtuple('UserRecord', fields)
+	return _recordClasses[fields]
+
+def getPool(path=None):
+	"""
+	Returns the connection pool of the given database file.
+	"""
+	return sharedState(path, 'pool', ConnectionPool)
+
+def getManager(path=None):
+	"""
+	Returns a process-wide manager for the given database file.
+	"""
+	return sharedState(path, 'manager', DBManager)
+
+def setManager(manager, path=None):
+	"""
+	Installs another storage backend, e.g. a sharding.ShardedBackend, as
+	the process-wide manager for the given database file. Returns the
+	previous one or None.
+	"""
+	if path is None:
+		path = config.DATABASE_PATH
+	_sharedLock.acquire()
+	try:
+		state = _shared.setdefault(path, {})
+		previous = state.get('manager')
+		state['manager'] = manager
+		return previous
+	finally:
+		_sharedLock.release()
+
+def createUserCache(path):
+	return LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def closePool(path=None):
+	"""
+	Closes all connections to the given database file and forgets its
+	pool along with everything cached about it.
+	"""
+	if path is None:
+		path = config.DATABASE_PATH
+	_sharedLock.acquire()
+	try:
+		state = _shared.pop(path, {})
+	finally:
+		_sharedLock.release()
+	if 'writebehind' in state:
+		state['writebehind'].stop()
+	if 'events' in state:
+		state['events'].stop()
+	if 'pool' in state:
+		state['pool'].closeAll()
+
+class DBManager(StorageBackend):
 	"""
 	This class represents the interface to the database. It provides
 	methods for storing, retrieving and updating users and authgroups.
-	The database is an SQLite3 database.
+	The database is an SQLite3 database. Connections are borrowed from
+	the process-wide pool of the database file. Retrieved users are kept
+	in an identity map so that repeated lookups of the same user return
+	the same object without querying the database. Every write of a user
+	passes through the identity map as well. Updates can optionally be
+	left to a write-behind queue that writes them in batches.
+	All statements are run through execute() and friends, which count
+	and time them if instrumentation is enabled.
 	"""
 
-	def __init__(self):
-		self.conn = sqlite3.connect(DATABASE_PATH)
-		self.cursor = self.conn.cursor()
+	def __init__(self, path=None):
+		if path is None:
+			path = config.DATABASE_PATH
+		self.path = path
+		self.pool = getPool(path)
+		self.groups = sharedState(path, 'groups', lambda path: AuthGroupMap())
+		self.users = sharedState(path, 'users', createUserCache)
+		if WRITE_BEHIND:
+			self.enableWriteBehind()
+		if INSTRUMENTATION:
+			self.enableInstrumentation()
+
+	@property
+	def conn(self):
+		return self.pool.connection()
+
+	@property
+	def cursor(self):
+		return self.conn.cursor()
+
+	def enableInstrumentation(self, **options):
+		"""
+		Starts counting and timing the statements of this database, see
+		instrument.QueryStats for the options. Returns the statistics.
+		"""
+		return sharedState(self.path, 'stats', lambda path: QueryStats(**options))
+
+	def disableInstrumentation(self):
+		popSharedState(self.path, 'stats')
+
+	def queryStats(self):
+		"""
+		Returns the statement statistics or None if instrumentation is disabled.
+		"""
+		return peekSharedState(self.path, 'stats')
+
+	def execute(self, sql, bindings=()):
+		"""
+		Executes a statement on the calling thread's connection and
+		returns the cursor. The changed rows are recorded.
+		"""
+		stats = self.queryStats()
+		if stats is None:
+			return self.conn.execute(sql, bindings)
+		start = time.time()
+		cursor = self.conn.execute(sql, bindings)
+		stats.record(sql, time.time() - start, max(cursor.rowcount, 0))
+		return cursor
+
+	def executemany(self, sql, bindings):
+		"""
+		Executes a statement for every sequence of bindings and returns the cursor.
+		"""
+		stats = self.queryStats()
+		if stats is None:
+			return self.conn.executemany(sql, bindings)
+		start = time.time()
+		cursor = self.conn.executemany(sql, bindings)
+		stats.record(sql, time.time() - start, max(cursor.rowcount, 0))
+		return cursor
+
+	def fetchone(self, sql, bindings=()):
+		"""
+		Executes a query and returns it's first row or None.
+		"""
+		stats = self.queryStats()
+		if stats is None:
+			return self.conn.execute(sql, bindings).fetchone()
+		start = time.time()
+		row = self.conn.execute(sql, bindings).fetchone()
+		stats.record(sql, time.time() - start, int(row is not None))
+		return row
+
+	def fetchall(self, sql, bindings=()):
+		"""
+		Executes a query and returns all of it's rows.
+		"""
+		stats = self.queryStats()
+		if stats is None:
+			return self.conn.execute(sql, bindings).fetchall()
+		start = time.time()
+		rows = self.conn.execute(sql, bindings).fetchall()
+		stats.record(sql, time.time() - start, len(rows))
+		return rows
+
+	def commit(self):
+		"""
+		Commits the calling thread's transaction.
+		"""
+		stats = self.queryStats()
+		if stats is None:
+			return self.conn.commit()
+		start = time.time()
+		self.conn.commit()
+		stats.recordCommit(time.time() - start)
+
+	def rollback(self):
+		self.conn.rollback()
+
+	def release(self):
+		self.pool.release()
 
 	def __bool2int__(self, value):
 		"""
@@ -38,87 +537,662 @@ class DBManager(object):
 			return int(value)
 		return value
 
+	def toColumn(self, value):
+		"""
+		Maps values onto their column representation: Booleans onto
+		integers and datetimes onto microseconds since the epoch.
+		"""
+		if isinstance(value, datetime.datetime):
+			return toEpochMicros(value)
+		return self.__bool2int__(value)
+
 	def createTables(self):
 		"""
 		Creates the two tables necessary for the backend: authgroup, user
+		and brings them up to the latest schema version.
 		"""
-		self.cursor.execute(AUTHGROUP_TABLE_CREATION)
-		self.cursor.execute(USER_TABLE_CREATION)
-		self.conn.commit()
+		self.execute(AUTHGROUP_TABLE_CREATION)
+		self.execute(USER_TABLE_CREATION)
+		self.commit()
+		self.migrate()
+		self.groups.invalidate()
+
+	def migrate(self):
+		"""
+		Applies pending schema migrations, running their statements
+		through execute(). Returns the applied versions.
+		"""
+		return migrations.migrate(self.conn, executor=self)
 
 	def insertGroup(self, name):
 		"""
 		Inserts an authorization group into the database
 		"""
-		self.cursor.execute(GROUP_INSERT, (name,))
-		self.conn.commit()
+		self.execute(GROUP_INSERT, (name,))
+		self.commit()
+		self.groups.invalidate()
+
+	def authGroups(self, reload=False):
+		"""
+		Returns the authgroup id/name mapping, loading it if necessary.
+		"""
+		if reload or not self.groups.isLoaded():
+			self.groups.load(self.fetchall(GROUP_GET_ALL))
+		return self.groups
+
+	def getAuthGroupId(self, name):
+		"""
+		Returns the id of an authgroup by it's name.
+		"""
+		groupid = self.authGroups().getId(name)
+		if groupid is None:
+			# the group may have been created by another process
+			groupid = self.authGroups(reload=True).getId(name)
+			if groupid is None:
+				raise AuthGroupDoesNotExistException(name)
+		return groupid
 
 	def insertUser(self, user):
 		"""
-		Inserts a user into the database.
+		Inserts a user into the database. Raises a UserExistsException if
+		the username is taken, e.g. by another process the filter of taken
+		usernames doesn't know about, or an EmailExistsException if
+		another user has the email.
+		"""
+		authgroup_id = self.getAuthGroupId(user.authgroup)
+		try:
+			self.execute(USER_INSERT, self.userBindings(user, authgroup_id))
+			self.commit()
+		except sqlite3.IntegrityError:
+			self.rollback()
+			# tell the violated unique index by looking the values up
+			if self.fetchone(USER_EXISTS, (user.username,)) is not None:
+				self.noteUsernames([user.username])
+				raise UserExistsException(user.username)
+			if self.fetchone(EMAIL_EXISTS, (user.email,)) is not None:
+				raise EmailExistsException(user.email)
+			raise
+		self.noteUsernames([user.username])
+		user.markClean()
+		self.users.put(user.username, user)
+
+	def deleteUser(self, username):
+		"""
+		Removes a user from the database. Returns True if he existed.
+		"""
+		deleted = self.execute(USER_DELETE, (username,)).rowcount
+		self.commit()
+		self.users.invalidate(username)
+		return deleted > 0
+
+	def userBindings(self, user, authgroup_id):
+		"""
+		Returns the values of a user in the order of USER_INSERT's columns.
 		"""
-		authgroup = user.authgroup
-		authgroup_id = self.cursor.execute('SELECT id FROM authgroup WHERE name = ?', (authgroup,)).fetchone()[0]
-		bindings = map(self.__bool2int__, [user.username, user.email, user.password, authgroup_id, user.registration_key,
-						str(user.key_expiration), user.activated, user.expired, user.logged_in,
+		return map(self.toColumn, [user.username, user.email, user.password, authgroup_id, user.registration_key,
+						user.key_expiration, user.activated, user.expired, user.logged_in,
 						user.failed_logins, user.locked, user.locked_until])
-		self.cursor.execute(USER_INSERT, bindings)
-		self.conn.commit()
+
+	def insertUsers(self, users, chunksize=BULK_CHUNK_SIZE, inserted=None):
+		"""
+		Inserts many users within a single transaction. Authgroups are
+		resolved once, username collisions are looked up per chunk and
+		the remaining users are inserted with executemany.
+		Users that cannot be inserted don't abort the batch but are
+		returned as a list of (username, reason) tuples. The users that
+		have been inserted are appended to the inserted list, if given.
+		"""
+		conflicts = []
+		if inserted is None:
+			inserted = []
+		start = len(inserted)
+		# take the write lock up front so that no collision can sneak in
+		# between the existence check and the insert
+		self.execute('BEGIN IMMEDIATE')
+		try:
+			groups = self.groups.load(self.fetchall(GROUP_GET_ALL))
+			seen = set()
+			chunk = []
+			for user in users:
+				chunk.append(user)
+				if len(chunk) >= chunksize:
+					self.insertChunk(chunk, groups, seen, conflicts, inserted)
+					chunk = []
+			if chunk:
+				self.insertChunk(chunk, groups, seen, conflicts, inserted)
+			self.commit()
+		except:
+			self.rollback()
+			del inserted[start:]
+			raise
+		for user in inserted[start:]:
+			user.markClean()
+		self.noteUsernames([user.username for user in inserted[start:]])
+		return conflicts
+
+	def insertChunk(self, chunk, groups, seen, conflicts, inserted):
+		"""
+		Inserts one chunk of a bulk registration, see insertUsers().
+		"""
+		usernames = [user.username for user in chunk]
+		placeholders = ', '.join(['?'] * len(usernames))
+		existing = set(row[0] for row in self.fetchall(USERS_EXISTING % placeholders, usernames))
+		rows = []
+		for user in chunk:
+			if user.username in seen:
+				conflicts.append((user.username, 'duplicate'))
+			elif user.username in existing:
+				conflicts.append((user.username, 'exists'))
+			elif user.authgroup not in groups:
+				conflicts.append((user.username, 'unknown authgroup'))
+			else:
+				seen.add(user.username)
+				rows.append((user, self.userBindings(user, groups[user.authgroup])))
+		if not rows:
+			return
+		cursor = self.executemany(USER_INSERT_OR_IGNORE, [bindings for user, bindings in rows])
+		if cursor.rowcount == len(rows):
+			inserted.extend([user for user, bindings in rows])
+			return
+		# some rows violated another constraint, find out which
+		candidates = [user.username for user, bindings in rows]
+		placeholders = ', '.join(['?'] * len(candidates))
+		present = set(row[0] for row in self.fetchall(USERS_EXISTING % placeholders, candidates))
+		for user, bindings in rows:
+			if user.username in present:
+				inserted.append(user)
+			else:
+				conflicts.append((user.username, 'constraint'))
 
 	def userExists(self, username):
 		"""
 		Checks whether a user with the given username is already present in the database.
+		Usernames the filter of taken ones doesn't know are free without a query.
 		"""
-		result = self.cursor.execute(USER_EXISTS, (username,)).fetchall()
-		if len(result) > 0:
-			return True
-		return False
+		usernames = self.usernameFilter()
+		if usernames is not None and not usernames.mightContain(username):
+			return False
+		return self.fetchone(USER_EXISTS, (username,)) is not None
+
+	def usernameFilter(self):
+		"""
+		Returns the Bloom filter of taken usernames, reading all of them on
+		first use, or None if USERNAME_FILTER is disabled.
+		"""
+		if not USERNAME_FILTER:
+			return None
+		usernames = peekSharedState(self.path, 'usernames')
+		if usernames is not None:
+			return usernames
+		# only one thread reads the usernames, the others wait for it
+		lock = sharedState(self.path, 'usernames-build', lambda path: threading.Lock())
+		lock.acquire()
+		try:
+			usernames = peekSharedState(self.path, 'usernames')
+			if usernames is None:
+				usernames = self.buildUsernameFilter()
+			return usernames
+		finally:
+			lock.release()
+
+	def buildUsernameFilter(self):
+		"""
+		Reads all usernames into a Bloom filter sized for at least twice
+		as many and installs it. The table is read without holding the
+		shared state's lock, so usernames inserted meanwhile are read
+		again once the filter is installed and sees every new one.
+		"""
+		capacity = max(USERNAME_FILTER_CAPACITY, self.fetchone(USER_COUNT)[0] * 2)
+		built = BloomFilter(capacity, USERNAME_FILTER_ERROR_RATE)
+		lastid = self.fetchone(USER_LAST_ID)[0] or 0
+		cursor = self.execute(USERNAMES)
+		while True:
+			rows = cursor.fetchmany(ITER_BATCH_SIZE)
+			if not rows:
+				break
+			for row in rows:
+				built.add(row[0])
+		cursor.close()
+		usernames = sharedState(self.path, 'usernames', lambda path: built)
+		for row in self.fetchall(USERNAMES_AFTER, (lastid,)):
+			usernames.add(row[0])
+		return usernames
+
+	def noteUsernames(self, usernames):
+		"""
+		Adds committed usernames to the filter of taken ones.
+		"""
+		filter = self.usernameFilter()
+		if filter is not None:
+			for username in usernames:
+				filter.add(username)
+
+	def activateByKey(self, key, now=None):
+		"""
+		Activates the unactivated user holding the given registration
+		key, or expires him if the key ran out before now, by one
+		conditional UPDATE on the unique index of the keys. Returns
+		(ACTIVATED, username), (KEY_EXPIRED, username) or (KEY_INVALID,
+		None) if no unactivated user holds the key.
+		"""
+		if now is None:
+			now = datetime.datetime.now()
+		micros = toEpochMicros(now)
+		if SQLITE_RETURNING:
+			row = self.fetchone(USER_ACTIVATE_BY_KEY + ' RETURNING username, activated', (micros, micros, key))
+		else:
+			# look the user up within the transaction of the update instead
+			self.execute('BEGIN IMMEDIATE')
+			try:
+				row = self.fetchone(USER_PENDING_KEY, (micros, key))
+				if row is not None:
+					self.execute(USER_ACTIVATE_BY_KEY, (micros, micros, key))
+			except:
+				self.rollback()
+				raise
+		self.commit()
+		if row is None:
+			# users whose timestamps haven't been converted to integers
+			# yet are activated the way they used to be
+			row = self.fetchone(USER_UNCONVERTED_KEY, (key,))
+			if row is None:
+				return KEY_INVALID, None
+			userobj = self.getUser(row[0])
+			if userobj.activated or userobj.expired:
+				return KEY_INVALID, None
+			if userobj.activate(key, now):
+				return ACTIVATED, userobj.username
+			return KEY_EXPIRED, userobj.username
+		username, activated = row
+		self.users.invalidate(username)
+		if activated:
+			self.recordEvent('activated', username)
+			return ACTIVATED, username
+		self.recordEvent('expired', username)
+		return KEY_EXPIRED, username
+
+	def authenticate(self, email, password, now=None):
+		"""
+		Checks a login attempt without constructing the user. The stored
+		hash is read by email and compared in Python, as it is salted.
+		The outcome is written by a single conditional UPDATE that only
+		applies if the user isn't locked meanwhile: a correct password
+		logs the user in, a wrong one is counted in the user's row, see
+		recordFailedLogin(), so all processes share the count and lockout.
+		Returns (AUTH_OK, username), (AUTH_LOCKED, username), (AUTH_INVALID,
+		username) for a wrong password or (AUTH_INVALID, None) if no user
+		has the email.
+		"""
+		if now is None:
+			now = datetime.datetime.now()
+		row = self.fetchone(USER_CREDENTIALS, (email,))
+		if row is None:
+			return AUTH_INVALID, None
+		userid, username, encoded, locked, locked_until, key_expires_on, lockedtext = row
+		if key_expires_on is not None or lockedtext is not None:
+			# convert the row's text timestamps first so that the lockout
+			# is decided on the integer ones, here and in the UPDATE
+			converted = migrations.convertTimestamp(lockedtext)
+			self.execute(migrations.CONVERSION_UPDATE, (migrations.convertTimestamp(key_expires_on), converted, userid))
+			self.commit()
+			if locked_until is None:
+				locked_until = converted
+		micros = toEpochMicros(now)
+		# don't spend the hashing on an attempt that is turned away anyway
+		if locked and locked_until is not None and locked_until > micros:
+			self.recordEvent('login_failed', username, reason='locked')
+			return AUTH_LOCKED, username
+		if not hashers.checkPassword(password, encoded):
+			outcome = self.recordFailedLogin(username, now)
+			self.users.invalidate(username)
+			if outcome is None:
+				# locked by a parallel attempt in the meantime
+				self.recordEvent('login_failed', username, reason='locked')
+				return AUTH_LOCKED, username
+			self.recordEvent('login_failed', username, reason='password')
+			failures, lockeduntil = outcome
+			if lockeduntil is not None:
+				self.recordEvent('locked', username, until=toEpochMicros(lockeduntil))
+			return AUTH_INVALID, username
+		# upgrade hashes of outdated algorithms or costs
+		if hashers.mustUpdate(encoded):
+			encoded = hashers.makePassword(password)
+		updated = self.writeOutcome(username, lambda: self.execute(USER_LOGIN_SUCCEEDED, (encoded, username, micros)).rowcount)
+		self.users.invalidate(username)
+		if not updated:
+			# locked by a parallel attempt in the meantime
+			self.recordEvent('login_failed', username, reason='locked')
+			return AUTH_LOCKED, username
+		self.recordEvent('login', username)
+		return AUTH_OK, username
+
+	def recordFailedLogin(self, username, now=None):
+		"""
+		Counts a failed login in the user's row and locks him for
+		LOCKOUT_PERIOD once he failed more than FAILED_LOGIN_TOLERANCE
+		times, by one conditional UPDATE. The count is thus shared by all
+		threads and processes and parallel failures lock him exactly once.
+		A lockout that is over starts the count anew. Returns the number
+		of failures and the end of a lockout started now or None, or
+		returns None if the user is locked already.
+		"""
+		if now is None:
+			now = datetime.datetime.now()
+		lockeduntil = now + LOCKOUT_PERIOD
+		bindings = (FAILED_LOGIN_TOLERANCE, FAILED_LOGIN_TOLERANCE, toEpochMicros(lockeduntil), username, toEpochMicros(now))
+		def write():
+			if SQLITE_RETURNING:
+				return self.fetchone(USER_LOGIN_FAILED + ' RETURNING failed_logins, locked', bindings)
+			# read the outcome within the transaction of the update instead
+			if self.execute(USER_LOGIN_FAILED, bindings).rowcount == 0:
+				return None
+			return self.fetchone(USER_FAILED_LOGINS, (username,))
+		row = self.writeOutcome(username, write)
+		if row is None:
+			return None
+		failures, locked = row
+		if not locked:
+			lockeduntil = None
+		return failures, lockeduntil
+
+	def writeOutcome(self, username, write):
+		"""
+		Calls write() to change a user's row within a transaction of its
+		own and commits. The user's values still queued for write-behind
+		are written first so that they can't overwrite the outcome later.
+		Returns the result of write().
+		"""
+		queue = self.writeBehindQueue()
+		if queue is not None:
+			queue.flushLock.acquire()
+		try:
+			try:
+				if queue is not None:
+					pending = queue.take(username)
+					if pending:
+						self.writeUserValues(username, pending)
+				result = write()
+				self.commit()
+			except:
+				self.rollback()
+				raise
+		finally:
+			if queue is not None:
+				queue.flushLock.release()
+		return result
+
+	def recordEvent(self, event, username, **details):
+		"""
+		Records an event of a user in the event log of the configured
+		database, if enabled, which is also the one User records to. The
+		shards of a sharded backend thus record to the catalog's log.
+		"""
+		eventlog.record(event, username, **details)
 
 	def getAuthGroupName(self, groupid):
 		"""
 		Returns the name of an authgroup by it's id.
 		"""
-		result = self.cursor.execute(GROUP_GET_NAME, (groupid,))
-		return result.fetchone()[0]
+		name = self.authGroups().getName(groupid)
+		if name is None:
+			name = self.authGroups(reload=True).getName(groupid)
+		return name
 
 	def getUserDetails(self, username):
 		"""
 		Retrieve an existing user's details from the db.
 		"""
-		result = self.cursor.execute(USER_GET, (username,))
-		return result.fetchall()
+		return self.fetchall(USER_GET, (username,))
 
-	def updateUser(self, userobj):
+	def enableWriteBehind(self, **options):
 		"""
-		Propagates the current state of the given user object to the database.
+		Leaves user updates of this database to a write-behind queue,
+		see writebehind.WriteBehindQueue for the options. Returns the queue.
 		"""
-		bindings = (userobj.activated, userobj.expired, userobj.logged_in, userobj.failed_logins, userobj.locked, userobj.locked_until, userobj.username,)
-		self.cursor.execute(USER_UPDATE, bindings)
-		self.conn.commit()
+		def create(path):
+			queue = WriteBehindQueue(self, **options)
+			# don't lose the queued updates if the process ends without closing the pool
+			atexit.register(queue.stop)
+			return queue
+		return sharedState(self.path, 'writebehind', create)
+
+	def disableWriteBehind(self):
+		"""
+		Writes user updates immediately again after writing what is queued.
+		"""
+		queue = popSharedState(self.path, 'writebehind')
+		if queue is not None:
+			queue.stop()
+
+	def writeBehindQueue(self):
+		"""
+		Returns the write-behind queue or None if updates are written immediately.
+		"""
+		return peekSharedState(self.path, 'writebehind')
+
+	def sessionStorages(self):
+		"""
+		Returns the databases holding sessions, just this one.
+		"""
+		return [self]
+
+	def sessionShard(self, username):
+		"""
+		Returns the index of the database among sessionStorages() that
+		holds the sessions of a user.
+		"""
+		return 0
+
+	def updateUser(self, userobj, immediate=False):
+		"""
+		Propagates the changes of the given user object to the database.
+		Only the columns of attributes changed since the user has been
+		loaded or last written are updated. If nothing changed, nothing
+		is written. Returns True if the user has been written or queued.
+		With a write-behind queue the changes are queued unless immediate
+		is True or a security-critical attribute like 'locked' changed.
+		"""
+		changed = [name for name in userobj.changedFields() if name in USER_UPDATABLE_COLUMNS]
+		if not changed:
+			self.users.put(userobj.username, userobj)
+			return False
+		values = dict([(name, getattr(userobj, name)) for name in changed])
+		queue = self.writeBehindQueue()
+		if queue is None:
+			self.writeUserValues(userobj.username, values)
+			self.commit()
+		elif not immediate and not USER_SECURITY_CRITICAL.intersection(changed):
+			queue.enqueue(userobj.username, values)
+		else:
+			# wait for a running flush and take over the user's queued
+			# values so that they can't overwrite this write later on
+			queue.flushLock.acquire()
+			try:
+				pending = queue.take(userobj.username)
+				pending.update(values)
+				self.writeUserValues(userobj.username, pending)
+				self.commit()
+			finally:
+				queue.flushLock.release()
+		userobj.markClean(changed)
+		self.users.put(userobj.username, userobj)
+		return True
+
+	def writeUserValues(self, username, values):
+		"""
+		Updates the columns of the given {attribute : value} dictionary
+		of a user without committing.
+		"""
+		names = sorted(values.keys())
+		assignments = ', '.join(['%s = ?' % USER_UPDATABLE_COLUMNS[name] for name in names])
+		bindings = map(self.toColumn, [values[name] for name in names])
+		bindings.append(username)
+		self.execute(USER_UPDATE_COLUMNS % assignments, bindings)
+
+	def expireUsers(self, now=None, purge=False, batchsize=SWEEP_BATCH_SIZE, pause=SWEEP_PAUSE, swept=None):
+		"""
+		Marks all unactivated users whose registration key expired before
+		now as expired or, if purge is True, deletes them. Works in
+		batches of one transaction each so that the write lock is never
+		held for long, pausing in between. Returns the number of users
+		expired or deleted, whose usernames are appended to the swept
+		list, if given.
+		"""
+		if now is None:
+			now = datetime.datetime.now()
+		if purge:
+			select, change = USERS_OVERDUE_ALL, USERS_DELETE
+		else:
+			select, change = USERS_OVERDUE, USERS_EXPIRE
+		total = 0
+		while True:
+			self.execute('BEGIN IMMEDIATE')
+			try:
+				rows = self.fetchall(select, (toEpochMicros(now), batchsize))
+				if rows:
+					self.execute(change % ', '.join(['?'] * len(rows)), [row[0] for row in rows])
+				self.commit()
+			except:
+				self.rollback()
+				raise
+			for userid, username in rows:
+				self.users.invalidate(username)
+			if swept is not None:
+				swept.extend([username for userid, username in rows])
+			total += len(rows)
+			if len(rows) < batchsize:
+				return total
+			time.sleep(pause)
+
+	def iterUsers(self, filter=None, columns=None, batchsize=ITER_BATCH_SIZE):
+		"""
+		Iterates over all users, or those whose fields equal the values of
+		the filter dictionary, as lightweight read-only records with the
+		given fields, by default all of them. See USER_RECORD_FIELDS for
+		the fields. Rows are fetched 'batchsize' at a time so memory stays
+		flat however many users there are.
+		"""
+		if columns is None:
+			columns = USER_RECORD_FIELD_NAMES
+		if filter is None:
+			filter = {}
+		fields = dict([(name, (selected, decoder)) for name, selected, decoder in USER_RECORD_FIELDS])
+		for name in list(columns) + filter.keys():
+			if name not in fields:
+				raise ValueError('unknown user field %r' % name)
+		selected = []
+		decoders = []
+		for name in columns:
+			start = len(selected)
+			selected.extend(fields[name][0])
+			decoders.append((start, len(selected), fields[name][1]))
+		conditions = []
+		bindings = []
+		for name, value in filter.iteritems():
+			# filter on the first, integer, column of timestamps
+			conditions.append('%s = ?' % fields[name][0][0])
+			bindings.append(self.toColumn(value))
+		join = ''
+		if 'authgroup' in columns or 'authgroup' in filter:
+			join = USER_ITER_JOIN
+		where = ''
+		if conditions:
+			where = ' WHERE ' + ' AND '.join(conditions)
+		record = userRecordClass(columns)
+		sql = USER_ITER % (', '.join(selected), join, where)
+		stats = self.queryStats()
+		start = time.time()
+		count = 0
+		cursor = self.conn.cursor()
+		cursor.execute(sql, bindings)
+		while True:
+			rows = cursor.fetchmany(batchsize)
+			if not rows:
+				break
+			count += len(rows)
+			for row in rows:
+				values = []
+				for start, end, decoder in decoders:
+					if decoder is None:
+						values.append(row[start])
+					else:
+						values.append(decoder(*row[start:end]))
+				yield record._make(values)
+		cursor.close()
+		if stats is not None:
+			# includes the time spent by the caller between the batches
+			stats.record(sql, time.time() - start, count)
 
 	def getUser(self, username):
 		"""
 		Retrieve a user by it's name.
 		"""
+		userobj = self.users.get(username)
+		if userobj is not None:
+			return userobj
+		row = self.fetchone(USER_GET_BY_USERNAME, (username,))
 		# throw exception if it doesn't exist
-		if not self.userExists(username):
+		if row is None:
 			raise UserDoesNotExistException(username)
-		else:
-			# scrap the parameters and set up a dictionairy
-			details = self.getUserDetails(username)[0][1:]
-			d = {'username' : details[0],
-                        'email' : details[1],
-                        'password' : details[2],
-                        'authgroupid' : details[3],
-                        'activated' : bool(details[6]),
-                        'expired' : bool(details[7]),
-                        'logged_in' : bool(details[8]),
-                        'failed_logins' : details[9],
-                        'locked' : bool(details[10]),
-                        'registration_key' : details[4],
-                        'key_expiration' : datetime.datetime.strptime(details[5], "%Y-%m-%d %H:%M:%S.%f"),
-			'locked_until' : datetime.datetime.strptime(details[11], "%Y-%m-%d %H:%M:%S.%f")}
-			d['authgroup'] = self.getAuthGroupName(d['authgroupid'])
-			d.pop('authgroupid')
-			# return a user constructed from the dictionairy
-			return User(**d)
+		return self.loadUser(row)
+
+	def getUserByEmail(self, email):
+		"""
+		Retrieve a user by it's email using the unique email index.
+		"""
+		row = self.fetchone(USER_GET_BY_EMAIL, (email,))
+		if row is None:
+			raise UserDoesNotExistException(email)
+		# prefer the object already known to the identity map
+		userobj = self.users.get(row[0])
+		if userobj is None:
+			userobj = self.loadUser(row)
+		return userobj
+
+	def getLockout(self, username):
+		"""
+		Reads whether a user is locked and until when from the database,
+		bypassing the identity map, as another process may have locked
+		him meanwhile. Returns (locked, locked_until) or None if there
+		is no such user.
+		"""
+		row = self.fetchone(USER_LOCKOUT, (username,))
+		if row is None:
+			return None
+		return bool(row[0]), timestampFromColumns(row[1], row[2])
+
+	def loadUser(self, row):
+		"""
+		Constructs a user from a row selected by USER_GET_WITH_GROUP
+		including updates still waiting in the write-behind queue and
+		adds it to the identity map.
+		"""
+		userobj = self.userFromRow(row)
+		queue = self.writeBehindQueue()
+		if queue is not None:
+			for name, value in queue.pendingValues(userobj.username).iteritems():
+				setattr(userobj, name, value)
+			userobj.markClean()
+		self.users.put(userobj.username, userobj)
+		return userobj
+
+	def userFromRow(self, row):
+		"""
+		Constructs a user from a row selected by USER_GET_WITH_GROUP.
+		Rows not yet converted to integer timestamps still carry them as text.
+		"""
+		# scrap the parameters and set up a dictionairy
+		d = {'username' : row[0],
+			'email' : row[1],
+			'password' : row[2],
+			'authgroup' : row[3],
+			'registration_key' : row[4],
+			'key_expiration' : timestampFromColumns(row[12], row[5]),
+			'activated' : bool(row[6]),
+			'expired' : bool(row[7]),
+			'logged_in' : bool(row[8]),
+			'failed_logins' : row[9],
+			'locked' : bool(row[10]),
+			'locked_until' : timestampFromColumns(row[13], row[11])}
+		# return a user constructed from the dictionairy
+		return User(**d)
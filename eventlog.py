@@ -0,0 +1,275 @@
+# /usr/bin/python
+
+# Append-only log of authentication events
+#
+# Logins, failed logins, logouts, activations and lockout transitions
+# are recorded for auditing without touching the user database. Events
+# are only appended to an in-memory queue by the calling thread and
+# written in batches by a background thread to JSON Lines segment files
+# in a directory of their own, by default the database's path followed
+# by '.events'. Every process writes segments of its own, named after
+# its process id, and what is still queued is written at exit. A segment
+# is closed once it reached a configurable size and the next one is
+# started. Events of all processes are streamed back in the order they
+# happened, e.g. of a single user or a period of time, by
+#
+#	python eventlog.py --user NAME --since '2012-01-01 00:00:00' [directory]
+
+import os
+import re
+import json
+import heapq
+import atexit
+import logging
+import threading
+from collections import deque
+from optparse import OptionParser
+import config
+from config import EVENT_LOG_BATCH_SIZE, EVENT_LOG_INTERVAL, EVENT_LOG_SEGMENT_SIZE
+import db
+from utils import *
+
+log = logging.getLogger(__name__)
+
+SEGMENT_NAME = 'events-%d-%06d.jsonl'
+# segments of older versions lack the writing process' id
+SEGMENT_PATTERN = re.compile(r'^events-(?:(\d+)-)?(\d+)\.jsonl$')
+
+def writers(directory):
+	"""
+	Returns the paths of the segment files of a directory by the id of
+	the process that wrote them, or None for older ones, oldest first.
+	"""
+	numbered = {}
+	for name in os.listdir(directory):
+		match = SEGMENT_PATTERN.match(name)
+		if match:
+			writer = match.group(1) and int(match.group(1))
+			numbered.setdefault(writer, []).append((int(match.group(2)), os.path.join(directory, name)))
+	paths = {}
+	for writer, segments in numbered.iteritems():
+		segments.sort()
+		paths[writer] = [path for number, path in segments]
+	return paths
+
+def segments(directory):
+	"""
+	Returns the paths of the segment files of a directory, those of one
+	process after the other and each process' oldest first.
+	"""
+	paths = []
+	for writer, segments in sorted(writers(directory).items()):
+		paths.extend(segments)
+	return paths
+
+class EventLog(object):
+	"""
+	Writes recorded events to the segment files of a directory. Events
+	are written every 'interval' seconds or as soon as 'batchsize' of
+	them are waiting, whichever comes first. Segments are rotated once
+	they reach 'segmentsize' bytes. The segments are named after the
+	writer, by default the id of the process, so that no two processes
+	append to the same file.
+	"""
+
+	def __init__(self, directory, batchsize=EVENT_LOG_BATCH_SIZE, interval=EVENT_LOG_INTERVAL, segmentsize=EVENT_LOG_SEGMENT_SIZE,
+			writer=None):
+		if writer is None:
+			writer = os.getpid()
+		self.directory = directory
+		self.writer = writer
+		self.batchsize = batchsize
+		self.interval = interval
+		self.segmentsize = segmentsize
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		# appending to a deque is thread-safe and doesn't take a lock
+		self.pending = deque()
+		self.wakeup = threading.Event()
+		# only one batch may be written at a time
+		self.writeLock = threading.Lock()
+		existing = writers(directory).get(writer)
+		if existing:
+			# continue the last segment unless it is full
+			self.segment = int(SEGMENT_PATTERN.match(os.path.basename(existing[-1])).group(2))
+			if os.path.getsize(existing[-1]) >= segmentsize:
+				self.segment += 1
+		else:
+			self.segment = 1
+		self.outfile = None
+		self.running = True
+		# counters
+		self.written = 0
+		self.batches = 0
+		self.rotations = 0
+		self.thread = threading.Thread(target=self.run, name='eventlog')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def record(self, event, username, **details):
+		"""
+		Queues an event of a user with further details to be written.
+		"""
+		details['at'] = toEpochMicros(datetime.datetime.now())
+		details['event'] = event
+		details['user'] = username
+		self.pending.append(details)
+		if len(self.pending) >= self.batchsize:
+			self.wakeup.set()
+
+	def depth(self):
+		return len(self.pending)
+
+	def run(self):
+		"""
+		The background thread's loop.
+		"""
+		while self.running:
+			self.wakeup.wait(self.interval)
+			self.wakeup.clear()
+			try:
+				self.flush()
+			except Exception:
+				log.exception('writing auth events failed')
+
+	def segmentPath(self):
+		return os.path.join(self.directory, SEGMENT_NAME % (self.writer, self.segment))
+
+	def flush(self):
+		"""
+		Appends all waiting events to the current segment. Returns the
+		number of events written.
+		"""
+		self.writeLock.acquire()
+		try:
+			batch = []
+			while self.pending:
+				batch.append(self.pending.popleft())
+			if not batch:
+				return 0
+			try:
+				if self.outfile is None:
+					self.outfile = open(self.segmentPath(), 'a')
+				self.outfile.write(''.join([json.dumps(event, separators=(',', ':'), sort_keys=True) + '\n'
+								for event in batch]))
+				self.outfile.flush()
+			except:
+				# keep the events for the next attempt, in their order
+				self.pending.extendleft(reversed(batch))
+				raise
+			self.written += len(batch)
+			self.batches += 1
+			if self.outfile.tell() >= self.segmentsize:
+				self.outfile.close()
+				self.outfile = None
+				self.segment += 1
+				self.rotations += 1
+			return len(batch)
+		finally:
+			self.writeLock.release()
+
+	def stop(self):
+		"""
+		Stops the background thread and writes what is still waiting.
+		Stopping it again doesn't do anything.
+		"""
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()
+		self.flush()
+		if self.outfile is not None:
+			self.outfile.close()
+			self.outfile = None
+
+	def stats(self):
+		return {'depth' : self.depth(),
+			'written' : self.written,
+			'batches' : self.batches,
+			'rotations' : self.rotations,
+			'segment' : self.segment}
+
+def enable(path=None, directory=None, **options):
+	"""
+	Starts recording the events of the users of the given database file,
+	see EventLog for the options. Returns the event log.
+	"""
+	def create(path):
+		eventlog = EventLog(directory or config.EVENT_LOG_DIRECTORY or path + '.events', **options)
+		# don't lose the queued events if the process ends without closing the pool
+		atexit.register(eventlog.stop)
+		return eventlog
+	return db.sharedState(path, 'events', create)
+
+def getEventLog(path=None):
+	"""
+	Returns the event log of the given database file, which is started on
+	first use if EVENT_LOG is set, or None if events aren't recorded.
+	"""
+	if config.EVENT_LOG:
+		return enable(path)
+	return db.peekSharedState(path, 'events')
+
+def record(event, username, **details):
+	"""
+	Records an event of a user of the configured database, if enabled.
+	"""
+	eventlog = getEventLog()
+	if eventlog is not None:
+		eventlog.record(event, username, **details)
+
+def iterEvents(directory, username=None, start=None, end=None):
+	"""
+	Streams the events of all segments of a directory, optionally only
+	those of a user and those that happened from start until before end.
+	The events of the processes' segments are merged by their time.
+	"""
+	if start is not None:
+		start = toEpochMicros(start)
+	if end is not None:
+		end = toEpochMicros(end)
+	streams = [readEvents(paths, username, start, end) for writer, paths in sorted(writers(directory).items())]
+	for at, index, event in heapq.merge(*streams):
+		yield event
+
+def readEvents(paths, username, start, end):
+	"""
+	Streams the matching events of the segments of one process, see
+	iterEvents(), as (time, position, event) tuples.
+	"""
+	index = 0
+	for path in paths:
+		infile = open(path)
+		for line in infile:
+			# a line cut short by a crash is skipped
+			try:
+				event = json.loads(line)
+			except ValueError:
+				continue
+			if username is not None and event['user'] != username:
+				continue
+			if start is not None and event['at'] < start:
+				continue
+			if end is not None and event['at'] >= end:
+				continue
+			index += 1
+			yield event['at'], index, event
+		infile.close()
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='%prog [options] [directory]')
+	parser.add_option('--user', help='only events of this user')
+	parser.add_option('--since', help="only events from then on, as 'YYYY-MM-DD HH:MM:SS'")
+	parser.add_option('--until', help='only events before then')
+	options, args = parser.parse_args()
+	if args:
+		directory = args[0]
+	else:
+		directory = config.EVENT_LOG_DIRECTORY or config.DATABASE_PATH + '.events'
+	start = end = None
+	if options.since:
+		start = parseTimestamp(options.since)
+	if options.until:
+		end = parseTimestamp(options.until)
+	for event in iterEvents(directory, options.user, start, end):
+		event['at'] = str(fromEpochMicros(event['at']))
+		print json.dumps(event, sort_keys=True)
@@ -0,0 +1,237 @@
+# /usr/bin/python
+
+# Password hashing
+#
+# Passwords are stored as encoded strings carrying the algorithm and its
+# parameters, e.g. 'pbkdf2_sha256$100000$<salt>$<hash>', so that hashes
+# of different algorithms and costs can coexist. Hashes stored before
+# this module existed are bare SHA1 hex digests, they are still accepted
+# but rehashed upon the next successful login.
+#
+# Run 'python hashers.py [cost ...]' to measure logins per second per
+# core at the given costs.
+
+import sys
+import os
+import time
+import hmac
+import base64
+import struct
+import binascii
+import hashlib
+import logging
+import multiprocessing
+from config import PASSWORD_HASHER, PASSWORD_COSTS, PASSWORD_HASHING_PROCESSES
+from utils import *
+
+log = logging.getLogger(__name__)
+
+def pbkdf2(password, salt, iterations, digest=hashlib.sha256):
+	"""
+	Derives a key of the digest's size from password and salt as of
+	PBKDF2 (RFC 2898). Uses hashlib's implementation where available.
+	"""
+	if hasattr(hashlib, 'pbkdf2_hmac'):
+		return hashlib.pbkdf2_hmac(digest().name, password, salt, iterations)
+	mac = hmac.new(password, None, digest)
+	def prf(data):
+		h = mac.copy()
+		h.update(data)
+		return h.digest()
+	# a single block is enough for a key of the digest's size
+	u = prf(salt + struct.pack('>I', 1))
+	result = int(binascii.hexlify(u), 16)
+	for i in xrange(iterations - 1):
+		u = prf(u)
+		result ^= int(binascii.hexlify(u), 16)
+	return binascii.unhexlify('%0*x' % (len(u) * 2, result))
+
+def toBytes(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+class SHA1Hasher(object):
+	"""
+	The legacy unsalted SHA1 hex digest. Only kept to verify old hashes.
+	"""
+	algorithm = 'sha1'
+
+	def encode(self, password, salt=None, cost=None):
+		return sha1Hash(toBytes(password))
+
+	def verify(self, password, encoded):
+		return constantTimeCompare(self.encode(password), encoded)
+
+	def cost(self, encoded):
+		return None
+
+class PBKDF2Hasher(object):
+	"""
+	PBKDF2 with HMAC-SHA256, a random salt per password and the
+	number of iterations as cost.
+	"""
+	algorithm = 'pbkdf2_sha256'
+
+	def encode(self, password, salt=None, cost=None):
+		if salt is None:
+			salt = binascii.hexlify(os.urandom(12))
+		if cost is None:
+			cost = PASSWORD_COSTS[self.algorithm]
+		key = pbkdf2(toBytes(password), toBytes(salt), cost)
+		return '%s$%d$%s$%s' % (self.algorithm, cost, salt, base64.b64encode(key))
+
+	def verify(self, password, encoded):
+		algorithm, cost, salt, key = encoded.split('$', 3)
+		return constantTimeCompare(self.encode(password, salt, int(cost)), encoded)
+
+	def cost(self, encoded):
+		return int(encoded.split('$', 2)[1])
+
+HASHERS = {SHA1Hasher.algorithm : SHA1Hasher(),
+	PBKDF2Hasher.algorithm : PBKDF2Hasher()}
+
+def identifyHasher(encoded):
+	"""
+	Returns the hasher that produced the encoded password.
+	"""
+	if '$' not in encoded:
+		return HASHERS['sha1']
+	return HASHERS[encoded.split('$', 1)[0]]
+
+def encodePassword(password, algorithm=None, cost=None):
+	"""
+	Hashes a password with the given algorithm, by default the configured one.
+	"""
+	if algorithm is None:
+		algorithm = PASSWORD_HASHER
+	return HASHERS[algorithm].encode(password, cost=cost)
+
+def verifyPassword(password, encoded):
+	"""
+	Returns True if the password matches the encoded one. An encoded
+	password of an unknown algorithm or malformed otherwise never
+	matches and is logged.
+	"""
+	try:
+		return identifyHasher(encoded).verify(password, encoded)
+	except (KeyError, ValueError, TypeError):
+		log.error('unreadable password hash %r', encoded)
+		return False
+
+def mustUpdate(encoded):
+	"""
+	Returns True if the encoded password should be rehashed because it
+	uses another algorithm or cost than the configured ones.
+	"""
+	hasher = identifyHasher(encoded)
+	if hasher.algorithm != PASSWORD_HASHER:
+		return True
+	return hasher.cost(encoded) != PASSWORD_COSTS[PASSWORD_HASHER]
+
+class InlineBackend(object):
+	"""
+	Hashes in the calling thread.
+	"""
+
+	def encode(self, password):
+		return encodePassword(password)
+
+	def encodeMany(self, passwords):
+		return map(encodePassword, passwords)
+
+	def verify(self, password, encoded):
+		return verifyPassword(password, encoded)
+
+class ProcessBackend(object):
+	"""
+	Hashes in a pool of worker processes so that hashing isn't
+	serialised by the GIL and scales across cores.
+	"""
+
+	def __init__(self, processes):
+		self.processes = processes
+		self.pool = multiprocessing.Pool(processes)
+
+	def encode(self, password):
+		return self.pool.apply(encodePassword, (password,))
+
+	def encodeMany(self, passwords, chunksize=16):
+		return self.pool.map(encodePassword, passwords, chunksize)
+
+	def verify(self, password, encoded):
+		return self.pool.apply(verifyPassword, (password, encoded))
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+backend = None
+
+def getBackend():
+	"""
+	Returns the configured hashing backend, a process pool of
+	PASSWORD_HASHING_PROCESSES workers or hashing inline if that is 0.
+	"""
+	global backend
+	if backend is None:
+		if PASSWORD_HASHING_PROCESSES:
+			backend = ProcessBackend(PASSWORD_HASHING_PROCESSES)
+		else:
+			backend = InlineBackend()
+	return backend
+
+def setBackend(newbackend):
+	"""
+	Replaces the hashing backend, returns the previous one.
+	"""
+	global backend
+	previous, backend = backend, newbackend
+	return previous
+
+def makePassword(password):
+	"""
+	Hashes a new password with the configured algorithm and cost.
+	"""
+	return getBackend().encode(password)
+
+def makePasswords(passwords):
+	"""
+	Hashes many new passwords, in parallel if a process pool is configured.
+	"""
+	return getBackend().encodeMany(passwords)
+
+def checkPassword(password, encoded):
+	"""
+	Returns True if the password matches the encoded one.
+	"""
+	return getBackend().verify(password, encoded)
+
+def benchmark(costs, duration=1.0, algorithm=None):
+	"""
+	Measures how many passwords a single core verifies per second at the
+	given costs. Returns a list of (cost, verifications per second).
+	"""
+	if algorithm is None:
+		algorithm = PASSWORD_HASHER
+	results = []
+	for cost in costs:
+		encoded = encodePassword('benchmark', algorithm, cost)
+		count = 0
+		start = time.time()
+		while time.time() - start < duration:
+			verifyPassword('benchmark', encoded)
+			count += 1
+		results.append((cost, count / (time.time() - start)))
+	return results
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		costs = [int(cost) for cost in sys.argv[1:]]
+	else:
+		costs = [1000, 10000, 100000, 200000]
+	cores = multiprocessing.cpu_count()
+	print '%s on %d cores' % (PASSWORD_HASHER, cores)
+	print '%10s %18s %18s' % ('cost', 'logins/s/core', 'logins/s total')
+	for cost, rate in benchmark(costs):
+		print '%10d %18.1f %18.1f' % (cost, rate, rate * cores)
@@ -0,0 +1,138 @@
+# /usr/bin/python
+
+# Instrumentation of database statements
+#
+# Once enabled for a database, every statement its manager executes is
+# counted and timed per statement, along with the rows it returned or
+# changed and the time spent committing. Statements slower than a
+# threshold are logged to the 'db.slow' logger. snapshot() returns
+# everything as a dictionary ready to be exported.
+
+import re
+import random
+import threading
+import logging
+from config import SLOW_QUERY_THRESHOLD, INSTRUMENTATION_SAMPLES
+
+slowlog = logging.getLogger('db.slow')
+
+# statements only differing in the length of a list of bindings are the same
+BINDING_LIST = re.compile(r'\?(, \?)+')
+WHITESPACE = re.compile(r'\s+')
+
+def normalize(sql):
+	"""
+	Returns the key statistics of a statement are kept under.
+	"""
+	return BINDING_LIST.sub('?, ...', WHITESPACE.sub(' ', sql).strip())
+
+class Timings(object):
+	"""
+	Call count, total and maximum duration and a bounded random sample
+	of durations for percentiles.
+	"""
+
+	def __init__(self, samples):
+		self.samples = samples
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.rows = 0
+		self.durations = []
+
+	def add(self, seconds, rows=0):
+		self.count += 1
+		self.total += seconds
+		self.rows += rows
+		if seconds > self.max:
+			self.max = seconds
+		# reservoir sampling keeps memory bounded
+		if len(self.durations) < self.samples:
+			self.durations.append(seconds)
+		else:
+			index = random.randint(0, self.count - 1)
+			if index < self.samples:
+				self.durations[index] = seconds
+
+	def summary(self):
+		durations = sorted(self.durations)
+		def percentile(fraction):
+			if not durations:
+				return 0.0
+			return durations[min(int(fraction * len(durations)), len(durations) - 1)] * 1000
+		mean = 0.0
+		if self.count:
+			mean = self.total / self.count * 1000
+		return {'count' : self.count,
+			'rows' : self.rows,
+			'total_ms' : self.total * 1000,
+			'mean_ms' : mean,
+			'p50_ms' : percentile(0.50),
+			'p95_ms' : percentile(0.95),
+			'p99_ms' : percentile(0.99),
+			'max_ms' : self.max * 1000}
+
+class QueryStats(object):
+	"""
+	Statistics of the statements and commits of one database.
+	"""
+
+	def __init__(self, threshold=SLOW_QUERY_THRESHOLD, samples=INSTRUMENTATION_SAMPLES):
+		self.threshold = threshold
+		self.samples = samples
+		self.lock = threading.Lock()
+		self.statements = {}
+		self.commits = Timings(samples)
+		self.slow = 0
+
+	def record(self, sql, seconds, rows=0):
+		"""
+		Records an executed statement.
+		"""
+		key = normalize(sql)
+		self.lock.acquire()
+		try:
+			timings = self.statements.get(key)
+			if timings is None:
+				timings = self.statements[key] = Timings(self.samples)
+			timings.add(seconds, rows)
+			if seconds >= self.threshold:
+				self.slow += 1
+		finally:
+			self.lock.release()
+		if seconds >= self.threshold:
+			slowlog.warning('%.1f ms, %d rows: %s', seconds * 1000, rows, key)
+
+	def recordCommit(self, seconds):
+		"""
+		Records a commit, i.e. the time spent syncing to disk.
+		"""
+		self.lock.acquire()
+		try:
+			self.commits.add(seconds)
+		finally:
+			self.lock.release()
+		if seconds >= self.threshold:
+			slowlog.warning('%.1f ms: COMMIT', seconds * 1000)
+
+	def snapshot(self):
+		"""
+		Returns the statistics so far as a dictionary.
+		"""
+		self.lock.acquire()
+		try:
+			return {'statements' : dict([(key, timings.summary()) for key, timings in self.statements.iteritems()]),
+				'commits' : self.commits.summary(),
+				'slow' : self.slow,
+				'threshold_ms' : self.threshold * 1000}
+		finally:
+			self.lock.release()
+
+	def reset(self):
+		self.lock.acquire()
+		try:
+			self.statements = {}
+			self.commits = Timings(self.samples)
+			self.slow = 0
+		finally:
+			self.lock.release()
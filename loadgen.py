@@ -0,0 +1,280 @@
+# /usr/bin/python
+
+# Concurrent load generator
+#
+# Seeds a database and drives a mix of user operations against it from
+# several threads in each of several processes at once, reproducing the
+# contention for SQLite's write lock. Reports throughput and latency
+# percentiles per operation, the time spent in writing statements and
+# commits, an estimate of how much of it was waiting for the lock, and
+# the number of 'database is locked' errors, e.g. to compare
+#
+#	python loadgen.py --threads 8 --processes 4 --journal-mode WAL
+#	python loadgen.py --threads 8 --processes 4 --journal-mode DELETE
+
+import time
+import json
+import random
+import bisect
+import sqlite3
+import threading
+import multiprocessing
+from optparse import OptionParser
+import config
+from config import POOL_SIZE, JOURNAL_MODE, BUSY_TIMEOUT
+import db
+import user
+import mailer
+import benchmark
+from utils import *
+
+OPERATIONS = ['register', 'activate', 'login', 'login_wrong', 'logout', 'lookup', 'authenticate']
+DEFAULT_MIX = 'register:5,activate:5,login:30,login_wrong:10,logout:10,lookup:30,authenticate:10'
+# statements waiting for the write lock
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'BEGIN')
+
+def parseMix(text):
+	"""
+	Parses 'operation:weight,...' into a list of (operation, weight).
+	"""
+	mix = []
+	for part in text.split(','):
+		operation, weight = part.split(':')
+		if operation not in OPERATIONS:
+			raise ValueError('unknown operation %r' % operation)
+		mix.append((operation, int(weight)))
+	return mix
+
+class DiscardTransport(object):
+	"""
+	Drops activation mails, their delivery is not part of the load.
+	"""
+
+	def open(self):
+		pass
+
+	def send(self, message):
+		pass
+
+	def close(self):
+		pass
+
+def operate(operation, manager, username, keys, name):
+	"""
+	Runs one operation on a seeded user, or registers a user of the given name.
+	"""
+	email = '%s@example.com' % username
+	if operation == 'register':
+		user.User(username=name, password=benchmark.PASSWORD, email='%s@example.com' % name, authgroup='non-admin').save()
+	elif operation == 'activate':
+		manager.getUser(username).activate(keys[username])
+	elif operation == 'login':
+		manager.getUser(username).login(email, benchmark.PASSWORD)
+	elif operation == 'login_wrong':
+		manager.getUser(username).login(email, 'wrong')
+	elif operation == 'logout':
+		manager.getUser(username).logout()
+	elif operation == 'lookup':
+		manager.getUser(username)
+	elif operation == 'authenticate':
+		manager.authenticate(email, benchmark.PASSWORD)
+
+def work(manager, keys, mix, deadline, seed, prefix):
+	"""
+	Runs randomly chosen operations until the deadline. Returns the
+	latencies, errors and 'database is locked' errors per operation.
+	"""
+	rng = random.Random(seed)
+	operations = [operation for operation, weight in mix]
+	cumulative = []
+	total = 0
+	for operation, weight in mix:
+		total += weight
+		cumulative.append(total)
+	usernames = sorted(keys)
+	result = {'latencies' : dict([(operation, []) for operation in operations]),
+		'errors' : dict([(operation, 0) for operation in operations]),
+		'locked' : dict([(operation, 0) for operation in operations])}
+	registered = 0
+	while time.time() < deadline:
+		operation = operations[bisect.bisect_right(cumulative, rng.randrange(total))]
+		username = rng.choice(usernames)
+		registered += 1
+		start = time.time()
+		try:
+			operate(operation, manager, username, keys, '%s_%d' % (prefix, registered))
+		except sqlite3.OperationalError, e:
+			if 'locked' in str(e):
+				result['locked'][operation] += 1
+			else:
+				result['errors'][operation] += 1
+			manager.rollback()
+			continue
+		except Exception:
+			result['errors'][operation] += 1
+			manager.rollback()
+			continue
+		result['latencies'][operation].append(time.time() - start)
+	manager.release()
+	return result
+
+def runProcess(path, keys, mix, duration, threads, poolsize, journalmode, busytimeout, index, queue=None):
+	"""
+	Runs 'threads' workers for duration seconds. Returns their merged
+	results along with the statement statistics, or puts them on the queue.
+	"""
+	config.DATABASE_PATH = path
+	mails = mailer.MailQueue(DiscardTransport())
+	previous = mailer.setMailQueue(mails)
+	db.sharedState(path, 'pool', lambda path: db.ConnectionPool(path, poolsize,
+				journalMode=journalmode, busyTimeout=busytimeout))
+	manager = db.getManager(path)
+	stats = manager.enableInstrumentation(threshold=float('inf'))
+	deadline = time.time() + duration
+	results = []
+	def run(thread):
+		results.append(work(manager, keys, mix, deadline, random.random(), 'load%d_%d' % (index, thread)))
+	workers = [threading.Thread(target=run, args=(thread,)) for thread in range(threads)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	merged = {'latencies' : {}, 'errors' : {}, 'locked' : {}, 'statements' : stats.snapshot()}
+	for operation, weight in mix:
+		merged['latencies'][operation] = []
+		for result in results:
+			merged['latencies'][operation].extend(result['latencies'][operation])
+		merged['errors'][operation] = sum([result['errors'][operation] for result in results])
+		merged['locked'][operation] = sum([result['locked'][operation] for result in results])
+	db.closePool(path)
+	mailer.setMailQueue(previous)
+	mails.stop()
+	if queue is not None:
+		queue.put(merged)
+	return merged
+
+def lockMetrics(snapshot):
+	"""
+	Returns the time spent in writing statements and commits and the
+	part of it above their median durations, which is mostly waiting for
+	the write lock, in milliseconds.
+	"""
+	timings = [summary for sql, summary in snapshot['statements'].iteritems() if sql.split(' ', 1)[0].upper() in WRITES]
+	timings.append(snapshot['commits'])
+	write = sum([summary['total_ms'] for summary in timings])
+	wait = sum([max(summary['total_ms'] - summary['count'] * summary['p50_ms'], 0.0) for summary in timings])
+	return write, wait
+
+def run(path, users, threads, processes, duration, mix, poolsize=POOL_SIZE, journalmode=JOURNAL_MODE, busytimeout=BUSY_TIMEOUT):
+	"""
+	Seeds a database of 'users' users and runs the load from 'processes'
+	processes of 'threads' threads each for duration seconds. Returns the
+	report as a dictionary.
+	"""
+	configured = config.DATABASE_PATH
+	try:
+		benchmark.createDatabase(path)
+		keys = benchmark.seed(users)
+		db.closePool(path)
+		# the journal mode can only be switched without other connections
+		conn = sqlite3.connect(path)
+		conn.execute('PRAGMA journal_mode = %s' % journalmode)
+		conn.close()
+		arguments = (path, keys, mix, duration, threads, poolsize, journalmode, busytimeout)
+		if processes <= 1:
+			results = [runProcess(*(arguments + (0,)))]
+		else:
+			queue = multiprocessing.Queue()
+			children = [multiprocessing.Process(target=runProcess, args=arguments + (index, queue))
+					for index in range(processes)]
+			for child in children:
+				child.start()
+			results = [queue.get() for child in children]
+			for child in children:
+				child.join()
+	finally:
+		config.DATABASE_PATH = configured
+	report = {'settings' : {'users' : users,
+				'threads' : threads,
+				'processes' : processes,
+				'duration' : duration,
+				'mix' : dict(mix),
+				'pool_size' : poolsize,
+				'journal_mode' : journalmode,
+				'busy_timeout_ms' : busytimeout,
+				'sqlite' : sqlite3.sqlite_version},
+		'operations' : {}}
+	total = {'count' : 0, 'errors' : 0, 'locked' : 0}
+	for operation, weight in mix:
+		latencies = []
+		for result in results:
+			latencies.extend(result['latencies'][operation])
+		latencies.sort()
+		errors = sum([result['errors'][operation] for result in results])
+		locked = sum([result['locked'][operation] for result in results])
+		report['operations'][operation] = {'count' : len(latencies),
+				'ops_per_sec' : len(latencies) / float(duration),
+				'p50_ms' : benchmark.percentile(latencies, 0.50) * 1000,
+				'p95_ms' : benchmark.percentile(latencies, 0.95) * 1000,
+				'p99_ms' : benchmark.percentile(latencies, 0.99) * 1000,
+				'max_ms' : latencies and latencies[-1] * 1000 or 0.0,
+				'errors' : errors,
+				'locked' : locked}
+		total['count'] += len(latencies)
+		total['errors'] += errors
+		total['locked'] += locked
+	total['ops_per_sec'] = total['count'] / float(duration)
+	write, wait = 0.0, 0.0
+	for result in results:
+		processwrite, processwait = lockMetrics(result['statements'])
+		write += processwrite
+		wait += processwait
+	total['write_ms'] = write
+	total['lock_wait_ms'] = wait
+	report['total'] = total
+	return report
+
+def report(results):
+	print '%-14s %10s %10s %10s %10s %10s %8s %8s' % ('operation', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+			'errors', 'locked')
+	for operation in OPERATIONS:
+		if operation not in results['operations']:
+			continue
+		summary = results['operations'][operation]
+		print '%-14s %10.1f %10.3f %10.3f %10.3f %10.3f %8d %8d' % (operation, summary['ops_per_sec'],
+				summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['max_ms'],
+				summary['errors'], summary['locked'])
+	total = results['total']
+	print '%-14s %10.1f %54d %8d' % ('total', total['ops_per_sec'], total['errors'], total['locked'])
+	print 'time in writes and commits %.1f ms, about %.1f ms of it waiting for the lock' % (total['write_ms'],
+			total['lock_wait_ms'])
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='%prog [options]')
+	parser.add_option('--database', default='./loadgen.db',
+			help='database file to seed, it is overwritten')
+	parser.add_option('--users', type='int', default=10000,
+			help='number of seeded users')
+	parser.add_option('--threads', type='int', default=4,
+			help='worker threads per process')
+	parser.add_option('--processes', type='int', default=1,
+			help='worker processes')
+	parser.add_option('--duration', type='float', default=10.0,
+			help='seconds the load is run')
+	parser.add_option('--mix', default=DEFAULT_MIX,
+			help='comma separated operation:weight pairs of %s' % ', '.join(OPERATIONS))
+	parser.add_option('--pool-size', type='int', default=POOL_SIZE,
+			help='connections per process')
+	parser.add_option('--journal-mode', default=JOURNAL_MODE,
+			help='SQLite journal mode, e.g. WAL or DELETE')
+	parser.add_option('--busy-timeout', type='int', default=BUSY_TIMEOUT,
+			help='milliseconds a statement waits for a lock before failing')
+	parser.add_option('--output', help='file to write the report to as JSON')
+	options, args = parser.parse_args()
+	results = run(options.database, options.users, options.threads, options.processes, options.duration,
+			parseMix(options.mix), options.pool_size, options.journal_mode, options.busy_timeout)
+	report(results)
+	if options.output:
+		outfile = open(options.output, 'w')
+		json.dump(results, outfile, indent=2, sort_keys=True)
+		outfile.close()
@@ -0,0 +1,334 @@
+# /usr/bin/python
+
+# Outbound mail
+#
+# Activation mails are put on a queue and delivered by a background
+# worker in batches, one transport connection per batch, so registering
+# a user doesn't wait for the delivery. Failed deliveries are retried
+# with exponential backoff.
+
+import time
+import heapq
+import atexit
+import logging
+import smtplib
+import threading
+from collections import deque
+from email.mime.text import MIMEText
+import config
+from config import MAIL_BATCH_SIZE, MAIL_INTERVAL, MAIL_RETRIES, MAIL_BACKOFF
+
+log = logging.getLogger(__name__)
+
+class Message(object):
+	"""
+	A plain text mail to a single recipient.
+	"""
+
+	def __init__(self, recipient, subject, body):
+		self.recipient = recipient
+		self.subject = subject
+		self.body = body
+		self.attempts = 0
+
+def activationMessage(user):
+	"""
+	Returns the mail carrying a user's registration key.
+	"""
+	return Message(user.email, 'Activate your account',
+			'sending registration_key: %s to %s' % (user.registration_key, user.email))
+
+class ConsoleTransport(object):
+	"""
+	Prints mails instead of delivering them.
+	"""
+
+	def open(self):
+		pass
+
+	def send(self, message):
+		print message.body
+
+	def close(self):
+		pass
+
+class MemoryTransport(object):
+	"""
+	Keeps mails in a list, for testing.
+	"""
+
+	def __init__(self):
+		self.sent = []
+		self.connections = 0
+
+	def open(self):
+		self.connections += 1
+
+	def send(self, message):
+		self.sent.append(message)
+
+	def close(self):
+		pass
+
+class FileTransport(object):
+	"""
+	Appends mails to a file.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.outfile = None
+
+	def open(self):
+		self.outfile = open(self.path, 'a')
+
+	def send(self, message):
+		self.outfile.write('To: %s\nSubject: %s\n\n%s\n\n' % (message.recipient, message.subject, message.body))
+
+	def close(self):
+		self.outfile.close()
+		self.outfile = None
+
+class SMTPTransport(object):
+	"""
+	Delivers mails over SMTP, all mails of a batch over one connection.
+	"""
+
+	def __init__(self, host, port, sender, username=None, password=None, starttls=False, timeout=10):
+		self.host = host
+		self.port = port
+		self.sender = sender
+		self.username = username
+		self.password = password
+		self.starttls = starttls
+		self.timeout = timeout
+		self.connection = None
+
+	def open(self):
+		self.connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+		if self.starttls:
+			self.connection.starttls()
+		if self.username:
+			self.connection.login(self.username, self.password)
+
+	def send(self, message):
+		mail = MIMEText(message.body)
+		mail['Subject'] = message.subject
+		mail['From'] = self.sender
+		mail['To'] = message.recipient
+		self.connection.sendmail(self.sender, [message.recipient], mail.as_string())
+
+	def close(self):
+		try:
+			self.connection.quit()
+		except smtplib.SMTPException:
+			pass
+		self.connection = None
+
+class MailQueue(object):
+	"""
+	Delivers queued mails through a transport in a background thread.
+	Up to 'batchsize' mails are sent per connection. A mail that fails
+	is retried up to 'retries' times, waiting 'backoff' seconds before
+	the first retry and twice as long before every further one.
+	"""
+
+	def __init__(self, transport, batchsize=MAIL_BATCH_SIZE, interval=MAIL_INTERVAL, retries=MAIL_RETRIES, backoff=MAIL_BACKOFF):
+		self.transport = transport
+		self.batchsize = batchsize
+		self.interval = interval
+		self.retries = retries
+		self.backoff = backoff
+		self.condition = threading.Condition()
+		self.ready = deque()
+		# (due time, sequence number, message) of mails to be retried
+		self.waiting = []
+		self.sequence = 0
+		self.sending = 0
+		self.running = True
+		# counters
+		self.queued = 0
+		self.sent = 0
+		self.retried = 0
+		self.failed = 0
+		self.batches = 0
+		self.thread = threading.Thread(target=self.run, name='mailer')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def send(self, message):
+		"""
+		Queues a mail for delivery.
+		"""
+		self.condition.acquire()
+		try:
+			self.ready.append(message)
+			self.queued += 1
+			self.condition.notifyAll()
+		finally:
+			self.condition.release()
+
+	def depth(self):
+		"""
+		Returns the number of mails not yet delivered.
+		"""
+		return len(self.ready) + len(self.waiting) + self.sending
+
+	def nextBatch(self):
+		"""
+		Waits for mails to deliver and returns up to batchsize of them.
+		Must be called with the condition held.
+		"""
+		while self.running:
+			now = time.time()
+			while self.waiting and self.waiting[0][0] <= now:
+				self.ready.append(heapq.heappop(self.waiting)[2])
+			if self.ready:
+				break
+			timeout = self.interval
+			if self.waiting:
+				timeout = min(timeout, self.waiting[0][0] - now)
+			self.condition.wait(timeout)
+		batch = []
+		while self.ready and len(batch) < self.batchsize:
+			batch.append(self.ready.popleft())
+		self.sending = len(batch)
+		return batch
+
+	def run(self):
+		"""
+		The background thread's loop.
+		"""
+		while True:
+			self.condition.acquire()
+			try:
+				batch = self.nextBatch()
+			finally:
+				self.condition.release()
+			if not batch:
+				break
+			self.deliver(batch)
+
+	def deliver(self, batch):
+		"""
+		Sends a batch over one connection and schedules failed mails for retry.
+		"""
+		failures = []
+		try:
+			self.transport.open()
+		except Exception:
+			log.exception('opening the mail transport failed')
+			failures = batch
+		else:
+			for message in batch:
+				try:
+					self.transport.send(message)
+				except Exception:
+					log.exception('sending mail to %s failed', message.recipient)
+					failures.append(message)
+			try:
+				self.transport.close()
+			except Exception:
+				log.exception('closing the mail transport failed')
+		self.condition.acquire()
+		try:
+			self.batches += 1
+			self.sent += len(batch) - len(failures)
+			for message in failures:
+				message.attempts += 1
+				if message.attempts > self.retries:
+					self.failed += 1
+					log.error('giving up mail to %s after %d attempts', message.recipient, message.attempts)
+					continue
+				self.retried += 1
+				self.sequence += 1
+				due = time.time() + self.backoff * 2 ** (message.attempts - 1)
+				heapq.heappush(self.waiting, (due, self.sequence, message))
+			self.sending = 0
+			self.condition.notifyAll()
+		finally:
+			self.condition.release()
+
+	def flush(self, timeout=None):
+		"""
+		Waits until all queued mails are delivered or given up. Returns
+		False if that didn't happen within timeout seconds.
+		"""
+		deadline = None
+		if timeout is not None:
+			deadline = time.time() + timeout
+		self.condition.acquire()
+		try:
+			while self.depth():
+				remaining = None
+				if deadline is not None:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+				self.condition.wait(remaining)
+			return True
+		finally:
+			self.condition.release()
+
+	def stop(self, timeout=None):
+		"""
+		Delivers what is queued and stops the background thread.
+		"""
+		self.flush(timeout)
+		self.condition.acquire()
+		try:
+			self.running = False
+			self.condition.notifyAll()
+		finally:
+			self.condition.release()
+		self.thread.join()
+
+	def stats(self):
+		return {'depth' : self.depth(),
+			'queued' : self.queued,
+			'sent' : self.sent,
+			'retried' : self.retried,
+			'failed' : self.failed,
+			'batches' : self.batches}
+
+def createTransport():
+	"""
+	Returns the transport configured by MAIL_TRANSPORT.
+	"""
+	if config.MAIL_TRANSPORT == 'smtp':
+		return SMTPTransport(config.SMTP_HOST, config.SMTP_PORT, config.MAIL_SENDER,
+					config.SMTP_USERNAME, config.SMTP_PASSWORD, config.SMTP_STARTTLS)
+	if config.MAIL_TRANSPORT == 'file':
+		return FileTransport(config.MAIL_FILE)
+	if config.MAIL_TRANSPORT == 'memory':
+		return MemoryTransport()
+	return ConsoleTransport()
+
+queue = None
+queueLock = threading.Lock()
+
+def getMailQueue():
+	"""
+	Returns the process-wide mail queue, which is flushed at exit.
+	"""
+	global queue
+	queueLock.acquire()
+	try:
+		if queue is None:
+			queue = MailQueue(createTransport())
+			atexit.register(queue.stop, 10)
+		return queue
+	finally:
+		queueLock.release()
+
+def setMailQueue(newqueue):
+	"""
+	Replaces the process-wide mail queue, returns the previous one.
+	"""
+	global queue
+	queueLock.acquire()
+	try:
+		previous, queue = queue, newqueue
+		return previous
+	finally:
+		queueLock.release()
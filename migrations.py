@@ -0,0 +1,211 @@
+# /usr/bin/python
+
+# Versioned schema migrations
+#
+# The schema version of a database is kept in SQLite's user_version
+# pragma. Every migration brings the schema from the previous version
+# to its own and is applied within a transaction of its own, so an
+# existing database can be upgraded in place by running
+#
+#	python migrations.py [path]
+#
+# Migration 4 adds integer timestamp columns. Rows stored before keep
+# their text timestamps, which are still read, until they are converted
+# in the background by
+#
+#	python migrations.py --convert-timestamps [path]
+#
+# Migration 1 makes emails unique. If users of an existing database
+# share emails it only indexes them and logs the duplicates, so that the
+# other migrations are still applied. Once the duplicates are resolved
+#
+#	python migrations.py --unique-emails [path]
+#
+# makes the index unique, or lists the emails still shared.
+
+import time
+import logging
+import sqlite3
+from optparse import OptionParser
+import config
+from utils import *
+
+log = logging.getLogger(__name__)
+
+DUPLICATE_EMAILS = 'SELECT email, COUNT(*) FROM user GROUP BY email HAVING COUNT(*) > 1 ORDER BY email'
+EMAIL_INDEX = 'CREATE INDEX IF NOT EXISTS user_email ON user (email)'
+UNIQUE_EMAIL_INDEX = 'CREATE UNIQUE INDEX IF NOT EXISTS user_email ON user (email)'
+
+def duplicateEmails(conn):
+	"""
+	Returns the emails shared by several users as (email, count) tuples.
+	"""
+	return conn.execute(DUPLICATE_EMAILS).fetchall()
+
+def uniqueEmailIndex(conn):
+	"""
+	Creates the unique index on emails, or a plain one if users share
+	emails, which are logged to be resolved, see makeEmailsUnique().
+	"""
+	duplicates = duplicateEmails(conn)
+	if not duplicates:
+		conn.execute(UNIQUE_EMAIL_INDEX)
+		return
+	for email, count in duplicates:
+		log.warning('%d users share the email %r', count, email)
+	log.warning('emails are not unique until the duplicates are resolved and migrations.py --unique-emails is run')
+	conn.execute(EMAIL_INDEX)
+
+def makeEmailsUnique(conn):
+	"""
+	Replaces a plain index on emails by a unique one. Returns the emails
+	still shared as (email, count) tuples, in which case nothing changes.
+	"""
+	duplicates = duplicateEmails(conn)
+	if duplicates:
+		return duplicates
+	conn.execute('DROP INDEX IF EXISTS user_email')
+	conn.execute(UNIQUE_EMAIL_INDEX)
+	conn.commit()
+	return []
+
+# (version, description, statements) in ascending order of versions,
+# statements are SQL or functions called with the executor of migrate()
+MIGRATIONS = [
+	(1, 'unique index on user emails',
+		[uniqueEmailIndex]),
+	(2, 'index on user authgroups',
+		['CREATE INDEX IF NOT EXISTS user_authgroup ON user (authgroup_id)']),
+	(3, 'index on the expiration of unactivated users',
+		['CREATE INDEX IF NOT EXISTS user_activation_expiry ON user (activated, key_expires_on)']),
+	(4, 'integer timestamps in microseconds since the epoch',
+		['ALTER TABLE user ADD COLUMN key_expires_at INTEGER',
+		'ALTER TABLE user ADD COLUMN locked_until_at INTEGER',
+		'DROP INDEX IF EXISTS user_activation_expiry',
+		'CREATE INDEX IF NOT EXISTS user_activation_expiry_at ON user (activated, key_expires_at)',
+		'CREATE INDEX IF NOT EXISTS user_lockout ON user (locked, locked_until_at)']),
+	(5, 'session tokens',
+		['CREATE TABLE IF NOT EXISTS session (token TEXT PRIMARY KEY, username TEXT NOT NULL, expires_at INTEGER NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS session_username ON session (username)',
+		'CREATE INDEX IF NOT EXISTS session_expiry ON session (expires_at)']),
+	(6, 'permissions of authgroups',
+		['CREATE TABLE IF NOT EXISTS permission (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+		"""CREATE TABLE IF NOT EXISTS authgroup_permission (authgroup_id INTEGER NOT NULL REFERENCES authgroup,
+			permission_id INTEGER NOT NULL REFERENCES permission, PRIMARY KEY (authgroup_id, permission_id))"""]),
+	(7, 'unique index on registration keys',
+		['CREATE UNIQUE INDEX IF NOT EXISTS user_registration_key ON user (registration_key)']),
+	(8, 'expired flag in the index on the expiration of unactivated users',
+		['DROP INDEX IF EXISTS user_activation_expiry_at',
+		'CREATE INDEX IF NOT EXISTS user_activation_expired_expiry ON user (activated, expired, key_expires_at)']),
+]
+
+CONVERSION_SELECT = """SELECT id, key_expires_on, locked_until FROM user
+			WHERE id > ? AND (key_expires_on IS NOT NULL OR locked_until IS NOT NULL) ORDER BY id LIMIT ?"""
+CONVERSION_UPDATE = """UPDATE user SET key_expires_at = COALESCE(key_expires_at, ?), locked_until_at = COALESCE(locked_until_at, ?),
+			key_expires_on = NULL, locked_until = NULL WHERE id = ?"""
+
+def latestVersion():
+	"""
+	Returns the schema version all migrations lead to.
+	"""
+	return MIGRATIONS[-1][0]
+
+def currentVersion(conn):
+	"""
+	Returns the schema version of the database behind conn.
+	"""
+	return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn, target=None, executor=None):
+	"""
+	Applies all migrations the database is missing up to the target
+	version, by default the latest one. Statements are run by the
+	executor's execute(), by default the connection's, e.g. by a
+	db.DBManager's to have them timed. Returns the applied versions.
+	"""
+	if target is None:
+		target = latestVersion()
+	if executor is None:
+		executor = conn
+	applied = []
+	# manage the transactions explicitly, DDL would commit implicitly otherwise
+	isolation_level = conn.isolation_level
+	conn.isolation_level = None
+	try:
+		for version, description, statements in MIGRATIONS:
+			if version > target:
+				break
+			executor.execute('BEGIN IMMEDIATE')
+			try:
+				# another process may have migrated in the meantime
+				if currentVersion(executor) >= version:
+					executor.execute('ROLLBACK')
+					continue
+				for statement in statements:
+					if callable(statement):
+						statement(executor)
+					else:
+						executor.execute(statement)
+				executor.execute('PRAGMA user_version = %d' % version)
+				executor.execute('COMMIT')
+			except:
+				executor.execute('ROLLBACK')
+				raise
+			applied.append(version)
+	finally:
+		conn.isolation_level = isolation_level
+	return applied
+
+def convertTimestamps(conn, batchsize=1000, pause=0.01):
+	"""
+	Converts the text timestamps of rows stored before migration 4 into
+	integer ones. Rows are converted in batches of one short transaction
+	each, so the database stays usable meanwhile. Returns the number of
+	converted rows.
+	"""
+	converted = 0
+	lastid = 0
+	while True:
+		rows = conn.execute(CONVERSION_SELECT, (lastid, batchsize)).fetchall()
+		if not rows:
+			return converted
+		bindings = []
+		for userid, key_expires_on, locked_until in rows:
+			bindings.append((convertTimestamp(key_expires_on), convertTimestamp(locked_until), userid))
+		conn.executemany(CONVERSION_UPDATE, bindings)
+		conn.commit()
+		converted += len(rows)
+		lastid = rows[-1][0]
+		time.sleep(pause)
+
+def convertTimestamp(value):
+	if value is None:
+		return None
+	return toEpochMicros(parseTimestamp(value))
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='%prog [options] [path]')
+	parser.add_option('--convert-timestamps', action='store_true', default=False,
+			help='convert text timestamps of existing rows to integers')
+	parser.add_option('--batch-size', type='int', default=1000,
+			help='rows converted per transaction')
+	parser.add_option('--unique-emails', action='store_true', default=False,
+			help='make the index on emails unique once no users share one')
+	options, args = parser.parse_args()
+	if args:
+		path = args[0]
+	else:
+		path = config.DATABASE_PATH
+	conn = sqlite3.connect(path)
+	print 'schema version of %s is %d' % (path, currentVersion(conn))
+	for version in migrate(conn):
+		print 'applied migration %d' % version
+	if options.convert_timestamps:
+		print 'converted timestamps of %d users' % convertTimestamps(conn, options.batch_size)
+	if options.unique_emails:
+		duplicates = makeEmailsUnique(conn)
+		for email, count in duplicates:
+			print '%d users share the email %s' % (count, email)
+		if not duplicates:
+			print 'emails are unique'
+	conn.close()
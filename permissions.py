@@ -0,0 +1,160 @@
+# /usr/bin/python
+
+# Permissions of authgroups
+#
+# Permissions are granted to authgroups. Every permission owns a bit
+# and the permissions of every authgroup are compiled into an integer
+# with the bits of its permissions set, so checking any number of
+# permissions of a user takes a few bit operations and no query.
+
+import threading
+import db
+from utils import *
+
+PERMISSION_INSERT = 'INSERT INTO permission VALUES(null, ?)'
+PERMISSION_GET_ALL = 'SELECT id, name FROM permission'
+GRANT_INSERT = 'INSERT OR IGNORE INTO authgroup_permission VALUES(?, ?)'
+GRANT_DELETE = 'DELETE FROM authgroup_permission WHERE authgroup_id = ? AND permission_id = ?'
+GRANT_GET_ALL = """SELECT authgroup.name, authgroup_permission.permission_id FROM authgroup_permission
+			JOIN authgroup ON authgroup.id = authgroup_permission.authgroup_id"""
+
+class PermissionRegistry(object):
+	"""
+	Holds the permission bits and the compiled bitsets of all authgroups
+	of one database. Grants and revocations through the registry update
+	the bitsets in place, refresh() recompiles them from the database.
+	"""
+
+	def __init__(self, path=None):
+		self.manager = db.getManager(path)
+		self.lock = threading.Lock()
+		self.compiled = False
+		# permission name -> id, the id being the permission's bit
+		self.bits = {}
+		# authgroup name -> bitset
+		self.groups = {}
+
+	def refresh(self):
+		"""
+		Compiles the bitsets of all authgroups from the database.
+		"""
+		bits = dict((name, permissionid) for permissionid, name in self.manager.fetchall(PERMISSION_GET_ALL))
+		groups = {}
+		for name, permissionid in self.manager.fetchall(GRANT_GET_ALL):
+			groups[name] = groups.get(name, 0) | (1 << permissionid)
+		self.lock.acquire()
+		try:
+			self.bits, self.groups = bits, groups
+			self.compiled = True
+		finally:
+			self.lock.release()
+
+	def ensureCompiled(self):
+		if not self.compiled:
+			self.refresh()
+
+	def permissionId(self, name):
+		self.ensureCompiled()
+		if name not in self.bits:
+			# the permission may have been created by another process
+			self.refresh()
+			if name not in self.bits:
+				raise PermissionDoesNotExistException(name)
+		return self.bits[name]
+
+	def createPermission(self, name):
+		"""
+		Creates a new permission.
+		"""
+		self.ensureCompiled()
+		permissionid = self.manager.execute(PERMISSION_INSERT, (name,)).lastrowid
+		self.manager.commit()
+		self.lock.acquire()
+		try:
+			self.bits[name] = permissionid
+		finally:
+			self.lock.release()
+
+	def grant(self, group, permission):
+		"""
+		Grants a permission to an authgroup.
+		"""
+		permissionid = self.permissionId(permission)
+		self.manager.execute(GRANT_INSERT, (self.manager.getAuthGroupId(group), permissionid))
+		self.manager.commit()
+		self.lock.acquire()
+		try:
+			self.groups[group] = self.groups.get(group, 0) | (1 << permissionid)
+		finally:
+			self.lock.release()
+
+	def revoke(self, group, permission):
+		"""
+		Revokes a permission from an authgroup.
+		"""
+		permissionid = self.permissionId(permission)
+		self.manager.execute(GRANT_DELETE, (self.manager.getAuthGroupId(group), permissionid))
+		self.manager.commit()
+		self.lock.acquire()
+		try:
+			self.groups[group] = self.groups.get(group, 0) & ~(1 << permissionid)
+		finally:
+			self.lock.release()
+
+	def mask(self, permissions):
+		"""
+		Returns the bitset of the given permissions. Unknown permissions
+		get a bit no authgroup has.
+		"""
+		self.ensureCompiled()
+		mask = 0
+		for name in permissions:
+			permissionid = self.bits.get(name)
+			if permissionid is None:
+				# a bit beyond all existing permissions
+				permissionid = max([0] + self.bits.values()) + 1
+			mask |= 1 << permissionid
+		return mask
+
+	def groupBits(self, group):
+		"""
+		Returns the bitset of an authgroup.
+		"""
+		self.ensureCompiled()
+		return self.groups.get(group, 0)
+
+	def hasPermission(self, group, permission):
+		"""
+		Returns True if the authgroup has been granted the permission.
+		"""
+		self.ensureCompiled()
+		permissionid = self.bits.get(permission)
+		if permissionid is None:
+			return False
+		return bool(self.groups.get(group, 0) & (1 << permissionid))
+
+	def hasAll(self, group, permissions):
+		"""
+		Returns True if the authgroup has been granted all the permissions.
+		"""
+		mask = self.mask(permissions)
+		return self.groupBits(group) & mask == mask
+
+def getRegistry(path=None):
+	"""
+	Returns the process-wide permission registry of the given database file.
+	"""
+	return db.sharedState(path, 'permissions', PermissionRegistry)
+
+def checkPermissions(user, permissions):
+	"""
+	Returns a dictionary telling for every given permission whether the
+	user has been granted it.
+	"""
+	registry = getRegistry()
+	bits = registry.groupBits(user.authgroup)
+	result = {}
+	for name in permissions:
+		permissionid = registry.bits.get(name)
+		result[name] = permissionid is not None and bool(bits & (1 << permissionid))
+	return result
@@ -0,0 +1,230 @@
+# /usr/bin/python
+
+# Non-blocking facade for registration, activation and login
+#
+# Python 2 has no asyncio, so instead of coroutines every operation
+# returns a Future. Event loops integrate by registering a done callback
+# that hands the result back to the loop, e.g. Twisted's
+# reactor.callFromThread or Tornado's IOLoop.add_callback.
+
+import threading
+import Queue
+from config import SERVICE_WORKERS, SERVICE_QUEUE_SIZE
+from utils import *
+import db
+import user
+
+class Future(object):
+	"""
+	The eventual result of an operation run by an AsyncUserService.
+	"""
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.state = 'pending'
+		self.value = None
+		self.error = None
+		self.callbacks = []
+
+	def cancel(self):
+		"""
+		Cancels the operation unless it has started already.
+		Returns True if it has been cancelled.
+		"""
+		self.condition.acquire()
+		try:
+			if self.state != 'pending':
+				return self.state == 'cancelled'
+			self.state = 'cancelled'
+			self.condition.notifyAll()
+		finally:
+			self.condition.release()
+		self.runCallbacks()
+		return True
+
+	def cancelled(self):
+		return self.state == 'cancelled'
+
+	def done(self):
+		return self.state in ('finished', 'cancelled')
+
+	def start(self):
+		"""
+		Marks the operation as running. Returns False if it has been cancelled.
+		"""
+		self.condition.acquire()
+		try:
+			if self.state != 'pending':
+				return False
+			self.state = 'running'
+			return True
+		finally:
+			self.condition.release()
+
+	def finish(self, value=None, error=None):
+		self.condition.acquire()
+		try:
+			self.value = value
+			self.error = error
+			self.state = 'finished'
+			self.condition.notifyAll()
+		finally:
+			self.condition.release()
+		self.runCallbacks()
+
+	def runCallbacks(self):
+		self.condition.acquire()
+		try:
+			callbacks, self.callbacks = self.callbacks, []
+		finally:
+			self.condition.release()
+		for callback in callbacks:
+			callback(self)
+
+	def addDoneCallback(self, callback):
+		"""
+		Calls callback(future) once the operation is done or cancelled,
+		right away if it is already. The callback runs on the worker
+		thread, not the caller's.
+		"""
+		self.condition.acquire()
+		try:
+			if not self.done():
+				self.callbacks.append(callback)
+				return
+		finally:
+			self.condition.release()
+		callback(self)
+
+	def result(self, timeout=None):
+		"""
+		Waits for the operation and returns its result or raises its exception.
+		"""
+		self.condition.acquire()
+		try:
+			if not self.done():
+				self.condition.wait(timeout)
+			if self.state == 'cancelled':
+				raise CancelledException()
+			if not self.done():
+				raise ServiceTimeoutException()
+		finally:
+			self.condition.release()
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+class AsyncUserService(object):
+	"""
+	Runs user operations on a bounded set of worker threads so that the
+	caller isn't blocked by database I/O or password hashing. Every worker
+	uses a pooled connection of its own. At most 'queuesize' operations
+	wait for a worker; submitting more blocks for up to 'timeout' seconds
+	and then raises a ServiceBusyException so callers feel backpressure.
+	Users are stored in the configured database, like User does. Workers
+	hold their connection for their whole life, so there must be fewer
+	of them than connections in the pool, leaving one to other threads.
+	"""
+
+	def __init__(self, workers=SERVICE_WORKERS, queuesize=SERVICE_QUEUE_SIZE, timeout=0):
+		poolsize = db.getPool().size
+		if workers >= poolsize:
+			raise ValueError('%d workers need more than %d pooled connections' % (workers, poolsize))
+		self.manager = db.getManager()
+		self.timeout = timeout
+		self.queue = Queue.Queue(queuesize)
+		self.threads = []
+		for i in range(workers):
+			thread = threading.Thread(target=self.work, name='user-service-%d' % i)
+			thread.setDaemon(True)
+			thread.start()
+			self.threads.append(thread)
+
+	def work(self):
+		"""
+		A worker thread's loop.
+		"""
+		while True:
+			job = self.queue.get()
+			if job is None:
+				break
+			future, function, args = job
+			if not future.start():
+				continue
+			try:
+				future.finish(value=function(*args))
+			except Exception, e:
+				future.finish(error=e)
+		# hand the worker's connection back
+		self.manager.release()
+
+	def submit(self, function, *args):
+		"""
+		Runs function(*args) on a worker and returns a Future of its result.
+		"""
+		future = Future()
+		try:
+			self.queue.put((future, function, args), self.timeout > 0, self.timeout or None)
+		except Queue.Full:
+			raise ServiceBusyException()
+		return future
+
+	def pending(self):
+		"""
+		Returns the number of operations waiting for a worker.
+		"""
+		return self.queue.qsize()
+
+	def shutdown(self):
+		"""
+		Stops the workers after the queued operations.
+		"""
+		for thread in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+
+	def register(self, username, password, email, authgroup):
+		"""
+		Creates and saves a new user. The future's result is the user.
+		"""
+		return self.submit(self.doRegister, username, password, email, authgroup)
+
+	def doRegister(self, username, password, email, authgroup):
+		userobj = user.User(username=username, password=password, email=email, authgroup=authgroup)
+		userobj.save()
+		return userobj
+
+	def activate(self, username, key):
+		"""
+		Activates a user. The future's result is True on success.
+		"""
+		return self.submit(self.doActivate, username, key)
+
+	def doActivate(self, username, key):
+		return self.manager.getUser(username).activate(key)
+
+	def login(self, email, password):
+		"""
+		Logs a user in by email and password. The future's result is
+		the session token, see User.login(), or False.
+		"""
+		return self.submit(self.doLogin, email, password)
+
+	def doLogin(self, email, password):
+		return self.manager.getUserByEmail(email).login(email, password)
+
+	def logout(self, username):
+		"""
+		Logs a user out.
+		"""
+		return self.submit(self.doLogout, username)
+
+	def doLogout(self, username):
+		self.manager.getUser(username).logout()
+
+	def getUser(self, username):
+		"""
+		Retrieves a user by it's name.
+		"""
+		return self.submit(self.manager.getUser, username)
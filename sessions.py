@@ -0,0 +1,240 @@
+# /usr/bin/python
+
+# Session tokens
+#
+# A successful login issues an opaque token. Tokens are kept in memory
+# for O(1) validation and persisted in the session table so that other
+# processes and restarts see them too. Authorizing a request therefore
+# doesn't need to read the user at all. A token is read again once it
+# has been trusted from memory for a few seconds, so a session revoked
+# by another process ends there shortly after. With a write-behind
+# queue new sessions are written with its batches, revocations are
+# always written right away. Sessions are stored in the database of
+# their user, if users are sharded the token names its shard.
+
+import os
+import time
+import binascii
+import threading
+import datetime
+import logging
+import db
+from config import SESSION_TTL, SESSION_PRUNE_INTERVAL, SESSION_RECHECK_INTERVAL
+from utils import *
+
+log = logging.getLogger(__name__)
+
+SESSION_INSERT = 'INSERT INTO session (token, username, expires_at) VALUES(?, ?, ?)'
+SESSION_GET = 'SELECT username, expires_at FROM session WHERE token = ?'
+SESSION_DELETE = 'DELETE FROM session WHERE token = ?'
+SESSION_DELETE_USER = 'DELETE FROM session WHERE username = ?'
+SESSION_DELETE_EXPIRED = 'DELETE FROM session WHERE expires_at < ?'
+
+class SessionStore(object):
+	"""
+	Issues, validates and revokes the session tokens of one database.
+	Tokens are trusted from memory for 'recheck' seconds after they have
+	last been read from the database.
+	"""
+
+	def __init__(self, path=None, ttl=SESSION_TTL, recheck=SESSION_RECHECK_INTERVAL):
+		self.manager = db.getManager(path)
+		self.ttl = ttl
+		self.recheck = recheck
+		self.lock = threading.Lock()
+		# token -> (username, expiration in microseconds since the epoch, time last read)
+		self.tokens = {}
+		# username -> set of tokens
+		self.byUser = {}
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def remember(self, token, username, expires):
+		self.lock.acquire()
+		try:
+			self.tokens[token] = (username, expires, time.time())
+			self.byUser.setdefault(username, set()).add(token)
+		finally:
+			self.lock.release()
+
+	def forget(self, token):
+		self.lock.acquire()
+		try:
+			username, expires, checked = self.tokens.pop(token, (None, None, None))
+			if username is not None:
+				tokens = self.byUser.get(username)
+				tokens.discard(token)
+				if not tokens:
+					del self.byUser[username]
+		finally:
+			self.lock.release()
+
+	def storageOf(self, username):
+		"""
+		Returns the manager holding the sessions of a user.
+		"""
+		return self.manager.sessionStorages()[self.manager.sessionShard(username)]
+
+	def storageOfToken(self, token):
+		"""
+		Returns the manager holding the session of a token, None if the
+		token can't be one.
+		"""
+		storages = self.manager.sessionStorages()
+		if len(storages) == 1:
+			return storages[0]
+		index, sep, rest = token.partition('.')
+		if not index.isdigit() or int(index) >= len(storages):
+			return None
+		return storages[int(index)]
+
+	def issue(self, username):
+		"""
+		Creates a new session for the user and returns its token. The
+		session is left to the write-behind queue if there is one.
+		"""
+		token = binascii.hexlify(os.urandom(20))
+		if len(self.manager.sessionStorages()) > 1:
+			token = '%d.%s' % (self.manager.sessionShard(username), token)
+		expires = toEpochMicros(datetime.datetime.now() + self.ttl)
+		self.remember(token, username, expires)
+		storage = self.storageOf(username)
+		queue = storage.writeBehindQueue()
+		if queue is not None:
+			queue.enqueueStatement(SESSION_INSERT, (token, username, expires))
+		else:
+			storage.execute(SESSION_INSERT, (token, username, expires))
+			storage.commit()
+		return token
+
+	def flushQueued(self, storage):
+		"""
+		Writes sessions still waiting in the write-behind queue of the
+		storage. Returns True if anything has been written.
+		"""
+		queue = storage.writeBehindQueue()
+		return queue is not None and queue.flush() > 0
+
+	def discardQueued(self, storage, match):
+		"""
+		Drops the sessions waiting in the write-behind queue of the
+		storage for which match(sql, bindings) is true.
+		"""
+		queue = storage.writeBehindQueue()
+		if queue is not None:
+			queue.discardStatements(lambda sql, bindings: sql == SESSION_INSERT and match(sql, bindings))
+
+	def validate(self, token):
+		"""
+		Returns the username of a valid session token, None otherwise.
+		Tokens unknown to this process, or not read for 'recheck'
+		seconds, are looked up in the database.
+		"""
+		now = toEpochMicros(datetime.datetime.now())
+		session = self.tokens.get(token)
+		if session is None or time.time() - session[2] >= self.recheck:
+			storage = self.storageOfToken(token)
+			if storage is None:
+				return None
+			row = storage.fetchone(SESSION_GET, (token,))
+			if row is None and session is not None and self.flushQueued(storage):
+				# the session may not have been written yet
+				row = storage.fetchone(SESSION_GET, (token,))
+			if row is None:
+				# revoked by another process
+				if session is not None:
+					self.forget(token)
+				return None
+			session = (row[0], row[1], None)
+			self.remember(token, row[0], row[1])
+		username, expires, checked = session
+		if expires < now:
+			self.forget(token)
+			return None
+		return username
+
+	def revoke(self, token):
+		"""
+		Ends a single session.
+		"""
+		self.forget(token)
+		storage = self.storageOfToken(token)
+		if storage is None:
+			return
+		# the session mustn't be inserted after it has been deleted
+		self.discardQueued(storage, lambda sql, bindings: bindings[0] == token)
+		storage.execute(SESSION_DELETE, (token,))
+		storage.commit()
+
+	def revokeAll(self, username):
+		"""
+		Ends all sessions of a user.
+		"""
+		self.lock.acquire()
+		try:
+			for token in self.byUser.pop(username, ()):
+				self.tokens.pop(token, None)
+		finally:
+			self.lock.release()
+		storage = self.storageOf(username)
+		self.discardQueued(storage, lambda sql, bindings: bindings[1] == username)
+		storage.execute(SESSION_DELETE_USER, (username,))
+		storage.commit()
+
+	def sessions(self, username):
+		"""
+		Returns the tokens of a user known to this process.
+		"""
+		return set(self.byUser.get(username, ()))
+
+	def prune(self):
+		"""
+		Removes all expired sessions. Returns the number removed from the
+		databases.
+		"""
+		now = toEpochMicros(datetime.datetime.now())
+		self.lock.acquire()
+		try:
+			expired = [token for token, (username, expires, checked) in self.tokens.iteritems() if expires < now]
+		finally:
+			self.lock.release()
+		for token in expired:
+			self.forget(token)
+		pruned = 0
+		for storage in self.manager.sessionStorages():
+			pruned += storage.execute(SESSION_DELETE_EXPIRED, (now,)).rowcount
+			storage.commit()
+		return pruned
+
+	def run(self, interval):
+		"""
+		The pruner thread's loop.
+		"""
+		while not self.stopped.isSet():
+			self.stopped.wait(interval)
+			try:
+				self.prune()
+			except Exception:
+				log.exception('pruning sessions failed')
+		self.manager.release()
+
+	def startPruner(self, interval=SESSION_PRUNE_INTERVAL):
+		"""
+		Prunes expired sessions every 'interval' seconds in the background.
+		"""
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.run, args=(interval,), name='session-pruner')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def stopPruner(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+def getSessionStore(path=None):
+	"""
+	Returns the process-wide session store of the given database file.
+	"""
+	return db.sharedState(path, 'sessions', SessionStore)
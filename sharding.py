@@ -0,0 +1,464 @@
+# /usr/bin/python
+
+# Users spread across several SQLite files
+#
+# Every SQLite file has a single writer, so all logins, logouts and
+# activations of one database are serialised. ShardedBackend hashes
+# usernames onto several files, the shards, which are written to
+# independently. Sessions are held by the shard of their user, too.
+# A catalog database holds the authgroups and permissions, and a
+# directory of the users' emails that keeps them unique across shards
+# and routes lookups by email to the right shard.
+# The authgroups are replicated into every shard, keeping their ids, so
+# that users are still joined with their group locally.
+# It is installed as the process-wide manager by
+#
+#	sharding.install(['users0.db', 'users1.db'])
+#
+# before the backend is used. Users of an existing database, or of
+# differently sharded ones, are copied onto new shards by
+#
+#	python sharding.py [options] shard...
+
+import hashlib
+import sqlite3
+import threading
+from optparse import OptionParser
+import config
+from config import BULK_CHUNK_SIZE
+import db
+from backend import StorageBackend
+from utils import *
+
+# the catalog's directory of the emails of all users
+DIRECTORY_TABLE_CREATION = 'CREATE TABLE IF NOT EXISTS email_directory (email TEXT PRIMARY KEY, username TEXT NOT NULL)'
+DIRECTORY_INDEX_CREATION = 'CREATE INDEX IF NOT EXISTS email_directory_username ON email_directory (username)'
+DIRECTORY_INSERT = 'INSERT INTO email_directory VALUES(?, ?)'
+DIRECTORY_INSERT_OR_IGNORE = 'INSERT OR IGNORE INTO email_directory VALUES(?, ?)'
+DIRECTORY_TAKEN = 'SELECT email FROM email_directory WHERE email IN (%s)'
+DIRECTORY_GET = 'SELECT username FROM email_directory WHERE email = ?'
+DIRECTORY_DELETE = 'DELETE FROM email_directory WHERE email = ? AND username = ?'
+DIRECTORY_DELETE_USERS = 'DELETE FROM email_directory WHERE username IN (%s)'
+
+# user fields copied by reshard(), in the order of db.USER_INSERT's columns
+RESHARD_FIELDS = ['username', 'email', 'password', 'authgroup', 'registration_key', 'key_expiration',
+			'activated', 'expired', 'logged_in', 'failed_logins', 'locked', 'locked_until']
+
+def shardIndex(username, count):
+	"""
+	Returns the index of the shard out of count that holds a username.
+	"""
+	if isinstance(username, unicode):
+		username = username.encode('utf-8')
+	return int(hashlib.md5(username).hexdigest()[:8], 16) % count
+
+class ShardedBackend(StorageBackend):
+	"""
+	Spreads users across the SQLite files of the given paths by the hash
+	of their username. Operations on a single user are run by the
+	DBManager of its shard, lookups by email are routed to it by the
+	catalog's email directory, sweeps are run on all shards and
+	iteration goes through one shard after the other. Usernames and
+	emails are unique across all shards. Everything else lives in the
+	catalog database, by default the configured one.
+	"""
+
+	def __init__(self, paths, catalog=None):
+		if catalog is None:
+			catalog = config.DATABASE_PATH
+		self.paths = list(paths)
+		self.catalog = db.DBManager(catalog)
+		self.shards = [db.DBManager(path) for path in self.paths]
+
+	def shardFor(self, username):
+		"""
+		Returns the manager of the shard holding a username.
+		"""
+		return self.shards[shardIndex(username, len(self.shards))]
+
+	def scatter(self, function):
+		"""
+		Runs function(shard) for every shard on a thread of its own and
+		returns the results in the order of the shards.
+		"""
+		results = [None] * len(self.shards)
+		errors = []
+		def run(index, shard):
+			try:
+				results[index] = function(shard)
+			except Exception, e:
+				errors.append(e)
+			shard.release()
+		threads = [threading.Thread(target=run, args=(index, shard)) for index, shard in enumerate(self.shards)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		if errors:
+			raise errors[0]
+		return results
+
+	def execute(self, sql, bindings=()):
+		return self.catalog.execute(sql, bindings)
+
+	def executemany(self, sql, bindings):
+		return self.catalog.executemany(sql, bindings)
+
+	def fetchone(self, sql, bindings=()):
+		return self.catalog.fetchone(sql, bindings)
+
+	def fetchall(self, sql, bindings=()):
+		return self.catalog.fetchall(sql, bindings)
+
+	def commit(self):
+		self.catalog.commit()
+
+	def rollback(self):
+		self.catalog.rollback()
+
+	def release(self):
+		self.catalog.release()
+		for shard in self.shards:
+			shard.release()
+
+	def createTables(self):
+		"""
+		Creates the tables of the catalog and of all shards, unless
+		they exist already, e.g. because the catalog is an existing database.
+		"""
+		for manager in [self.catalog] + self.shards:
+			if manager.fetchone(db.TABLE_EXISTS, ('user',)):
+				manager.migrate()
+			else:
+				manager.createTables()
+		self.createDirectory()
+		self.replicateGroups()
+
+	def migrate(self):
+		"""
+		Applies pending schema migrations to the catalog and all shards.
+		Returns the versions applied to the catalog.
+		"""
+		for shard in self.shards:
+			shard.migrate()
+		applied = self.catalog.migrate()
+		self.createDirectory()
+		return applied
+
+	def createDirectory(self):
+		"""
+		Creates the email directory of the catalog unless it exists and
+		enters the users already on the shards.
+		"""
+		if self.catalog.fetchone(db.TABLE_EXISTS, ('email_directory',)):
+			return
+		self.catalog.execute(DIRECTORY_TABLE_CREATION)
+		self.catalog.execute(DIRECTORY_INDEX_CREATION)
+		for shard in self.shards:
+			records = shard.iterUsers(columns=['email', 'username'])
+			self.catalog.executemany(DIRECTORY_INSERT_OR_IGNORE, [(record.email, record.username) for record in records])
+			shard.release()
+		self.catalog.commit()
+
+	def usernameOf(self, email):
+		"""
+		Returns the username of the user with the given email or None.
+		"""
+		row = self.catalog.fetchone(DIRECTORY_GET, (email,))
+		if row is None:
+			return None
+		return row[0]
+
+	def claimEmails(self, users, chunksize=BULK_CHUNK_SIZE):
+		"""
+		Enters the emails of new users into the directory within one
+		transaction. Returns the users whose email has been entered and
+		the conflicts of the others as (username, reason) tuples.
+		"""
+		claimed = []
+		conflicts = []
+		emails = set()
+		usernames = set()
+		self.catalog.execute('BEGIN IMMEDIATE')
+		try:
+			for start in range(0, len(users), chunksize):
+				chunk = users[start:start + chunksize]
+				placeholders = ', '.join(['?'] * len(chunk))
+				taken = set(row[0] for row in self.catalog.fetchall(DIRECTORY_TAKEN % placeholders,
+												[user.email for user in chunk]))
+				rows = []
+				for user in chunk:
+					if user.username in usernames:
+						conflicts.append((user.username, 'duplicate'))
+					elif user.email in taken or user.email in emails:
+						conflicts.append((user.username, 'constraint'))
+					else:
+						usernames.add(user.username)
+						emails.add(user.email)
+						claimed.append(user)
+						rows.append((user.email, user.username))
+				self.catalog.executemany(DIRECTORY_INSERT, rows)
+			self.catalog.commit()
+		except:
+			self.catalog.rollback()
+			raise
+		return claimed, conflicts
+
+	def releaseEmails(self, users):
+		"""
+		Removes the emails of users that haven't been inserted after all
+		from the directory.
+		"""
+		if not users:
+			return
+		self.catalog.executemany(DIRECTORY_DELETE, [(user.email, user.username) for user in users])
+		self.catalog.commit()
+
+	def replicateGroups(self):
+		"""
+		Copies the authgroups of the catalog into every shard.
+		"""
+		rows = self.catalog.fetchall(db.GROUP_GET_ALL)
+		for shard in self.shards:
+			shard.executemany(db.GROUP_INSERT_WITH_ID, rows)
+			shard.commit()
+			shard.groups.invalidate()
+
+	def insertGroup(self, name):
+		self.catalog.insertGroup(name)
+		self.replicateGroups()
+
+	def authGroups(self, reload=False):
+		return self.catalog.authGroups(reload)
+
+	def getAuthGroupId(self, name):
+		return self.catalog.getAuthGroupId(name)
+
+	def getAuthGroupName(self, groupid):
+		return self.catalog.getAuthGroupName(groupid)
+
+	def insertUser(self, user):
+		"""
+		Inserts the user into his shard and then enters his email into
+		the directory. If the email is taken by a user of another shard
+		he is removed from his shard again and an EmailExistsException
+		is raised. A failing insert thus never leaves a claimed email behind.
+		"""
+		shard = self.shardFor(user.username)
+		shard.insertUser(user)
+		try:
+			self.catalog.execute(DIRECTORY_INSERT, (user.email, user.username))
+			self.catalog.commit()
+		except sqlite3.IntegrityError:
+			self.catalog.rollback()
+			shard.deleteUser(user.username)
+			raise EmailExistsException(user.email)
+		except:
+			self.catalog.rollback()
+			shard.deleteUser(user.username)
+			raise
+
+	def insertUsers(self, users, chunksize=BULK_CHUNK_SIZE, inserted=None):
+		"""
+		Enters the emails of many users into the directory and inserts
+		the users within one transaction per shard, see
+		DBManager.insertUsers(). The conflicts of the directory are
+		returned first, then those of the shards shard by shard.
+		"""
+		if inserted is None:
+			inserted = []
+		start = len(inserted)
+		claimed, conflicts = self.claimEmails(list(users), chunksize)
+		parts = [[] for shard in self.shards]
+		for user in claimed:
+			parts[shardIndex(user.username, len(self.shards))].append(user)
+		try:
+			for shard, part in zip(self.shards, parts):
+				if part:
+					conflicts.extend(shard.insertUsers(part, chunksize, inserted))
+		finally:
+			# the emails of users rejected by their shard are free again
+			saved = set([id(user) for user in inserted[start:]])
+			self.releaseEmails([user for user in claimed if id(user) not in saved])
+		return conflicts
+
+	def activateByKey(self, key, now=None):
+		"""
+		Activates the user holding a registration key on the shard
+		holding it, see DBManager.activateByKey(). The shard is found by
+		reading the unique index of the keys, only that one is written.
+		"""
+		for shard in self.shards:
+			if shard.fetchone(db.KEY_EXISTS, (key,)) is not None:
+				return shard.activateByKey(key, now)
+		return db.KEY_INVALID, None
+
+	def authenticate(self, email, password, now=None):
+		"""
+		Checks a login attempt on the shard of the user with the email, see
+		DBManager.authenticate().
+		"""
+		username = self.usernameOf(email)
+		if username is None:
+			return db.AUTH_INVALID, None
+		return self.shardFor(username).authenticate(email, password, now)
+
+	def recordFailedLogin(self, username, now=None):
+		return self.shardFor(username).recordFailedLogin(username, now)
+
+	def userExists(self, username):
+		return self.shardFor(username).userExists(username)
+
+	def getUser(self, username):
+		return self.shardFor(username).getUser(username)
+
+	def getUserByEmail(self, email):
+		"""
+		Retrieve a user by it's email from the shard the directory names.
+		"""
+		username = self.usernameOf(email)
+		if username is None:
+			raise UserDoesNotExistException(email)
+		return self.shardFor(username).getUserByEmail(email)
+
+	def getLockout(self, username):
+		return self.shardFor(username).getLockout(username)
+
+	def updateUser(self, userobj, immediate=False):
+		return self.shardFor(userobj.username).updateUser(userobj, immediate)
+
+	def deleteUser(self, username):
+		"""
+		Removes a user from his shard and his email from the directory.
+		"""
+		deleted = self.shardFor(username).deleteUser(username)
+		self.catalog.execute(DIRECTORY_DELETE_USERS % '?', (username,))
+		self.catalog.commit()
+		return deleted
+
+	def sessionStorages(self):
+		return self.shards
+
+	def sessionShard(self, username):
+		return shardIndex(username, len(self.shards))
+
+	def writeBehindQueue(self):
+		return self.catalog.writeBehindQueue()
+
+	def expireUsers(self, now=None, purge=False, **options):
+		"""
+		Expires, or purges, overdue users of all shards at the same time,
+		see DBManager.expireUsers(). The emails of purged users are removed
+		from the directory. Returns the number of users swept.
+		"""
+		swept = []
+		total = sum(self.scatter(lambda shard: shard.expireUsers(now, purge, swept=swept, **options)))
+		if purge and swept:
+			for start in range(0, len(swept), BULK_CHUNK_SIZE):
+				chunk = swept[start:start + BULK_CHUNK_SIZE]
+				self.catalog.execute(DIRECTORY_DELETE_USERS % ', '.join(['?'] * len(chunk)), chunk)
+			self.catalog.commit()
+		return total
+
+	def iterUsers(self, filter=None, columns=None, **options):
+		"""
+		Iterates over the users of one shard after the other, see
+		DBManager.iterUsers(). Ids are only unique per shard.
+		"""
+		for shard in self.shards:
+			for record in shard.iterUsers(filter, columns, **options):
+				yield record
+
+	def close(self):
+		"""
+		Closes the connections to the catalog and all shards.
+		"""
+		for path in self.paths + [self.catalog.path]:
+			db.closePool(path)
+
+def install(paths, catalog=None):
+	"""
+	Installs a ShardedBackend of the given shards as the process-wide
+	manager of its catalog database and returns it.
+	"""
+	backend = ShardedBackend(paths, catalog)
+	db.setManager(backend, backend.catalog.path)
+	return backend
+
+def reshard(source, paths, catalog=None, batchsize=BULK_CHUNK_SIZE, progress=None):
+	"""
+	Copies all users of the source backend onto new shards of the given
+	paths, creating them if necessary. The catalog defaults to the one
+	of the source, otherwise the source's authgroups are copied into
+	the given one. Users already present on the shards are left alone so
+	an interrupted run can simply be repeated. The source is not changed.
+	Calls progress(copied) after every batch and returns the sharded
+	backend of the new shards.
+	"""
+	if isinstance(source, ShardedBackend):
+		sourcecatalog = source.catalog
+	else:
+		sourcecatalog = source
+	if catalog is None:
+		catalog = sourcecatalog.path
+	target = ShardedBackend(paths, catalog)
+	target.createTables()
+	if catalog != sourcecatalog.path:
+		target.catalog.executemany(db.GROUP_INSERT_WITH_ID, sourcecatalog.fetchall(db.GROUP_GET_ALL))
+		target.catalog.commit()
+		target.replicateGroups()
+	batches = [[] for shard in target.shards]
+	copied = 0
+	for record in source.iterUsers(columns=RESHARD_FIELDS):
+		index = shardIndex(record.username, len(target.shards))
+		values = list(record)
+		values[3] = target.getAuthGroupId(record.authgroup)
+		batches[index].append(map(target.catalog.toColumn, values))
+		if len(batches[index]) >= batchsize:
+			copied += writeBatch(target, target.shards[index], batches[index])
+			batches[index] = []
+			if progress is not None:
+				progress(copied)
+	for shard, batch in zip(target.shards, batches):
+		if batch:
+			copied += writeBatch(target, shard, batch)
+	if progress is not None:
+		progress(copied)
+	return target
+
+def writeBatch(target, shard, rows):
+	"""
+	Inserts rows of user bindings into a shard of the target backend
+	and their emails into its directory, skipping users already there.
+	Returns the number of users inserted.
+	"""
+	target.catalog.executemany(DIRECTORY_INSERT_OR_IGNORE, [(row[1], row[0]) for row in rows])
+	target.catalog.commit()
+	cursor = shard.executemany(db.USER_INSERT_OR_IGNORE, rows)
+	shard.commit()
+	shard.noteUsernames([row[0] for row in rows])
+	return max(cursor.rowcount, 0)
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='%prog [options] shard...')
+	parser.add_option('--source', action='append', default=[],
+			help='a database, or shard, to copy users from, may be given repeatedly')
+	parser.add_option('--source-catalog', default=None,
+			help='the catalog of sharded sources')
+	parser.add_option('--catalog', default=None,
+			help='the catalog of the new shards, by default the source\'s')
+	parser.add_option('--batch-size', type='int', default=BULK_CHUNK_SIZE,
+			help='users inserted per transaction')
+	options, args = parser.parse_args()
+	if not args:
+		parser.error('no shards given')
+	sources = options.source or [config.DATABASE_PATH]
+	if len(sources) == 1 and options.source_catalog is None:
+		source = db.DBManager(sources[0])
+	else:
+		source = ShardedBackend(sources, options.source_catalog)
+	def report(copied):
+		print 'copied %d users' % copied
+	target = reshard(source, args, options.catalog, options.batch_size, report)
+	for path, shard in zip(target.paths, target.shards):
+		print '%s holds %d users' % (path, shard.fetchone('SELECT COUNT(*) FROM user')[0])
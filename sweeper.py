@@ -0,0 +1,78 @@
+# /usr/bin/python
+
+# Periodic expiration of unactivated users
+
+import threading
+import time
+import logging
+import db
+from config import SWEEP_INTERVAL, SWEEP_PURGE
+
+log = logging.getLogger(__name__)
+
+class Sweeper(object):
+	"""
+	Expires, or purges, unactivated users whose registration key ran out
+	every 'interval' seconds in a background thread, see DBManager.expireUsers().
+	"""
+
+	def __init__(self, interval=SWEEP_INTERVAL, purge=SWEEP_PURGE, path=None):
+		self.manager = db.getManager(path)
+		self.interval = interval
+		self.purge = purge
+		self.stopped = threading.Event()
+		self.thread = None
+		# counters
+		self.runs = 0
+		self.swept = 0
+		self.lastSwept = 0
+		self.lastRun = None
+
+	def sweep(self):
+		"""
+		Runs one sweep right away. Returns the number of users swept.
+		"""
+		swept = self.manager.expireUsers(purge=self.purge)
+		self.runs += 1
+		self.swept += swept
+		self.lastSwept = swept
+		self.lastRun = time.time()
+		return swept
+
+	def run(self):
+		"""
+		The background thread's loop.
+		"""
+		while True:
+			try:
+				self.sweep()
+			except Exception:
+				log.exception('sweeping unactivated users failed')
+			self.stopped.wait(self.interval)
+			if self.stopped.isSet():
+				break
+		self.manager.release()
+
+	def start(self):
+		"""
+		Starts sweeping in the background, beginning with a sweep right away.
+		"""
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.run, name='sweeper')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def stop(self):
+		"""
+		Stops sweeping after the current sweep.
+		"""
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def stats(self):
+		return {'runs' : self.runs,
+			'swept' : self.swept,
+			'lastSwept' : self.lastSwept,
+			'lastRun' : self.lastRun}
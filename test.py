@@ -1,13 +1,35 @@
 import unittest
 import db
 import user
+import cache
+import migrations
+import service
+import hashers
+import sweeper
+import sessions
+import throttle
+import permissions
+import benchmark
+import instrument
+import mailer
+import sharding
+import transfer
+import bloom
+import loadgen
+import eventlog
+import shutil
+import subprocess
+import sys
+import StringIO
+import logging
 import sqlite3
 import os
 import hashlib
 import re
 import datetime
 import time
-from config import DATABASE_PATH, EXPIRATION_PERIOD, FAILED_LOGIN_TOLERANCE, LOCKOUT_PERIOD
+import threading
+from config import DATABASE_PATH, EXPIRATION_PERIOD, FAILED_LOGIN_TOLERANCE, LOCKOUT_PERIOD, PASSWORD_COSTS, SESSION_TTL
 from utils import *
 
 class RegAndAuthBackendTests(unittest.TestCase):
@@ -21,9 +43,12 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		"""
 		Set up the test db and basic user details for testing.
 		"""
+		# drop pooled connections to a previous test db
+		db.closePool()
 		# if the test db does not yet exist, create it
-		if os.path.exists(DATABASE_PATH):
-			os.remove(DATABASE_PATH)
+		for path in (DATABASE_PATH, DATABASE_PATH + '-wal', DATABASE_PATH + '-shm'):
+			if os.path.exists(path):
+				os.remove(path)
 		# create the dbmanager
 		self.dbmanager = db.DBManager()
 		# and release table creation statements
@@ -92,9 +117,965 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		# and should have propageted to the db
 		self.assertNotEquals(self.dbmanager.getUser(self.username).password, self.password)
 		# instead it should be stored as the password's hash
-		self.assertEquals(userobj.password, sha1Hash(self.password))
+		self.assertTrue(hashers.checkPassword(self.password, userobj.password))
 		# and should have propageted to the db
-		self.assertEquals(self.dbmanager.getUser(self.username).password, sha1Hash(self.password))
+		self.assertTrue(hashers.checkPassword(self.password, self.dbmanager.getUser(self.username).password))
+
+	def test_bulk_registration(self):
+		"""
+		Test saving many users at once.
+		"""
+		# one user exists already
+		user.User(username = 'user0', email = 'user0@website.de', password = self.password, authgroup = 'non-admin').save()
+		users = [user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password, authgroup = 'non-admin')
+				for i in range(25)]
+		# a duplicate within the batch and an unknown authgroup
+		users.append(user.User(username = 'user3', email = 'other@website.de', password = self.password, authgroup = 'non-admin'))
+		users.append(user.User(username = 'nogroup', email = 'nogroup@website.de', password = self.password, authgroup = 'nobody'))
+		conflicts = self.dbmanager.insertUsers(users, chunksize=10)
+		self.assertEquals(conflicts, [('user0', 'exists'), ('user3', 'duplicate'), ('nogroup', 'unknown authgroup')])
+		# all others are stored
+		for i in range(25):
+			self.assertTrue(self.dbmanager.userExists('user%d' % i))
+		self.assertEquals(self.dbmanager.getUser('user3').email, 'user3@website.de')
+		self.assertFalse(self.dbmanager.userExists('nogroup'))
+		# saving the same users again conflicts on every one of them
+		self.assertEquals(len(user.User.saveMany(users[:5])), 5)
+
+	def test_authgroup_mapping(self):
+		"""
+		Test the cached mapping of authgroup ids and names.
+		"""
+		self.assertEquals(self.dbmanager.getAuthGroupId('admin'), 1)
+		self.assertEquals(self.dbmanager.getAuthGroupName(2), 'non-admin')
+		# new groups invalidate the mapping
+		self.dbmanager.insertGroup('guest')
+		self.assertFalse(self.dbmanager.groups.isLoaded())
+		self.assertEquals(self.dbmanager.getAuthGroupId('guest'), 3)
+		self.assertEquals(self.dbmanager.getAuthGroupName(3), 'guest')
+		# and all managers of a database share it
+		self.assertTrue(db.getManager().groups is self.dbmanager.groups)
+		# unknown groups can't be referenced
+		self.assertRaises(AuthGroupDoesNotExistException, self.dbmanager.getAuthGroupId, 'nobody')
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'nobody')
+		self.assertRaises(AuthGroupDoesNotExistException, userobj.save)
+		# users come with their group's name
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'guest')
+		userobj.save()
+		self.assertEquals(self.dbmanager.getUser(self.username).authgroup, 'guest')
+		self.assertRaises(UserDoesNotExistException, self.dbmanager.getUser, 'nobody')
+
+	def test_user_cache(self):
+		"""
+		Test the identity map in front of user retrieval.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		# saved users are served from the identity map
+		self.assertTrue(self.dbmanager.getUser(self.username) is userobj)
+		# others are read once and cached
+		self.dbmanager.users.clear()
+		first = self.dbmanager.getUser(self.username)
+		self.assertFalse(first is userobj)
+		self.assertTrue(self.dbmanager.getUser(self.username) is first)
+		# updates are written through
+		userobj.logout()
+		self.assertTrue(self.dbmanager.getUser(self.username) is userobj)
+
+		# the cache is bounded and counts what it does
+		lru = cache.LRUCache(size=2, ttl=60)
+		lru.put('a', 1)
+		lru.put('b', 2)
+		self.assertEquals(lru.get('a'), 1)
+		lru.put('c', 3)
+		self.assertEquals(lru.get('b'), None)
+		self.assertEquals(lru.get('c'), 3)
+		stats = lru.stats()
+		self.assertEquals((stats['size'], stats['hits'], stats['misses'], stats['evictions']), (2, 2, 1, 1))
+		# and entries expire
+		lru = cache.LRUCache(size=2, ttl=0.01)
+		lru.put('a', 1)
+		time.sleep(0.02)
+		self.assertEquals(lru.get('a'), None)
+		self.assertEquals(lru.stats()['expirations'], 1)
+
+	def test_username_filter(self):
+		"""
+		Test telling free usernames by the Bloom filter of taken ones.
+		"""
+		usernames = bloom.BloomFilter(1000, 0.01)
+		for i in range(1000):
+			usernames.add('user%d' % i)
+		self.assertTrue(all(['user%d' % i in usernames for i in range(1000)]))
+		falsepositives = len([i for i in range(10000) if 'free%d' % i in usernames])
+		self.assertTrue(falsepositives < 300)
+		user.User.saveMany([user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password,
+				authgroup = 'non-admin') for i in range(3)], notify = False)
+		# the filter of a database is built from its users
+		db.closePool()
+		self.dbmanager = db.DBManager()
+		stats = self.dbmanager.enableInstrumentation()
+		self.assertTrue(self.dbmanager.userExists('user1'))
+		self.assertEquals(stats.snapshot()['statements'][instrument.normalize(db.USER_EXISTS)]['count'], 1)
+		# free usernames are mostly told without a query
+		for i in range(100):
+			self.assertFalse(self.dbmanager.userExists('free%d' % i))
+		self.assertTrue(stats.snapshot()['statements'][instrument.normalize(db.USER_EXISTS)]['count'] < 10)
+		# and inserted ones are added
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		self.assertTrue(self.dbmanager.usernameFilter().mightContain(self.username))
+		self.assertRaises(UserExistsException, userobj.save)
+		# a username taken by another process the filter doesn't know is still refused
+		conn = sqlite3.connect(DATABASE_PATH)
+		conn.execute(db.USER_INSERT, ('elsewhere', 'elsewhere@website.de', 'hash', 1, 'key', 0, 0, 0, 0, 0, 0, 0))
+		conn.commit()
+		conn.close()
+		other = user.User(username = 'elsewhere', email = 'other@website.de', password = self.password, authgroup = 'non-admin')
+		self.assertFalse(self.dbmanager.userExists('elsewhere'))
+		self.assertRaises(UserExistsException, other.save)
+		self.assertTrue(self.dbmanager.usernameFilter().mightContain('elsewhere'))
+		self.assertRaises(UserExistsException, other.save)
+
+	def test_user_by_email(self):
+		"""
+		Test retrieving users by their email.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		self.assertTrue(self.dbmanager.getUserByEmail(self.email) is userobj)
+		self.dbmanager.users.clear()
+		self.assertEquals(self.dbmanager.getUserByEmail(self.email).username, self.username)
+		self.assertRaises(UserDoesNotExistException, self.dbmanager.getUserByEmail, 'wrong@email.com')
+		# the lookup is backed by an index
+		plan = self.dbmanager.conn.execute('EXPLAIN QUERY PLAN ' + db.USER_GET_BY_EMAIL, (self.email,)).fetchall()
+		self.assertTrue('user_email' in ' '.join([row[-1] for row in plan]))
+		# which also keeps emails unique
+		other = user.User(username = 'other', email = self.email, password = self.password, authgroup = 'non-admin')
+		self.assertRaises(EmailExistsException, other.save)
+		self.assertFalse(self.dbmanager.userExists('other'))
+		self.assertEquals(user.User.saveMany([other]), [('other', 'constraint')])
+
+	def test_migrations(self):
+		"""
+		Test upgrading an unversioned database.
+		"""
+		self.assertEquals(migrations.currentVersion(self.dbmanager.conn), migrations.latestVersion())
+		# a database created before versioning
+		path = DATABASE_PATH + '.old'
+		if os.path.exists(path):
+			os.remove(path)
+		conn = sqlite3.connect(path)
+		conn.execute(db.AUTHGROUP_TABLE_CREATION)
+		conn.execute(db.USER_TABLE_CREATION)
+		conn.execute(db.GROUP_INSERT, ('non-admin',))
+		# with text timestamps, one without microseconds
+		conn.execute('INSERT INTO user VALUES(null, ?, ?, ?, 1, ?, ?, 0, 0, 0, 0, 1, ?)',
+				('old', 'old@website.de', sha1Hash('oldpass'), 'key', '2030-01-02 03:04:05.123456', '2030-01-02 03:04:05'))
+		conn.commit()
+		self.assertEquals(migrations.currentVersion(conn), 0)
+		self.assertEquals(migrations.migrate(conn), [version for version, description, statements in migrations.MIGRATIONS])
+		self.assertEquals(migrations.currentVersion(conn), migrations.latestVersion())
+		# migrating again doesn't do anything
+		self.assertEquals(migrations.migrate(conn), [])
+
+		# text timestamps are still read
+		old = db.DBManager(path).getUser('old')
+		self.assertEquals(old.key_expiration, datetime.datetime(2030, 1, 2, 3, 4, 5, 123456))
+		self.assertEquals(old.locked_until, datetime.datetime(2030, 1, 2, 3, 4, 5))
+		# until they are converted to integers
+		self.assertEquals(migrations.convertTimestamps(conn, batchsize = 1, pause = 0), 1)
+		self.assertEquals(migrations.convertTimestamps(conn), 0)
+		self.assertEquals(conn.execute('SELECT key_expires_on, locked_until, key_expires_at FROM user').fetchone(),
+				(None, None, toEpochMicros(old.key_expiration)))
+		db.closePool(path)
+		old = db.DBManager(path).getUser('old')
+		self.assertEquals(old.key_expiration, datetime.datetime(2030, 1, 2, 3, 4, 5, 123456))
+		self.assertEquals(old.locked_until, datetime.datetime(2030, 1, 2, 3, 4, 5))
+		db.closePool(path)
+		conn.close()
+		os.remove(path)
+
+		# users sharing an email don't keep the other migrations from being applied
+		conn = sqlite3.connect(path)
+		conn.execute(db.AUTHGROUP_TABLE_CREATION)
+		conn.execute(db.USER_TABLE_CREATION)
+		for name in ('first', 'second'):
+			conn.execute('INSERT INTO user (username, email, authgroup_id) VALUES(?, ?, 1)', (name, 'shared@website.de'))
+		conn.commit()
+		logging.disable(logging.WARNING)
+		try:
+			self.assertEquals(len(migrations.migrate(conn)), len(migrations.MIGRATIONS))
+		finally:
+			logging.disable(logging.NOTSET)
+		self.assertEquals(migrations.currentVersion(conn), migrations.latestVersion())
+		self.assertEquals(migrations.makeEmailsUnique(conn), [('shared@website.de', 2)])
+		# until they are resolved
+		conn.execute("DELETE FROM user WHERE username = 'second'")
+		conn.commit()
+		self.assertEquals(migrations.makeEmailsUnique(conn), [])
+		self.assertRaises(sqlite3.IntegrityError, conn.execute,
+				"INSERT INTO user (username, email, authgroup_id) VALUES('third', 'shared@website.de', 1)")
+		conn.close()
+		os.remove(path)
+
+		# integer timestamps map onto the same datetimes
+		date = datetime.datetime(2012, 2, 29, 23, 59, 59, 999999)
+		self.assertEquals(fromEpochMicros(toEpochMicros(date)), date)
+		self.assertEquals(toEpochMicros(datetime.datetime(1970, 1, 1, 0, 0, 1)), 1000000)
+
+	def test_dirty_tracking(self):
+		"""
+		Test that updates only write changed attributes.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		self.assertEquals(userobj.changedFields(), set())
+		userobj.save()
+		# nothing changed, nothing written
+		self.assertFalse(self.dbmanager.updateUser(userobj))
+		userobj.logout()
+		self.assertEquals(userobj.changedFields(), set())
+		# assigning an equal value is no change
+		userobj.locked = False
+		self.assertEquals(userobj.changedFields(), set())
+		userobj.logged_in = True
+		userobj.failed_logins = 2
+		self.assertEquals(userobj.changedFields(), set(['logged_in', 'failed_logins']))
+		self.assertTrue(self.dbmanager.updateUser(userobj))
+		self.assertEquals(userobj.changedFields(), set())
+		# the changes are in the db
+		self.dbmanager.users.clear()
+		stored = self.dbmanager.getUser(self.username)
+		self.assertTrue(stored.isLoggedIn())
+		self.assertEquals(stored.failed_logins, 2)
+		self.assertEquals(stored.changedFields(), set())
+		# an unlock in memory is persisted by the next update
+		stored.locked = True
+		stored.locked_until = datetime.datetime.now() - datetime.timedelta(seconds=1)
+		stored.update()
+		self.assertFalse(stored.isLocked())
+		self.assertEquals(stored.changedFields(), set(['locked']))
+		stored.update()
+		self.dbmanager.users.clear()
+		self.assertFalse(self.dbmanager.getUser(self.username).locked)
+
+	def test_write_behind(self):
+		"""
+		Test queueing user updates and writing them in batches.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		queue = self.dbmanager.enableWriteBehind(batchsize = 100, interval = 60)
+		self.assertTrue(db.getManager().writeBehindQueue() is queue)
+		def stored(column):
+			return self.dbmanager.conn.execute('SELECT %s FROM user WHERE username = ?' % column, (self.username,)).fetchone()[0]
+		# updates are queued and coalesced
+		userobj.activate(userobj.registration_key)
+		userobj.login(self.email, self.password)
+		self.assertEquals(queue.depth(), 1)
+		self.assertEquals(stored('activated'), 0)
+		self.assertEquals(stored('logged_in'), 0)
+		# but visible to readers
+		self.dbmanager.users.clear()
+		self.assertTrue(self.dbmanager.getUser(self.username).isLoggedIn())
+		# until they are flushed, along with the new session
+		self.assertEquals(queue.stats()['statements'], 1)
+		self.assertEquals(queue.flush(), 2)
+		self.assertEquals(queue.depth(), 0)
+		self.assertEquals(stored('activated'), 1)
+		self.assertEquals(stored('logged_in'), 1)
+		stats = queue.stats()
+		self.assertEquals((stats['enqueued'], stats['coalesced'], stats['flushes'], stats['flushed']), (3, 1, 1, 2))
+
+		# locking bypasses the queue and takes the user's queued updates along
+		userobj = self.dbmanager.getUser(self.username)
+		userobj.logout()
+		self.assertEquals(queue.depth(), 1)
+		for i in range(FAILED_LOGIN_TOLERANCE+1):
+			userobj.login(email = self.email, password = 'wrongpass%s' % i)
+		self.assertEquals(queue.depth(), 0)
+		self.assertEquals(stored('locked'), 1)
+		self.assertEquals(stored('logged_in'), 0)
+		self.assertEquals(stored('failed_logins'), FAILED_LOGIN_TOLERANCE+1)
+
+		# the background thread writes once enough users are pending
+		self.dbmanager.disableWriteBehind()
+		self.assertTrue(self.dbmanager.writeBehindQueue() is None)
+		queue = self.dbmanager.enableWriteBehind(batchsize = 1, interval = 60)
+		userobj.failed_logins = 0
+		userobj.update()
+		for i in range(100):
+			if queue.depth() == 0 and queue.flushes:
+				break
+			time.sleep(0.01)
+		self.assertEquals(stored('failed_logins'), 0)
+		self.dbmanager.disableWriteBehind()
+		# queued updates are written when the process exits
+		script = ('import db; manager = db.getManager(); manager.enableWriteBehind(interval = 60); '
+				'userobj = manager.getUser(%r); userobj.logged_in = True; userobj.update()' % self.username)
+		self.assertEquals(stored('logged_in'), 0)
+		subprocess.check_call([sys.executable, '-c', script])
+		self.assertEquals(stored('logged_in'), 1)
+
+	def test_async_service(self):
+		"""
+		Test running user operations on worker threads.
+		"""
+		userservice = service.AsyncUserService(workers = 2)
+		userobj = userservice.register(self.username, self.password, self.email, 'non-admin').result(5)
+		self.assertTrue(userservice.activate(self.username, userobj.registration_key).result(5))
+		token = userservice.login(self.email, self.password).result(5)
+		self.assertEquals(sessions.getSessionStore().validate(token), self.username)
+		self.assertTrue(self.dbmanager.getUser(self.username).isLoggedIn())
+		userservice.logout(self.username).result(5)
+		self.assertFalse(userservice.getUser(self.username).result(5).isLoggedIn())
+		self.assertFalse(userservice.login(self.email, 'wrongpass').result(5))
+		# failures are raised by the future
+		self.assertRaises(UserDoesNotExistException, userservice.getUser('nobody').result, 5)
+		# callbacks are called once done
+		done = []
+		userservice.getUser(self.username).addDoneCallback(done.append)
+		userservice.shutdown()
+		self.assertEquals(len(done), 1)
+
+		# a full queue pushes back and queued operations can be cancelled
+		userservice = service.AsyncUserService(workers = 1, queuesize = 1)
+		started = threading.Event()
+		release = threading.Event()
+		def block():
+			started.set()
+			release.wait(5)
+		userservice.submit(block)
+		started.wait(5)
+		queued = userservice.submit(self.dbmanager.getUser, self.username)
+		self.assertRaises(ServiceBusyException, userservice.submit, block)
+		self.assertTrue(queued.cancel())
+		self.assertRaises(CancelledException, queued.result)
+		release.set()
+		userservice.shutdown()
+		# workers keep their connection, so they must leave one in the pool
+		self.assertRaises(ValueError, service.AsyncUserService, workers = db.getPool().size)
+		userservice = service.AsyncUserService(workers = db.getPool().size - 1)
+		futures = [userservice.submit(self.dbmanager.fetchone, db.USER_COUNT) for i in range(db.getPool().size * 2)]
+		self.assertEquals([future.result(5) for future in futures], [(1,)] * db.getPool().size * 2)
+		self.assertEquals(self.dbmanager.fetchone(db.USER_COUNT), (1,))
+		userservice.shutdown()
+
+	def test_password_hashing(self):
+		"""
+		Test password hashes and their upgrade upon login.
+		"""
+		encoded = hashers.makePassword(self.password)
+		algorithm, cost, salt, key = encoded.split('$')
+		self.assertEquals(algorithm, 'pbkdf2_sha256')
+		self.assertEquals(int(cost), PASSWORD_COSTS['pbkdf2_sha256'])
+		# hashes are salted
+		self.assertNotEquals(encoded, hashers.makePassword(self.password))
+		self.assertTrue(hashers.checkPassword(self.password, encoded))
+		self.assertFalse(hashers.checkPassword('wrongpass', encoded))
+		self.assertFalse(hashers.mustUpdate(encoded))
+		# the fallback implementation agrees with hashlib's
+		self.assertEquals(hashers.pbkdf2('password', 'salt', 2), hashlib.pbkdf2_hmac('sha256', 'password', 'salt', 2))
+		# old algorithms and costs need an upgrade
+		self.assertTrue(hashers.checkPassword(self.password, sha1Hash(self.password)))
+		self.assertTrue(hashers.mustUpdate(sha1Hash(self.password)))
+		self.assertTrue(hashers.mustUpdate(hashers.encodePassword(self.password, cost = 10)))
+
+		# a legacy hash is replaced upon the next successful login
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.password = sha1Hash(self.password)
+		userobj.save()
+		userobj.login(self.email, 'wrongpass')
+		self.assertEquals(userobj.password, sha1Hash(self.password))
+		userobj.login(self.email, self.password)
+		self.assertTrue(userobj.isLoggedIn())
+		self.dbmanager.users.clear()
+		stored = self.dbmanager.getUser(self.username).password
+		self.assertTrue(stored.startswith('pbkdf2_sha256$'))
+		self.assertTrue(hashers.checkPassword(self.password, stored))
+
+		# hashing in worker processes
+		# unreadable hashes never match
+		logging.disable(logging.ERROR)
+		try:
+			for encoded in ('unknown$1$salt$hash', 'pbkdf2_sha256$many$salt$hash', 'pbkdf2_sha256$1000', None):
+				self.assertFalse(hashers.checkPassword(self.password, encoded))
+			userobj = user.User(username = 'unreadable', email = 'unreadable@website.de', password = self.password, authgroup = 'non-admin')
+			userobj.save()
+			userobj.password = 'unknown$1$salt$hash'
+			self.assertFalse(userobj.login('unreadable@website.de', self.password))
+		finally:
+			logging.disable(logging.NOTSET)
+		backend = hashers.ProcessBackend(2)
+		previous = hashers.setBackend(backend)
+		try:
+			encoded = hashers.makePassword(self.password)
+			self.assertTrue(hashers.checkPassword(self.password, encoded))
+			self.assertEquals(len(hashers.makePasswords(['a', 'b', 'c'])), 3)
+		finally:
+			hashers.setBackend(previous)
+			backend.close()
+
+	def test_expiration_sweep(self):
+		"""
+		Test expiring and purging overdue unactivated users.
+		"""
+		later = datetime.datetime.now() + EXPIRATION_PERIOD + datetime.timedelta(seconds=1)
+		users = [user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password, authgroup = 'non-admin')
+				for i in range(7)]
+		user.User.saveMany(users)
+		# an activated user is never swept
+		users[0].activate(users[0].registration_key)
+		cached = self.dbmanager.getUser('user1')
+		# nothing is overdue yet
+		self.assertEquals(self.dbmanager.expireUsers(), 0)
+		self.assertEquals(self.dbmanager.expireUsers(now = later, batchsize = 4, pause = 0), 6)
+		self.assertEquals(self.dbmanager.expireUsers(now = later), 0)
+		self.assertFalse(self.dbmanager.getUser('user0').isExpired())
+		# cached users have been invalidated
+		self.assertFalse(self.dbmanager.getUser('user1') is cached)
+		self.assertTrue(self.dbmanager.getUser('user1').isExpired())
+		# purging deletes them
+		self.assertEquals(self.dbmanager.expireUsers(now = later, purge = True), 6)
+		self.assertTrue(self.dbmanager.userExists('user0'))
+		self.assertFalse(self.dbmanager.userExists('user1'))
+		# expired users aren't walked again to find overdue ones
+		for select in (db.USERS_OVERDUE, db.USERS_OVERDUE_ALL):
+			plan = self.dbmanager.conn.execute('EXPLAIN QUERY PLAN ' + select, (0, 1)).fetchall()
+			self.assertTrue('expired=? AND key_expires_at<?' in ' '.join([row[-1] for row in plan]))
+
+		# the sweeper does it periodically
+		user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin').save()
+		time.sleep(EXPIRATION_PERIOD.total_seconds())
+		periodic = sweeper.Sweeper(interval = 60)
+		periodic.start()
+		periodic.stop()
+		self.assertEquals(periodic.stats()['swept'], 1)
+		self.assertTrue(self.dbmanager.getUser(self.username).isExpired())
+
+	def test_iterate_users(self):
+		"""
+		Test streaming over users as lightweight records.
+		"""
+		users = [user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password,
+				authgroup = i % 3 and 'non-admin' or 'admin') for i in range(10)]
+		user.User.saveMany(users)
+		users[4].activate(users[4].registration_key)
+		records = list(self.dbmanager.iterUsers(batchsize = 3))
+		self.assertEquals([record.username for record in records], ['user%d' % i for i in range(10)])
+		self.assertEquals(records[0].authgroup, 'admin')
+		self.assertEquals(records[4].key_expiration, users[4].key_expiration)
+		self.assertTrue(records[4].activated)
+		self.assertFalse(records[3].activated)
+		# records are read-only
+		self.assertRaises(AttributeError, setattr, records[0], 'username', 'other')
+		# filtered and projected
+		records = list(self.dbmanager.iterUsers(filter = {'authgroup' : 'admin', 'activated' : False}, columns = ['username', 'email']))
+		self.assertEquals(records, [('user0', 'user0@website.de'), ('user3', 'user3@website.de'), ('user6', 'user6@website.de'), ('user9', 'user9@website.de')])
+		self.assertEquals(records[1].email, 'user3@website.de')
+		self.assertRaises(ValueError, list, self.dbmanager.iterUsers(columns = ['nothing']))
+
+	def test_sessions(self):
+		"""
+		Test session tokens issued upon login.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		store = sessions.getSessionStore()
+		self.assertFalse(userobj.login(self.email, 'wrongpass'))
+		first = userobj.login(self.email, self.password)
+		second = userobj.login(self.email, self.password)
+		# every login has it's own session
+		self.assertNotEquals(first, second)
+		self.assertEquals(store.validate(first), self.username)
+		self.assertEquals(store.validate(second), self.username)
+		self.assertEquals(store.validate('forged'), None)
+		# sessions are seen by other processes
+		self.assertEquals(sessions.SessionStore().validate(first), self.username)
+		# a single one can be ended
+		store.revoke(first)
+		self.assertEquals(store.validate(first), None)
+		self.assertEquals(sessions.SessionStore().validate(first), None)
+		# logout ends all of them
+		third = userobj.login(self.email, self.password)
+		userobj.logout()
+		self.assertEquals(store.validate(second), None)
+		self.assertEquals(store.validate(third), None)
+		self.assertEquals(store.sessions(self.username), set())
+		# revocations by other processes take effect once a token is read again
+		other = sessions.SessionStore(recheck = 0.05)
+		fourth = userobj.login(self.email, self.password)
+		self.assertEquals(other.validate(fourth), self.username)
+		store.revokeAll(self.username)
+		time.sleep(0.05)
+		self.assertEquals(other.validate(fourth), None)
+		self.assertEquals(other.sessions(self.username), set())
+		# sessions expire and get pruned
+		token = userobj.login(self.email, self.password)
+		time.sleep(SESSION_TTL.total_seconds())
+		self.assertEquals(store.prune(), 1)
+		self.assertEquals(store.validate(token), None)
+		store.startPruner(interval = 0.01)
+		store.stopPruner()
+		# with a write-behind queue new sessions are written with its batches
+		queue = self.dbmanager.enableWriteBehind(batchsize = 1000, interval = 60)
+		try:
+			token = userobj.login(self.email, self.password)
+			self.assertEquals(self.dbmanager.fetchone(sessions.SESSION_GET, (token,)), None)
+			self.assertEquals(queue.stats()['statements'], 1)
+			self.assertEquals(store.validate(token), self.username)
+			queue.flush()
+			self.assertEquals(sessions.SessionStore().validate(token), self.username)
+			# a queued session can't outlive its revocation
+			token = userobj.login(self.email, self.password)
+			store.revoke(token)
+			self.assertEquals(queue.stats()['statements'], 0)
+			self.assertEquals(sessions.SessionStore().validate(token), None)
+		finally:
+			self.dbmanager.disableWriteBehind()
+
+	def test_failure_tracking(self):
+		"""
+		Test counting failed logins in the user's row and per source in memory.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		def stored(column):
+			return self.dbmanager.conn.execute('SELECT %s FROM user WHERE username = ?' % column, (self.username,)).fetchone()[0]
+		# every failure is written
+		for i in range(FAILED_LOGIN_TOLERANCE):
+			userobj.login(self.email, 'wrongpass')
+		self.assertEquals(userobj.failed_logins, FAILED_LOGIN_TOLERANCE)
+		self.assertEquals(stored('failed_logins'), FAILED_LOGIN_TOLERANCE)
+		self.assertEquals(userobj.changedFields(), set())
+		# and so is locking
+		userobj.login(self.email, 'wrongpass')
+		self.assertTrue(userobj.isLocked())
+		self.assertEquals(stored('locked'), 1)
+		# and unlocking, which starts counting anew
+		time.sleep(LOCKOUT_PERIOD.total_seconds())
+		userobj.login(self.email, 'wrongpass')
+		self.assertFalse(userobj.isLocked())
+		self.assertEquals((stored('locked'), stored('failed_logins')), (0, 1))
+
+		# parallel failures are all counted and lock exactly once
+		other = user.User(username = 'other', email = 'other@website.de', password = self.password, authgroup = 'non-admin')
+		other.save()
+		locks = []
+		def fail():
+			for i in range(3):
+				outcome = self.dbmanager.recordFailedLogin('other')
+				locks.append(outcome is not None and outcome[1] is not None)
+			self.dbmanager.release()
+		threads = [threading.Thread(target = fail) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEquals(locks.count(True), 1)
+		self.assertEquals(self.dbmanager.fetchone('SELECT failed_logins FROM user WHERE username = ?', ('other',))[0],
+				FAILED_LOGIN_TOLERANCE+1)
+
+		# sources failing too often are blocked
+		tracker = throttle.FailureTracker(tolerance = 2, window = 60)
+		for i in range(3):
+			tracker.recordFailure('10.0.0.1')
+		self.assertTrue(tracker.isSourceBlocked('10.0.0.1'))
+		self.assertFalse(tracker.isSourceBlocked('10.0.0.2'))
+		# parallel failures are all counted
+		tracker = throttle.FailureTracker(tolerance = 100, window = 60)
+		def failSource():
+			for i in range(10):
+				tracker.recordFailure('10.0.0.1')
+		threads = [threading.Thread(target = failSource) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEquals(tracker.sourceFailures('10.0.0.1'), 40)
+		# failures leave the window
+		tracker = throttle.FailureTracker(tolerance = 5, window = 0.05)
+		tracker.recordFailure('10.0.0.1')
+		time.sleep(0.06)
+		self.assertEquals(tracker.recordFailure('10.0.0.1'), 1)
+		# only a bounded number of sources is tracked
+		tracker = throttle.FailureTracker(maxkeys = 10, window = 60)
+		for i in range(100):
+			tracker.recordFailure('10.0.0.%d' % i)
+		self.assertEquals(len(tracker.failures), 10)
+		# logins from a blocked source are turned away
+		throttle.getTracker().tolerance = 1
+		userobj = self.dbmanager.getUser(self.username)
+		self.assertFalse(userobj.login(self.email, 'wrongpass', source = '10.0.0.3'))
+		self.assertFalse(userobj.login(self.email, 'wrongpass', source = '10.0.0.3'))
+		self.assertFalse(userobj.login(self.email, self.password, source = '10.0.0.3'))
+		self.assertEquals(stored('failed_logins'), 3)
+		self.assertTrue(userobj.login(self.email, self.password, source = '10.0.0.4'))
+
+	def test_benchmark(self):
+		"""
+		Test the benchmark on a small database.
+		"""
+		path = DATABASE_PATH + '.bench'
+		results = benchmark.run([40], 5, path)
+		self.assertEquals(sorted(results['sizes']['40'].keys()), sorted(benchmark.OPERATIONS))
+		for summary in results['sizes']['40'].values():
+			self.assertEquals(summary['count'], 5)
+			self.assertTrue(summary['p50_ms'] <= summary['p95_ms'] <= summary['p99_ms'])
+		# the configured database is left alone
+		self.assertTrue(db.getManager().path == DATABASE_PATH)
+		for filename in (path, path + '-wal', path + '-shm'):
+			if os.path.exists(filename):
+				os.remove(filename)
+		# nothing regresses against itself but against a faster baseline
+		self.assertEquals(benchmark.compare(results, results, 0.1), [])
+		faster = {'sizes' : {'40' : {'login' : {'ops_per_sec' : 1e9, 'p95_ms' : 0.0}}}}
+		self.assertEquals(len(benchmark.compare(results, faster, 0.1)), 2)
+		self.assertEquals(benchmark.percentile([1, 2, 3, 4], 0.5), 2)
+
+	def test_load_generator(self):
+		"""
+		Test the load generator on a small database.
+		"""
+		path = DATABASE_PATH + '.load'
+		results = loadgen.run(path, 20, 3, 1, 0.5, loadgen.parseMix(loadgen.DEFAULT_MIX))
+		for filename in (path, path + '-wal', path + '-shm'):
+			if os.path.exists(filename):
+				os.remove(filename)
+		self.assertEquals(sorted(results['operations'].keys()), sorted(loadgen.OPERATIONS))
+		total = results['total']
+		self.assertTrue(total['count'] > 0)
+		self.assertEquals(total['count'], sum([summary['count'] for summary in results['operations'].values()]))
+		self.assertEquals(total['errors'], 0)
+		self.assertTrue(0 <= total['lock_wait_ms'] <= total['write_ms'])
+		# the configured database is left alone
+		self.assertTrue(db.getManager().path == DATABASE_PATH)
+		self.assertRaises(ValueError, loadgen.parseMix, 'login:1,unknown:1')
+
+	def test_event_log(self):
+		"""
+		Test recording authentication events.
+		"""
+		directory = DATABASE_PATH + '.events'
+		if os.path.exists(directory):
+			shutil.rmtree(directory)
+		self.assertTrue(eventlog.getEventLog() is None)
+		events = eventlog.enable(directory = directory, interval = 60, segmentsize = 1000)
+		self.assertTrue(eventlog.getEventLog() is events)
+		started = datetime.datetime.now()
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		userobj.activate('wrongkey')
+		userobj.activate(userobj.registration_key)
+		self.assertTrue(userobj.login(self.email, self.password))
+		userobj.logout()
+		for i in range(FAILED_LOGIN_TOLERANCE + 1):
+			userobj.login(self.email, 'wrongpass', source = '10.0.0.1')
+		userobj.login(self.email, self.password)
+		self.assertEquals(self.dbmanager.authenticate(self.email, self.password), (db.AUTH_LOCKED, self.username))
+		other = user.User(username = 'other', email = 'other@website.de', password = self.password, authgroup = 'non-admin')
+		other.save()
+		self.dbmanager.activateByKey(other.registration_key)
+		# nothing is written until the batch is due
+		self.assertEquals(events.depth(), 14)
+		self.assertEquals(eventlog.segments(directory), [])
+		db.closePool()
+		self.assertEquals(events.stats()['written'], 14)
+		# every process writes segments of its own
+		self.assertEquals([os.path.basename(path) for path in eventlog.segments(directory)], ['events-%d-000001.jsonl' % os.getpid()])
+		logged = [event['event'] for event in eventlog.iterEvents(directory, self.username)]
+		self.assertEquals(logged, ['activation_failed', 'activated', 'login', 'logout'] +
+				['login_failed'] * (FAILED_LOGIN_TOLERANCE + 1) + ['locked', 'login_failed', 'login_failed'])
+		failure = list(eventlog.iterEvents(directory, self.username))[4]
+		self.assertEquals((failure['source'], failure['reason']), ('10.0.0.1', 'password'))
+		self.assertEquals([event['event'] for event in eventlog.iterEvents(directory, 'other')], ['activated'])
+		# by time
+		self.assertEquals(len(list(eventlog.iterEvents(directory, start = started))), 14)
+		self.assertEquals(list(eventlog.iterEvents(directory, end = started)), [])
+		# segments are rotated by size and appended to after a restart
+		events = eventlog.EventLog(directory, interval = 60, segmentsize = 1000)
+		for i in range(50):
+			events.record('logout', 'user%d' % i)
+			if i % 10 == 9:
+				events.flush()
+		events.stop()
+		self.assertTrue(len(eventlog.segments(directory)) > 2)
+		self.assertEquals(len(list(eventlog.iterEvents(directory))), 64)
+		# a line cut short is skipped
+		outfile = open(eventlog.segments(directory)[-1], 'a')
+		outfile.write('{"at":')
+		outfile.close()
+		self.assertEquals(len(list(eventlog.iterEvents(directory))), 64)
+		# the events of several processes are merged by their time
+		first = eventlog.EventLog(directory, interval = 60, writer = 1)
+		second = eventlog.EventLog(directory, interval = 60, writer = 2)
+		for i in range(6):
+			[first, second][i % 2].record('login', 'merged', number = i)
+			time.sleep(0.001)
+		first.stop()
+		second.stop()
+		self.assertEquals([event['number'] for event in eventlog.iterEvents(directory, 'merged')], range(6))
+		# queued events are written when the process exits
+		script = ('import eventlog; eventlog.enable(directory = %r, interval = 60).record("logout", "exiting")' % directory)
+		subprocess.check_call([sys.executable, '-c', script])
+		self.assertEquals([event['event'] for event in eventlog.iterEvents(directory, 'exiting')], ['logout'])
+		shutil.rmtree(directory)
+
+	def test_instrumentation(self):
+		"""
+		Test counting and timing statements.
+		"""
+		self.assertTrue(self.dbmanager.queryStats() is None)
+		stats = self.dbmanager.enableInstrumentation(threshold = 0)
+		# the statistics are shared by all managers of the database
+		self.assertTrue(db.getManager().queryStats() is stats)
+		slow = []
+		class Collect(logging.Handler):
+			def emit(self, record):
+				slow.append(record.getMessage())
+		handler = Collect()
+		instrument.slowlog.addHandler(handler)
+		try:
+			userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+			userobj.save()
+			self.dbmanager.users.clear()
+			self.dbmanager.getUser(self.username)
+			self.assertRaises(UserDoesNotExistException, self.dbmanager.getUser, 'nobody')
+			user.User.saveMany([user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password,
+					authgroup = 'non-admin') for i in range(3)])
+			# so are the statements of migrations and of the username filter
+			self.dbmanager.migrate()
+			builds = stats.snapshot()['statements'].get(db.USERNAMES, {'count' : 0})['count']
+			self.dbmanager.buildUsernameFilter()
+		finally:
+			instrument.slowlog.removeHandler(handler)
+		snapshot = stats.snapshot()
+		self.assertEquals(snapshot['statements']['PRAGMA user_version']['count'], len(migrations.MIGRATIONS))
+		self.assertEquals(snapshot['statements'][db.USERNAMES]['count'], builds + 1)
+		lookup = snapshot['statements'][instrument.normalize(db.USER_GET_BY_USERNAME)]
+		self.assertEquals((lookup['count'], lookup['rows']), (2, 1))
+		self.assertTrue(lookup['p50_ms'] <= lookup['p99_ms'] <= lookup['max_ms'])
+		self.assertEquals(snapshot['statements'][instrument.normalize(db.USER_INSERT)]['count'], 1)
+		# lists of bindings of any length are counted together
+		self.assertTrue('SELECT username FROM user WHERE username IN (?, ...)' in snapshot['statements'])
+		self.assertEquals(snapshot['commits']['count'], 2)
+		# everything has been slower than a threshold of 0
+		self.assertEquals(len(slow), snapshot['slow'] + snapshot['commits']['count'])
+		self.dbmanager.disableInstrumentation()
+		self.dbmanager.getUser(self.username)
+		self.assertEquals(stats.snapshot()['statements'][instrument.normalize(db.USER_GET_BY_USERNAME)]['count'], 2)
+
+	def test_activation_mail(self):
+		"""
+		Test queueing and delivering activation mails.
+		"""
+		transport = mailer.MemoryTransport()
+		queue = mailer.MailQueue(transport, batchsize = 10, interval = 0.01, retries = 2, backoff = 0.01)
+		previous = mailer.setMailQueue(queue)
+		try:
+			userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+			# nothing is sent before the user has been saved
+			self.assertTrue(queue.flush(5))
+			self.assertEquals(transport.sent, [])
+			userobj.save()
+			users = [user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password,
+					authgroup = 'non-admin') for i in range(3)]
+			users.append(user.User(username = self.username, email = 'other@website.de', password = self.password, authgroup = 'non-admin'))
+			# of a name given twice only the saved copy gets a mail
+			users.append(user.User(username = 'dup', email = 'dup@website.de', password = self.password, authgroup = 'non-admin'))
+			users.append(user.User(username = 'dup', email = 'duplicate@website.de', password = self.password, authgroup = 'non-admin'))
+			self.assertEquals(user.User.saveMany(users), [(self.username, 'exists'), ('dup', 'duplicate')])
+			# users may be given by a generator
+			user.User.saveMany(user.User(username = 'gen%d' % i, email = 'gen%d@website.de' % i, password = self.password,
+					authgroup = 'non-admin') for i in range(2))
+			self.assertTrue(queue.flush(5))
+		finally:
+			mailer.setMailQueue(previous)
+			queue.stop()
+		# the rejected users don't get a mail
+		self.assertEquals(sorted([message.recipient for message in transport.sent]),
+				sorted([self.email, 'dup@website.de', 'gen0@website.de', 'gen1@website.de'] +
+					['user%d@website.de' % i for i in range(3)]))
+		self.assertTrue(userobj.registration_key in transport.sent[0].body)
+		self.assertEquals(queue.stats()['sent'], 7)
+		# failed deliveries are retried until they are given up
+		class Flaky(mailer.MemoryTransport):
+			failures = 1
+			def send(self, message):
+				if message.recipient.startswith('flak') and self.failures:
+					self.failures -= 1
+					raise IOError('connection reset')
+				mailer.MemoryTransport.send(self, message)
+		transport = Flaky()
+		queue = mailer.MailQueue(transport, batchsize = 10, interval = 0.01, retries = 2, backoff = 0.01)
+		queue.send(mailer.Message('flaky@website.de', 'subject', 'body'))
+		self.assertTrue(queue.flush(5))
+		transport.failures = 3
+		queue.send(mailer.Message('flakier@website.de', 'subject', 'body'))
+		self.assertTrue(queue.flush(5))
+		queue.stop()
+		self.assertEquals([message.recipient for message in transport.sent], ['flaky@website.de'])
+		stats = queue.stats()
+		self.assertEquals((stats['sent'], stats['retried'], stats['failed'], stats['depth']), (1, 3, 1, 0))
+
+	def test_sharding(self):
+		"""
+		Test spreading users across shards and resharding them.
+		"""
+		paths = [DATABASE_PATH + '.shard%d' % i for i in range(5)]
+		for path in paths:
+			if os.path.exists(path):
+				os.remove(path)
+		backend = sharding.install(paths[:2])
+		try:
+			self.assertTrue(db.getManager() is backend)
+			backend.createTables()
+			# the authgroups of the catalog are replicated into the shards
+			backend.insertGroup('guest')
+			for shard in backend.shards:
+				self.assertEquals(shard.getAuthGroupId('guest'), backend.getAuthGroupId('guest'))
+			userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+			userobj.save()
+			self.assertRaises(UserExistsException, userobj.save)
+			users = [user.User(username = 'user%d' % i, email = 'user%d@website.de' % i, password = self.password,
+					authgroup = 'guest') for i in range(20)]
+			self.assertEquals(user.User.saveMany(users + users[:1], notify = False), [('user0', 'duplicate')])
+			counts = [shard.fetchone('SELECT COUNT(*) FROM user')[0] for shard in backend.shards]
+			self.assertEquals(sum(counts), 21)
+			self.assertTrue(min(counts) > 0)
+			# emails are unique across shards
+			names = ['other%d' % i for i in range(10)]
+			other = [name for name in names if backend.shardFor(name) is not backend.shardFor(self.username)][0]
+			self.assertRaises(EmailExistsException, user.User(username = other, email = self.email, password = self.password,
+					authgroup = 'non-admin').save)
+			self.assertFalse(backend.userExists(other))
+			self.assertEquals(backend.usernameOf(self.email), self.username)
+			# a user rejected by his shard doesn't claim his email
+			self.assertRaises(UserExistsException, backend.insertUser, user.User(username = self.username,
+					email = 'fresh@website.de', password = self.password, authgroup = 'non-admin'))
+			self.assertEquals(backend.usernameOf('fresh@website.de'), None)
+			self.assertEquals(user.User.saveMany([user.User(username = other, email = 'user1@website.de', password = self.password,
+					authgroup = 'non-admin')], notify = False), [(other, 'constraint')])
+			self.assertFalse(backend.userExists(other))
+			# a user is read from and written to his shard
+			self.assertTrue(backend.getUserByEmail(self.email) is backend.getUser(self.username))
+			self.assertEquals(backend.authenticate(self.email, self.password)[0], db.AUTH_OK)
+			self.assertEquals(backend.authenticate('user7@website.de', self.password), (db.AUTH_OK, 'user7'))
+			self.assertEquals(backend.authenticate('nobody@website.de', self.password), (db.AUTH_INVALID, None))
+			# shards record to the catalog's event log
+			directory = DATABASE_PATH + '.events'
+			if os.path.exists(directory):
+				shutil.rmtree(directory)
+			events = eventlog.enable(directory = directory, interval = 60)
+			backend.authenticate('user7@website.de', self.password)
+			events.flush()
+			self.assertEquals([event['event'] for event in eventlog.iterEvents(directory, 'user7')], ['login'])
+			db.popSharedState(None, 'events').stop()
+			shutil.rmtree(directory)
+			# activation by key only writes to the shard holding the key
+			stats = [shard.enableInstrumentation() for shard in backend.shards]
+			try:
+				self.assertEquals(backend.activateByKey(userobj.registration_key), (db.ACTIVATED, self.username))
+				self.assertEquals(backend.activateByKey('nokey'), (db.KEY_INVALID, None))
+			finally:
+				for shard in backend.shards:
+					shard.disableInstrumentation()
+			holder = backend.shards.index(backend.shardFor(self.username))
+			self.assertEquals([snapshot['commits']['count'] for snapshot in [shardstats.snapshot() for shardstats in stats]],
+					[int(index == holder) for index in range(len(backend.shards))])
+			userobj = backend.getUser(self.username)
+			self.assertTrue(userobj.isActive())
+			token = userobj.login(email = self.email, password = self.password)
+			self.assertEquals(sessions.getSessionStore().validate(token), self.username)
+			# sessions are stored on the user's shard
+			self.assertEquals(backend.shardFor(self.username).fetchone(sessions.SESSION_GET, (token,))[0], self.username)
+			self.assertEquals(backend.catalog.fetchone(sessions.SESSION_GET, (token,)), None)
+			self.assertEquals(sessions.SessionStore().validate(token), self.username)
+			self.assertEquals(sessions.SessionStore().validate('9.' + token.split('.', 1)[1]), None)
+			self.assertEquals(sessions.SessionStore().validate('forged'), None)
+			second = userobj.login(email = self.email, password = self.password)
+			sessions.getSessionStore().revoke(second)
+			self.assertEquals(sessions.SessionStore().validate(second), None)
+			backend.shardFor(self.username).users.clear()
+			self.assertTrue(backend.getUser(self.username).isLoggedIn())
+			# sweeps and iteration cover all shards
+			later = datetime.datetime.now() + EXPIRATION_PERIOD * 2
+			self.assertEquals(backend.expireUsers(later), 20)
+			self.assertEquals(len(list(backend.iterUsers({'expired' : True}, ['username']))), 20)
+			# reshard onto three new shards
+			copied = []
+			target = sharding.reshard(backend, paths[2:], batchsize = 4, progress = copied.append)
+			self.assertEquals(copied[-1], 21)
+			self.assertEquals(sorted([record.username for record in target.iterUsers(columns = ['username'])]),
+					sorted([record.username for record in backend.iterUsers(columns = ['username'])]))
+			self.assertTrue(target.getUser(self.username).isActive())
+			self.assertEquals(target.getUser('user3').authgroup, 'guest')
+			# repeating it copies nothing
+			self.assertEquals(sharding.reshard(backend, paths[2:], progress = copied.append).paths, paths[2:])
+			self.assertEquals(copied[-1], 0)
+			# purging frees the emails of the purged users
+			self.assertEquals(backend.expireUsers(later, purge = True), 20)
+			user.User(username = other, email = 'user1@website.de', password = self.password, authgroup = 'non-admin').save()
+			self.assertEquals(backend.getUserByEmail('user1@website.de').username, other)
+		finally:
+			backend.close()
+			for path in paths:
+				db.closePool(path)
+				for filename in (path, path + '-wal', path + '-shm'):
+					if os.path.exists(filename):
+						os.remove(filename)
+
+	def test_import_export(self):
+		"""
+		Test importing users from and exporting them to files.
+		"""
+		rows = ['username,email,password,authgroup,activated,unknown']
+		rows.extend(['user%d,user%d@website.de,pass%d,non-admin,%d,x' % (i, i, i, i % 2) for i in range(10)])
+		rows.append('user0,again@website.de,pass,non-admin,0,x')
+		path = DATABASE_PATH + '.checkpoint'
+		if os.path.exists(path):
+			os.remove(path)
+		checkpoint = transfer.Checkpoint(path, 'users.csv')
+		reported = []
+		# an import interrupted after the first chunks
+		records = transfer.readRecords(StringIO.StringIO('\n'.join(rows[:5])), 'csv')
+		self.assertEquals(transfer.importUsers(records, 3, checkpoint = checkpoint), (4, {}))
+		self.assertEquals(checkpoint.load(), 4)
+		# continues where it stopped
+		records = transfer.readRecords(StringIO.StringIO('\n'.join(rows)), 'csv')
+		self.assertEquals(transfer.importUsers(records, 3, checkpoint.load(), checkpoint = checkpoint, progress = reported.append),
+				(11, {'exists' : 1}))
+		self.assertEquals(reported, [7, 10, 11])
+		self.assertRaises(ValueError, transfer.Checkpoint(path, 'other.csv').load)
+		os.remove(path)
+		userobj = self.dbmanager.getUser('user3')
+		self.assertTrue(userobj.isActive())
+		self.assertTrue(hashers.checkPassword('pass3', userobj.password))
+		self.assertFalse(self.dbmanager.getUser('user4').isActive())
+
+		# exported users are imported again as they were
+		for format in ('csv', 'jsonl'):
+			outfile = StringIO.StringIO()
+			self.assertEquals(transfer.exportUsers(outfile, format, 4), 10)
+			exported = outfile.getvalue()
+			self.setUp()
+			done, rejected = transfer.importUsers(transfer.readRecords(StringIO.StringIO(exported), format))
+			self.assertEquals((done, rejected), (10, {}))
+			imported = self.dbmanager.getUser('user3')
+			self.assertEquals((imported.password, imported.registration_key, imported.key_expiration, imported.activated),
+					(userobj.password, userobj.registration_key, userobj.key_expiration, True))
+
+		# incomplete and unreadable rows are rejected without stopping the import
+		records = [{'username' : 'nopass', 'email' : 'nopass@website.de', 'authgroup' : 'non-admin'},
+				{'email' : 'noname@website.de', 'password' : 'pass', 'authgroup' : 'non-admin'},
+				['not', 'a', 'record'],
+				{'username' : 'baddate', 'email' : 'baddate@website.de', 'password' : 'pass', 'authgroup' : 'non-admin',
+					'key_expiration' : 'tomorrow'},
+				{'username' : 'complete', 'email' : 'complete@website.de', 'password' : 'pass', 'authgroup' : 'non-admin'}]
+		self.assertEquals(transfer.importUsers(iter(records), 2), (5, {'incomplete' : 3, 'invalid' : 1}))
+		self.assertTrue(self.dbmanager.userExists('complete'))
+		self.assertFalse(self.dbmanager.userExists('nopass'))
+		self.assertFalse(self.dbmanager.userExists('baddate'))
 
 	def test_user_activation(self):
 		"""
@@ -110,6 +1091,9 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		userobj.activate(wrongkey)
 		# he should not be active
 		self.assertFalse(userobj.isActive())
+		# neither without a key
+		self.assertFalse(userobj.activate(None))
+		self.assertFalse(userobj.isActive())
 		# that should be in the db as well
 		self.assertFalse(self.dbmanager.getUser(self.username).isActive())
 
@@ -132,6 +1116,103 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		# that should be in the db as well
 		self.assertTrue(self.dbmanager.getUser(self.username).isActive())
 
+	def test_activation_by_key(self):
+		"""
+		Test activating users by their registration key alone.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		other = user.User(username = 'other', email = 'other@website.de', password = self.password, authgroup = 'non-admin')
+		other.save()
+		self.assertEquals(self.dbmanager.activateByKey(sha1Hash(self.username)), (db.KEY_INVALID, None))
+		self.assertEquals(self.dbmanager.activateByKey(userobj.registration_key), (db.ACTIVATED, self.username))
+		# the identity map doesn't hand out the stale user
+		self.assertTrue(self.dbmanager.getUser(self.username).isActive())
+		# a key works only once
+		self.assertEquals(self.dbmanager.activateByKey(userobj.registration_key), (db.KEY_INVALID, None))
+		# a key that ran out expires the user
+		later = datetime.datetime.now() + EXPIRATION_PERIOD
+		self.assertEquals(self.dbmanager.activateByKey(other.registration_key, later), (db.KEY_EXPIRED, 'other'))
+		self.assertTrue(self.dbmanager.getUser('other').isExpired())
+		self.assertFalse(self.dbmanager.getUser('other').isActive())
+		self.assertEquals(self.dbmanager.activateByKey(other.registration_key), (db.KEY_INVALID, None))
+		# keys are unique
+		duplicate = user.User(username = 'duplicate', email = 'duplicate@website.de', password = self.password,
+				authgroup = 'non-admin', registration_key = other.registration_key)
+		self.assertRaises(sqlite3.IntegrityError, duplicate.save)
+
+	def test_authenticate(self):
+		"""
+		Test checking login attempts with the lockout written by a conditional update.
+		"""
+		userobj = user.User(username = self.username, email = self.email, password = self.password, authgroup = 'non-admin')
+		userobj.save()
+		def failures():
+			return self.dbmanager.fetchone('SELECT failed_logins FROM user WHERE username = ?', (self.username,))[0]
+		self.assertEquals(self.dbmanager.authenticate('wrong@email.com', self.password), (db.AUTH_INVALID, None))
+		self.assertEquals(self.dbmanager.authenticate(self.email, self.password), (db.AUTH_OK, self.username))
+		self.assertTrue(self.dbmanager.getUser(self.username).isLoggedIn())
+		# parallel failures are all counted
+		def fail():
+			self.dbmanager.authenticate(self.email, 'wrongpass')
+			self.dbmanager.release()
+		threads = [threading.Thread(target = fail) for i in range(FAILED_LOGIN_TOLERANCE)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEquals(failures(), FAILED_LOGIN_TOLERANCE)
+		self.assertFalse(self.dbmanager.getUser(self.username).locked)
+		# one more locks the user, even the right password is turned away then
+		self.assertEquals(self.dbmanager.authenticate(self.email, 'wrongpass'), (db.AUTH_INVALID, self.username))
+		userobj = self.dbmanager.getUser(self.username)
+		self.assertTrue(userobj.locked)
+		self.assertFalse(userobj.isLoggedIn())
+		self.assertEquals(self.dbmanager.authenticate(self.email, self.password), (db.AUTH_LOCKED, self.username))
+		# until the lockout is over
+		later = datetime.datetime.now() + LOCKOUT_PERIOD * 2
+		self.assertEquals(self.dbmanager.authenticate(self.email, 'wrongpass', later), (db.AUTH_INVALID, self.username))
+		self.assertEquals(failures(), 1)
+		self.assertEquals(self.dbmanager.authenticate(self.email, self.password, later), (db.AUTH_OK, self.username))
+		userobj = self.dbmanager.getUser(self.username)
+		self.assertEquals((userobj.locked, userobj.failed_logins), (False, 0))
+		self.assertEquals(failures(), 0)
+		# the same without UPDATE ... RETURNING
+		returning, db.SQLITE_RETURNING = db.SQLITE_RETURNING, False
+		try:
+			self.assertEquals(self.dbmanager.recordFailedLogin(self.username), (1, None))
+			for i in range(FAILED_LOGIN_TOLERANCE-1):
+				self.dbmanager.recordFailedLogin(self.username)
+			failed, lockeduntil = self.dbmanager.recordFailedLogin(self.username)
+			self.assertEquals(failed, FAILED_LOGIN_TOLERANCE+1)
+			self.assertTrue(lockeduntil > datetime.datetime.now())
+			self.assertEquals(self.dbmanager.recordFailedLogin(self.username), None)
+			self.assertEquals(self.dbmanager.authenticate(self.email, self.password, later), (db.AUTH_OK, self.username))
+		finally:
+			db.SQLITE_RETURNING = returning
+
+		# failures of both login paths count towards the same lockout
+		other = user.User(username = 'other', email = 'other@website.de', password = self.password, authgroup = 'non-admin')
+		other.save()
+		for i in range(FAILED_LOGIN_TOLERANCE):
+			if i % 2:
+				self.assertFalse(other.login('other@website.de', 'wrongpass'))
+			else:
+				self.assertEquals(self.dbmanager.authenticate('other@website.de', 'wrongpass'), (db.AUTH_INVALID, 'other'))
+		self.assertFalse(other.login('other@website.de', 'wrongpass'))
+		self.assertEquals(self.dbmanager.authenticate('other@website.de', self.password), (db.AUTH_LOCKED, 'other'))
+
+		# a lockout stored as text before the integer timestamps is kept
+		locked_until = str(datetime.datetime.now() + datetime.timedelta(minutes=10))
+		self.dbmanager.execute('UPDATE user SET locked = 1, locked_until = ?, locked_until_at = NULL WHERE username = ?',
+				(locked_until, self.username))
+		self.dbmanager.commit()
+		self.dbmanager.users.clear()
+		self.assertTrue(self.dbmanager.getUser(self.username).isLocked())
+		self.assertEquals(self.dbmanager.authenticate(self.email, self.password), (db.AUTH_LOCKED, self.username))
+		self.assertEquals(self.dbmanager.fetchone('SELECT locked_until, locked_until_at FROM user WHERE username = ?', (self.username,)),
+				(None, toEpochMicros(parseTimestamp(locked_until))))
+
 	def test_login(self):
 		"""
 		Test login and logout of a user.
@@ -171,7 +1252,10 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		self.assertFalse(self.dbmanager.getUser(username = userobj.username).isLoggedIn())
 		# trial counter should have been incremented
 		self.assertEquals(trials+1, userobj.failed_logins)
+		# in the user's row
+		self.dbmanager.users.clear()
 		self.assertEquals(self.dbmanager.getUser(username = userobj.username).failed_logins, trials+1)
+		userobj = self.dbmanager.getUser(username = userobj.username)
 
 		# test locking
 		# login and out to reset counter
@@ -184,6 +1268,7 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		for i in range(FAILED_LOGIN_TOLERANCE+1):
 			userobj.login(email = self.email, password = 'wrongpass%s' % i)
 		self.assertTrue(userobj.isLocked())
+		self.dbmanager.users.clear()
 		self.assertTrue(self.dbmanager.getUser(username = userobj.username).isLocked())
 		# should unlock after LOCKOUT_PERIOD
 		seconds = LOCKOUT_PERIOD.total_seconds()
@@ -191,7 +1276,63 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		time.sleep(seconds)
 		self.assertFalse(userobj.isLocked())
 		self.assertFalse(self.dbmanager.getUser(username = userobj.username).isLocked())
+
+		# a lockout by another process applies to the user cached here
+		userobj = self.dbmanager.getUser(username = userobj.username)
+		script = ('import db; userobj = db.getManager().getUser(%r)\n'
+				'for i in range(%d): userobj.login(%r, "wrongpass")'
+				% (self.username, FAILED_LOGIN_TOLERANCE+1, self.email))
+		subprocess.check_call([sys.executable, '-c', script])
+		self.assertTrue(self.dbmanager.getUser(username = userobj.username) is userobj)
+		self.assertFalse(userobj.login(self.email, self.password))
+		self.assertTrue(userobj.isLocked())
+		self.assertFalse(userobj.isLoggedIn())
 	
+	def test_connection_pool(self):
+		"""
+		Test that connections are bound per thread and reused.
+		"""
+		pool = db.getPool()
+		# the same thread always gets the same connection
+		conn = pool.connection()
+		self.assertTrue(conn is pool.connection())
+		self.assertTrue(conn is self.dbmanager.conn)
+		# managers of the same database share the pool
+		self.assertTrue(db.getManager().pool is pool)
+		# connections are set up with the configured journal mode
+		mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+		self.assertEquals(mode.lower(), 'wal')
+
+		# another thread gets a connection of its own
+		others = []
+		def borrow():
+			others.append(pool.connection())
+			pool.release()
+		thread = threading.Thread(target=borrow)
+		thread.start()
+		thread.join()
+		self.assertFalse(others[0] is conn)
+		# a released connection is handed out again
+		thread = threading.Thread(target=borrow)
+		thread.start()
+		thread.join()
+		self.assertTrue(others[1] is others[0])
+
+		# a full pool refuses to open more connections
+		small = db.ConnectionPool(DATABASE_PATH, size=1, timeout=0.1)
+		small.connection()
+		errors = []
+		def exhaust():
+			try:
+				small.connection()
+			except PoolExhaustedException, e:
+				errors.append(e)
+		thread = threading.Thread(target=exhaust)
+		thread.start()
+		thread.join()
+		self.assertEquals(len(errors), 1)
+		small.closeAll()
+
 	def test_authorization(self):
 		"""
 		Test user authorization.
@@ -210,6 +1351,30 @@ class RegAndAuthBackendTests(unittest.TestCase):
 		# should be admin
 		self.assertTrue(admin.isAdmin())
 
+		# permissions granted to the groups
+		registry = permissions.getRegistry()
+		for name in ('read', 'write', 'delete'):
+			registry.createPermission(name)
+		registry.grant('non-admin', 'read')
+		for name in ('read', 'write', 'delete'):
+			registry.grant('admin', name)
+		self.assertTrue(nonadmin.hasPermission('read'))
+		self.assertFalse(nonadmin.hasPermission('write'))
+		self.assertFalse(nonadmin.hasPermission('unknown'))
+		self.assertTrue(admin.hasPermission('delete'))
+		self.assertEquals(permissions.checkPermissions(nonadmin, ['read', 'write']), {'read' : True, 'write' : False})
+		self.assertTrue(registry.hasAll('admin', ['read', 'write']))
+		self.assertFalse(registry.hasAll('non-admin', ['read', 'write']))
+		self.assertFalse(registry.hasAll('admin', ['read', 'unknown']))
+		# revoking updates the bitsets
+		registry.revoke('admin', 'delete')
+		self.assertFalse(admin.hasPermission('delete'))
+		# which match the ones compiled from the db
+		compiled = permissions.PermissionRegistry()
+		compiled.refresh()
+		self.assertEquals(compiled.groups, registry.groups)
+		self.assertRaises(PermissionDoesNotExistException, registry.grant, 'admin', 'unknown')
+
 if __name__ == '__main__':
 	suite = unittest.TestLoader().loadTestsFromTestCase(RegAndAuthBackendTests)
 	unittest.TextTestRunner(verbosity=1).run(suite)
@@ -0,0 +1,83 @@
+# /usr/bin/python
+
+# In-memory throttling of failing sources
+#
+# Failed logins are counted in sliding windows per source (e.g. the
+# client's address) without touching the database, so that a source
+# guessing the passwords of many users is turned away early. The
+# failures of a user, which lock him, are counted in his row instead,
+# see DBManager.recordFailedLogin(), as they must be shared by all
+# processes.
+
+import threading
+import time
+from collections import deque
+import db
+from cache import LRUCache
+from config import FAILED_LOGIN_WINDOW, FAILED_LOGIN_SOURCE_TOLERANCE, FAILED_LOGIN_TRACKED_KEYS
+
+class FailureTracker(object):
+	"""
+	Counts the failed logins of sources within the last 'window'
+	seconds. A source is blocked once it failed more than 'tolerance'
+	times. At most 'maxkeys' sources are tracked, the least recently
+	failing ones are forgotten first. Failures are counted under a lock
+	so that parallel attempts are all counted.
+	"""
+
+	def __init__(self, tolerance=FAILED_LOGIN_SOURCE_TOLERANCE, window=FAILED_LOGIN_WINDOW,
+			maxkeys=FAILED_LOGIN_TRACKED_KEYS):
+		self.tolerance = tolerance
+		self.window = window
+		self.lock = threading.Lock()
+		# source -> timestamps of the failures within the window
+		self.failures = LRUCache(maxkeys, window)
+
+	def count(self, source, now):
+		times = self.failures.get(source)
+		if times is None:
+			return 0
+		return len([t for t in times if t > now - self.window])
+
+	def recordFailure(self, source):
+		"""
+		Records a failed login of a source. Returns the number of its
+		failures within the window, which is capped just above the
+		tolerance.
+		"""
+		now = time.time()
+		self.lock.acquire()
+		try:
+			times = self.failures.get(source)
+			if times is None:
+				times = deque(maxlen=self.tolerance + 1)
+			while times and times[0] <= now - self.window:
+				times.popleft()
+			times.append(now)
+			self.failures.put(source, times)
+			return len(times)
+		finally:
+			self.lock.release()
+
+	def sourceFailures(self, source):
+		"""
+		Returns the number of failures of a source within the window.
+		"""
+		self.lock.acquire()
+		try:
+			return self.count(source, time.time())
+		finally:
+			self.lock.release()
+
+	def isSourceBlocked(self, source):
+		"""
+		Returns True if a source failed too often to be allowed to try again.
+		"""
+		return self.sourceFailures(source) > self.tolerance
+
+def getTracker(path=None):
+	"""
+	Returns the process-wide failure tracker for the sources of logins
+	to the given database file.
+	"""
+	return db.sharedState(path, 'failures', lambda path: FailureTracker())
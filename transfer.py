@@ -0,0 +1,275 @@
+# /usr/bin/python
+
+# Bulk import and export of users
+#
+# Users are read from and written to CSV or JSON Lines files one row at
+# a time, so files of millions of users take constant memory:
+#
+#	python transfer.py export users.jsonl
+#	python transfer.py import users.jsonl --checkpoint users.checkpoint
+#
+# Imported rows carry either a plaintext 'password', which is hashed,
+# in parallel if a process pool is configured, or an encoded
+# 'password_hash' as written by the export. Rows lacking a username,
+# email, authgroup or password, or with unreadable values, are rejected
+# and counted like users that can't be saved. Rows are written in chunks
+# of one transaction each. After every chunk the number of rows done is
+# stored in the checkpoint file, so an interrupted import continues
+# where it stopped when run again with the same checkpoint.
+
+import os
+import sys
+import csv
+import time
+import json
+import logging
+import itertools
+from optparse import OptionParser
+from config import BULK_CHUNK_SIZE
+import db
+import user
+import hashers
+from utils import *
+
+log = logging.getLogger(__name__)
+
+# the columns of exported files
+EXPORT_FIELDS = ['username', 'email', 'password_hash', 'authgroup', 'registration_key', 'key_expiration',
+			'activated', 'expired', 'failed_logins', 'locked', 'locked_until']
+# the fields every imported row needs besides a password
+REQUIRED_FIELDS = ['username', 'email', 'authgroup']
+BOOLEAN_FIELDS = ['activated', 'expired', 'locked']
+TIMESTAMP_FIELDS = ['key_expiration', 'locked_until']
+
+def fileFormat(path):
+	"""
+	Returns 'jsonl' for paths ending in .jsonl or .json, 'csv' otherwise.
+	"""
+	if os.path.splitext(path)[1] in ('.jsonl', '.json'):
+		return 'jsonl'
+	return 'csv'
+
+def readRecords(infile, format):
+	"""
+	Lazily parses the rows of a CSV file with a header or of a JSON
+	Lines file into dictionaries.
+	"""
+	if format == 'csv':
+		for record in csv.DictReader(infile):
+			yield record
+	else:
+		for line in infile:
+			if line.strip():
+				yield json.loads(line)
+
+def toBoolean(value):
+	if isinstance(value, basestring):
+		return value.strip().lower() in ('1', 'true', 'yes')
+	return bool(value)
+
+def userFromRecord(record, password):
+	"""
+	Constructs a user from an imported record and his encoded password.
+	Missing or empty fields get the defaults of new users, unknown ones
+	are ignored.
+	"""
+	values = {}
+	for name, value in record.iteritems():
+		if value is None or value == '' or name not in EXPORT_FIELDS or name == 'password_hash':
+			continue
+		if name in BOOLEAN_FIELDS:
+			value = toBoolean(value)
+		elif name in TIMESTAMP_FIELDS:
+			value = parseTimestamp(value)
+		elif name == 'failed_logins':
+			value = int(value)
+		values[str(name)] = value
+	if 'registration_key' not in values:
+		# passing a key keeps the constructor from hashing the password again
+		values['registration_key'] = registrationKey(hashers.toBytes(values['username']))
+	values['password'] = password
+	return user.User(**values)
+
+def isComplete(record):
+	"""
+	Returns True if the record has all required fields and a password.
+	"""
+	if not isinstance(record, dict):
+		return False
+	for name in REQUIRED_FIELDS:
+		if not record.get(name):
+			return False
+	return bool(record.get('password') or record.get('password_hash'))
+
+def importChunk(records, notify):
+	"""
+	Hashes the plaintext passwords of a chunk of records at once and
+	saves the users within one transaction. Incomplete records and those
+	with unreadable values are rejected as 'incomplete' or 'invalid'
+	without saving the others. Returns the conflicts.
+	"""
+	conflicts = []
+	complete = []
+	for record in records:
+		if isComplete(record):
+			complete.append(record)
+			continue
+		# don't log the record, it may carry a plaintext password
+		username = None
+		if isinstance(record, dict):
+			username = record.get('username')
+		log.warning('rejected incomplete record of %r', username)
+		conflicts.append((username, 'incomplete'))
+	plaintext = [record['password'] for record in complete if not record.get('password_hash')]
+	hashed = iter(hashers.makePasswords(plaintext))
+	users = []
+	for record in complete:
+		if record.get('password_hash'):
+			encoded = record['password_hash']
+		else:
+			encoded = hashed.next()
+		try:
+			users.append(userFromRecord(record, encoded))
+		except (ValueError, TypeError):
+			log.warning('rejected invalid record of %r', record['username'])
+			conflicts.append((record['username'], 'invalid'))
+	return conflicts + user.User.saveMany(users, notify)
+
+def importUsers(records, batchsize=BULK_CHUNK_SIZE, start=0, notify=False, checkpoint=None, progress=None):
+	"""
+	Saves the users of the given records in chunks of batchsize,
+	skipping the first 'start' records, which have been imported before.
+	After every chunk the number of records done is saved to the
+	checkpoint and passed to progress(). Returns the number of records
+	done and the numbers of rejected users by reason.
+	"""
+	done = start
+	rejected = {}
+	records = itertools.islice(records, start, None)
+	while True:
+		chunk = list(itertools.islice(records, batchsize))
+		if not chunk:
+			break
+		for username, reason in importChunk(chunk, notify):
+			rejected[reason] = rejected.get(reason, 0) + 1
+		done += len(chunk)
+		if checkpoint is not None:
+			checkpoint.save(done)
+		if progress is not None:
+			progress(done)
+	return done, rejected
+
+def exportUsers(outfile, format, batchsize=BULK_CHUNK_SIZE, progress=None):
+	"""
+	Writes all users to a CSV or JSON Lines file, reading them batchsize
+	rows at a time. Returns the number of users written.
+	"""
+	columns = ['password' if name == 'password_hash' else name for name in EXPORT_FIELDS]
+	if format == 'csv':
+		writer = csv.writer(outfile)
+		writer.writerow(EXPORT_FIELDS)
+	count = 0
+	for record in db.getManager().iterUsers(columns=columns, batchsize=batchsize):
+		values = []
+		for name, value in zip(EXPORT_FIELDS, record):
+			if isinstance(value, datetime.datetime):
+				value = str(value)
+			elif format == 'csv' and isinstance(value, bool):
+				value = int(value)
+			elif format == 'csv' and isinstance(value, unicode):
+				value = value.encode('utf-8')
+			values.append(value)
+		if format == 'csv':
+			writer.writerow(values)
+		else:
+			outfile.write(json.dumps(dict(zip(EXPORT_FIELDS, values)), sort_keys=True) + '\n')
+		count += 1
+		if progress is not None and count % batchsize == 0:
+			progress(count)
+	if progress is not None:
+		progress(count)
+	return count
+
+class Checkpoint(object):
+	"""
+	The number of records of a source imported so far, kept in a file.
+	"""
+
+	def __init__(self, path, source):
+		self.path = path
+		self.source = source
+
+	def load(self):
+		"""
+		Returns the number of records done or 0 if there is no checkpoint.
+		A checkpoint of another source is an error.
+		"""
+		if not os.path.exists(self.path):
+			return 0
+		infile = open(self.path)
+		state = json.load(infile)
+		infile.close()
+		if state['source'] != self.source:
+			raise ValueError('checkpoint %s belongs to %s' % (self.path, state['source']))
+		return state['done']
+
+	def save(self, done):
+		# replace the file at once so that an interruption can't corrupt it
+		temporary = self.path + '.tmp'
+		outfile = open(temporary, 'w')
+		json.dump({'source' : self.source, 'done' : done}, outfile)
+		outfile.close()
+		os.rename(temporary, self.path)
+
+class Progress(object):
+	"""
+	Reports the number of rows done and the rows per second.
+	"""
+
+	def __init__(self, verb, stream=sys.stderr, start=0):
+		self.verb = verb
+		self.stream = stream
+		self.start = start
+		self.started = time.time()
+
+	def __call__(self, done):
+		elapsed = max(time.time() - self.started, 1e-6)
+		self.stream.write('%s %d rows, %.1f rows/s\n' % (self.verb, done, (done - self.start) / elapsed))
+
+if __name__ == '__main__':
+	parser = OptionParser(usage='%prog [options] import|export path')
+	parser.add_option('--format', choices=['csv', 'jsonl'],
+			help='csv or jsonl, by default guessed from the file name')
+	parser.add_option('--batch-size', type='int', default=BULK_CHUNK_SIZE,
+			help='rows per transaction and progress report')
+	parser.add_option('--checkpoint',
+			help='file recording how far an import got, to resume it')
+	parser.add_option('--processes', type='int', default=0,
+			help='processes hashing plaintext passwords, by default as configured')
+	parser.add_option('--notify', action='store_true', default=False,
+			help='mail imported users their activation keys')
+	options, args = parser.parse_args()
+	if len(args) != 2 or args[0] not in ('import', 'export'):
+		parser.error('expected import or export and a path')
+	command, path = args
+	format = options.format or fileFormat(path)
+	if command == 'export':
+		outfile = open(path, 'wb')
+		count = exportUsers(outfile, format, options.batch_size, Progress('exported'))
+		outfile.close()
+		print 'exported %d users to %s' % (count, path)
+	else:
+		if options.processes:
+			hashers.setBackend(hashers.ProcessBackend(options.processes))
+		checkpoint = None
+		start = 0
+		if options.checkpoint:
+			checkpoint = Checkpoint(options.checkpoint, os.path.abspath(path))
+			start = checkpoint.load()
+		infile = open(path, 'rb')
+		done, rejected = importUsers(readRecords(infile, format), options.batch_size, start, options.notify,
+						checkpoint, Progress('imported', start=start))
+		infile.close()
+		print 'read %d rows of %s, %d of them before' % (done, path, start)
+		for reason, count in sorted(rejected.items()):
+			print 'rejected %d users: %s' % (count, reason)
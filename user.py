@@ -4,6 +4,12 @@ import hashlib
 import random
 import datetime
 import db
+import hashers
+import sessions
+import throttle
+import permissions
+import mailer
+import eventlog
 from config import EXPIRATION_PERIOD, DATABASE_PATH, FAILED_LOGIN_TOLERANCE, LOCKOUT_PERIOD
 from utils import *
 
@@ -14,28 +20,38 @@ class User(object):
 	# Registration
 	A user can be registered and must be activated with the appropriate key. Otherwise
 	the account will expire. The registration will be generated by the SHA1 hash of
-	the username and some random salt to prevent forgery. The method for sending the
-	key to the user is merely a mock up and would need to be implemented properly
-	for real-world applications.
+	the username and some random salt to prevent forgery. The key is mailed to the
+	user through the queue in mailer.py once he has been saved.
 
 	# Authentication
 	The user can login with his credentials. The user's password will not be stored as
-	clear text but it's SHA1 hash. Upon login the supplied password's SHA1 hash will be
-	compared to the value stored in the database. If they match the user is logged in.
-	Successive failing login attempts will lock the account for a specified amount of time.
+	clear text but as a salted hash by the configured hasher, see hashers.py. Upon login
+	the supplied password is checked against the stored hash. If they match the user is
+	logged in and a hash of an outdated algorithm or cost is replaced. Successive failing
+	login attempts will lock the account for a specified amount of time.
 
 	# Authorization
 	A user is a member of an authentication group. The most simplistic approach is to have
 	two such groups, namely 'admins' and 'non-admins'. Thereby when a user tries to access
 	a certain resource his permission can be determined by calling isAdmin() to decide
-	whether he is allowed to or not.
+	whether he is allowed to or not. Finer grained permissions granted to the groups
+	are checked by hasPermission().
+
+	# Persistence
+	The user keeps track of the attributes changed since it has been loaded
+	or last written so that updates only need to write those.
 	"""
 
+	# attributes whose changes are tracked
+	TRACKED_FIELDS = frozenset(['username', 'email', 'password', 'authgroup', 'activated', 'expired', 'logged_in',
+				'failed_logins', 'locked', 'registration_key', 'key_expiration', 'locked_until'])
+
 	def __init__(self, username, password, email, authgroup, activated=None, expired=None, logged_in=None, failed_logins=None, locked=None, registration_key=None, key_expiration=None, locked_until=None):
 		"""
 		Constructor either receiving all user parameter or only basic values
 		and generating defaults for the rest.
 		"""
+		self.__dict__['changed'] = set()
 		# set the user's details and credentials
 		self.username = username
 		self.email = email
@@ -78,33 +94,74 @@ class User(object):
 		else:
 			self.locked_until = locked_until
 
-		# if newUser is True the registration key needs to be transmitted to
-		# the user's email and his password will be hashed instead of
-		# storing it as real text
+		# if newUser is True his password will be hashed instead of
+		# storing it as real text, the registration key is transmitted
+		# to his email once he has been saved
 		if newUser:
-			self.password = sha1Hash(self.password)
-			self.sendActivationEmail()
+			self.password = hashers.makePassword(self.password)
+		# nothing has changed yet
+		self.markClean()
+
+	def __setattr__(self, name, value):
+		"""
+		Records changes of tracked attributes.
+		"""
+		if name in self.TRACKED_FIELDS and self.__dict__.get(name, self) != value:
+			self.changed.add(name)
+		object.__setattr__(self, name, value)
+
+	def changedFields(self):
+		"""
+		Returns the names of the attributes changed since the last markClean().
+		"""
+		return set(self.changed)
 
+	def markClean(self, fields=None):
+		"""
+		Forgets about changes of the given attributes, by default all of them,
+		once they have been written.
+		"""
+		if fields is None:
+			self.changed.clear()
+		else:
+			self.changed.difference_update(fields)
 
 	def save(self):
 		"""
-		Initially saves a new user to the db.
+		Initially saves a new user to the db and queues his activation mail.
 		"""
-		dbmanager = db.DBManager()
+		dbmanager = db.getManager()
 		if dbmanager.userExists(self.username):
 			raise UserExistsException(self.username)
 		else:
 			dbmanager.insertUser(self)
+			self.sendActivationEmail()
 
-	def update(self):
+	@staticmethod
+	def saveMany(users, notify=True):
+		"""
+		Saves many new users to the db at once. Returns the users that
+		could not be saved as a list of (username, reason) tuples. If
+		notify is True the saved users' activation mails are queued.
+		"""
+		dbmanager = db.getManager()
+		inserted = []
+		conflicts = dbmanager.insertUsers(users, inserted=inserted)
+		if notify:
+			for user in inserted:
+				user.sendActivationEmail()
+		return conflicts
+
+	def update(self, immediate=False):
 		"""
 		Propagates the current user state to the database via
-		the database manager.
+		the database manager. If immediate is True the state is written
+		even if updates are left to a write-behind queue otherwise.
 		"""
 		# get the manager
-		dbmanager = db.DBManager()
+		dbmanager = db.getManager()
 		# and to update
-		dbmanager.updateUser(self)
+		dbmanager.updateUser(self, immediate)
 		return True
 
 	def activate(self, suppliedkey, now = datetime.datetime.now()):
@@ -119,17 +176,22 @@ class User(object):
 		# variable to store success of the activation attempt
 		isokay = False
 		if inTime(now, self.key_expiration):
-			if suppliedkey == self.registration_key:
+			# compare in constant time so that keys can't be guessed by timing
+			if constantTimeCompare(suppliedkey, self.registration_key):
 				self.activated = True
 				# success
 				isokay = not isokay
+				eventlog.record('activated', self.username)
+			else:
+				eventlog.record('activation_failed', self.username)
 		else:
 			self.expired = True
+			eventlog.record('expired', self.username)
 		# update user object
 		self.update()
 		return isokay
 
-	def login(self, email, password):
+	def login(self, email, password, source=None):
 		"""
 		Login the user. The user's email and the password must both
 		be provided as further security measure in case two user's
@@ -140,38 +202,91 @@ class User(object):
 		time. A correct login will reset the failed counter. It will
 		also be reset when being locked out. The user will stay
 		logged in until logout() is called.
+		A correct login returns a session token that can be checked by
+		sessions.getSessionStore().validate() without reading the user
+		again, any other attempt returns False.
+		Failed attempts are counted in the user's row by a single
+		UPDATE, see DBManager.recordFailedLogin(), so that all processes
+		share the count and the lockout. Those of a source, if one is
+		given, are counted in memory by the failure tracker to turn it
+		away once it failed too often. The lockout is read from the
+		database on every attempt, as the user may be cached here while
+		another process locks him. Every attempt is recorded in the
+		event log.
 		"""
+		tracker = throttle.getTracker()
+		# sources failing too often are turned away right away
+		if source is not None and tracker.isSourceBlocked(source):
+			eventlog.record('login_failed', self.username, source=source, reason='source blocked')
+			return False
 		# check if the correct user is meant at all
 		# or if the user is already logged in
 		if email != self.email:
 			# don't proceed in these cases
+			eventlog.record('login_failed', self.username, source=source, reason='email')
 			return False
+		# another process may have locked the user since he was loaded
+		self.refreshLockout()
 		# is the user allowed to login?
+		waslocked = self.locked
 		if self.isLocked():
 			# if not, don't proceed
+			eventlog.record('login_failed', self.username, source=source, reason='locked')
 			return False
+		if waslocked:
+			eventlog.record('unlocked', self.username)
 		# otherwise check the password's credibility
-		if sha1Hash(password) == self.password:
+		if hashers.checkPassword(password, self.password):
 			# correct login
 			self.logged_in = True
 			self.failed_logins = 0
+			# upgrade hashes of outdated algorithms or costs
+			if hashers.mustUpdate(self.password):
+				self.password = hashers.makePassword(password)
+			# propagate to db
+			self.update()
+			eventlog.record('login', self.username, source=source)
+			return sessions.getSessionStore().issue(self.username)
+		# incorrect login
+		if source is not None:
+			tracker.recordFailure(source)
+		outcome = db.getManager().recordFailedLogin(self.username)
+		if outcome is None:
+			# locked by a parallel attempt in the meantime
+			self.refreshLockout()
+			eventlog.record('login_failed', self.username, source=source, reason='locked')
 		else:
-			# incorrect login
-			self.logged_in = False
-			self.failed_logins += 1
-			if self.failed_logins > FAILED_LOGIN_TOLERANCE:
-				self.locked = True
-				self.locked_until = datetime.datetime.now() + LOCKOUT_PERIOD
-		# propagate to db
-		self.update()
+			eventlog.record('login_failed', self.username, source=source, reason='password')
+			self.failed_logins, lockeduntil = outcome
+			self.locked = lockeduntil is not None
+			if self.locked:
+				self.locked_until = lockeduntil
+				eventlog.record('locked', self.username, until=toEpochMicros(lockeduntil))
+		self.logged_in = False
+		# all of this has been written already
+		self.markClean(['logged_in', 'failed_logins', 'locked', 'locked_until'])
+		return False
+
+	def refreshLockout(self):
+		"""
+		Reads whether the user is locked and until when from the database.
+		"""
+		lockout = db.getManager().getLockout(self.username)
+		if lockout is not None:
+			self.locked, lockeduntil = lockout
+			# a lockout without a timestamp is over
+			self.locked_until = lockeduntil or datetime.datetime.now()
+			self.markClean(['locked', 'locked_until'])
 
 	def logout(self):
 		"""
-		Logout the user.
+		Logout the user and end all of his sessions.
 		"""
 		# this operation is not as critical so no checks are done
 		self.logged_in = False
 		self.update()
+		sessions.getSessionStore().revokeAll(self.username)
+		eventlog.record('logout', self.username)
 
 	def isActive(self):
 		"""
@@ -215,8 +330,14 @@ class User(object):
 			return True
 		return False
 
+	def hasPermission(self, permission):
+		"""
+		Determine whether this user's authgroup has been granted a permission.
+		"""
+		return permissions.getRegistry().hasPermission(self.authgroup, permission)
+
 	def sendActivationEmail(self):
 		"""
-		Transmit the registration key to the user's email adress.
+		Queue the registration key for transmission to the user's email adress.
 		"""
-		print 'sending registration_key: %s to %s' % (self.registration_key, self.email)
+		mailer.getMailQueue().send(mailer.activationMessage(self))
@@ -2,6 +2,7 @@
 
 # Help functions and utilities
 
+import hmac
 import hashlib
 import datetime
 import random
@@ -26,6 +27,67 @@ class UserDoesNotExistException(Exception):
         def __str__(self):
                 return repr(self.username) + 'does not yet exist'
 
+class EmailExistsException(Exception):
+        """
+        An Exception representing that the email of a user to be saved is taken by another.
+        """
+        def __init__(self, email):
+                self.email = email
+
+        def __str__(self):
+                return repr(self.email) + 'is already taken'
+
+class AuthGroupDoesNotExistException(Exception):
+        """
+        An Exception representing that a referenced authgroup does not exist.
+        """
+        def __init__(self, name):
+                self.name = name
+
+        def __str__(self):
+                return repr(self.name) + 'does not exist'
+
+class PermissionDoesNotExistException(Exception):
+        """
+        An Exception representing that a referenced permission does not exist.
+        """
+        def __init__(self, name):
+                self.name = name
+
+        def __str__(self):
+                return repr(self.name) + 'does not exist'
+
+class PoolExhaustedException(Exception):
+        """
+        An Exception representing that no pooled connection became available in time.
+        """
+        def __init__(self, path):
+                self.path = path
+
+        def __str__(self):
+                return 'no connection to ' + repr(self.path) + ' available'
+
+class ServiceBusyException(Exception):
+        """
+        An Exception representing that too many operations are waiting to be run.
+        """
+        def __str__(self):
+                return 'too many pending operations'
+
+class ServiceTimeoutException(Exception):
+        """
+        An Exception representing that an operation didn't finish in time.
+        """
+        def __str__(self):
+                return 'operation did not finish in time'
+
+class CancelledException(Exception):
+        """
+        An Exception representing that an operation has been cancelled.
+        """
+        def __str__(self):
+                return 'operation has been cancelled'
+
 def sha1Hash(value):
         """ 
         Returns the SHA1 hex digest of the supplied value.
@@ -34,6 +96,26 @@ def sha1Hash(value):
         sha1.update(value)
         return sha1.hexdigest()
 
+def constantTimeCompare(a, b):
+        """
+        Compares two strings in time independent of where they differ.
+        Anything but strings, e.g. a missing key, is never equal.
+        """
+        if not isinstance(a, basestring) or not isinstance(b, basestring):
+                return False
+        if isinstance(a, unicode):
+                a = a.encode('utf-8')
+        if isinstance(b, unicode):
+                b = b.encode('utf-8')
+        if hasattr(hmac, 'compare_digest'):
+                return hmac.compare_digest(a, b)
+        if len(a) != len(b):
+                return False
+        result = 0
+        for x, y in zip(a, b):
+                result |= ord(x) ^ ord(y)
+        return result == 0
+
 def registrationKey(username):
         """ 
         Generates a registration key by computing the value
@@ -53,6 +135,40 @@ def inTime(date, expiration_date):
                 return True
         return False
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def toEpochMicros(date):
+        """
+        Maps a datetime onto the number of microseconds since the epoch.
+        """
+        delta = date - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def fromEpochMicros(micros):
+        """
+        Maps a number of microseconds since the epoch onto a datetime.
+        """
+        return EPOCH + datetime.timedelta(microseconds=micros)
+
+def parseTimestamp(value):
+        """
+        Parses a datetime stored as text, with or without microseconds.
+        """
+        if '.' in value:
+                return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+        return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+def timestampFromColumns(micros, text):
+        """
+        Returns the datetime of an integer timestamp column or, for rows
+        not yet converted, of the corresponding text column.
+        """
+        if micros is not None:
+                return fromEpochMicros(micros)
+        if text is not None:
+                return parseTimestamp(text)
+        return None
+
 def bool2int(value):
 	"""
         Maps Booleans onto integers: True -> 1, False -> 0
@@ -0,0 +1,232 @@
+# /usr/bin/python
+
+# Write-behind queue for user updates
+
+import threading
+import time
+import logging
+from config import WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL
+
+log = logging.getLogger(__name__)
+
+class WriteBehindQueue(object):
+	"""
+	Collects user updates in memory and writes them to the database in
+	the background. Updates of the same user are coalesced so that only
+	the latest value of every attribute is written. A background thread
+	writes all queued updates within a single transaction once
+	'batchsize' users are pending or 'interval' seconds have passed,
+	whichever comes first. flush() writes synchronously and returns only
+	when the updates have been committed. Other statements, e.g. inserts
+	of sessions, can be queued to be written in the same transactions,
+	in the order they have been queued.
+	"""
+
+	def __init__(self, manager, batchsize=WRITE_BEHIND_BATCH_SIZE, interval=WRITE_BEHIND_INTERVAL):
+		self.manager = manager
+		self.batchsize = batchsize
+		self.interval = interval
+		self.condition = threading.Condition()
+		# only one flush may write at a time
+		self.flushLock = threading.Lock()
+		# pending updates, username -> {attribute : value}
+		self.pending = {}
+		# pending statements as (sql, bindings), oldest first
+		self.statements = []
+		self.running = True
+		# counters
+		self.enqueued = 0
+		self.coalesced = 0
+		self.flushes = 0
+		self.flushed = 0
+		self.errors = 0
+		self.lastFlushLatency = 0.0
+		self.maxFlushLatency = 0.0
+		self.totalFlushLatency = 0.0
+		self.thread = threading.Thread(target=self.run, name='write-behind')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def enqueue(self, username, values):
+		"""
+		Queues the given attribute values of a user to be written.
+		"""
+		self.condition.acquire()
+		try:
+			if username in self.pending:
+				self.pending[username].update(values)
+				self.coalesced += 1
+			else:
+				self.pending[username] = dict(values)
+			self.enqueued += 1
+			if len(self.pending) >= self.batchsize:
+				self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def enqueueStatement(self, sql, bindings):
+		"""
+		Queues a statement to be executed with the next batch.
+		"""
+		self.condition.acquire()
+		try:
+			self.statements.append((sql, bindings))
+			self.enqueued += 1
+			if len(self.pending) + len(self.statements) >= self.batchsize:
+				self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def discardStatements(self, match):
+		"""
+		Removes the queued statements for which match(sql, bindings) is
+		true. Waits for a flush in progress, so statements it has taken
+		are committed when this returns. Returns the number removed.
+		"""
+		self.flushLock.acquire()
+		try:
+			self.condition.acquire()
+			try:
+				kept = [(sql, bindings) for sql, bindings in self.statements if not match(sql, bindings)]
+				discarded = len(self.statements) - len(kept)
+				self.statements = kept
+				return discarded
+			finally:
+				self.condition.release()
+		finally:
+			self.flushLock.release()
+
+	def take(self, username):
+		"""
+		Removes and returns the pending values of a user so that the
+		caller can write them itself. Returns an empty dictionary if
+		nothing is pending.
+		"""
+		self.condition.acquire()
+		try:
+			return self.pending.pop(username, {})
+		finally:
+			self.condition.release()
+
+	def pendingValues(self, username):
+		"""
+		Returns a copy of the values of a user that are not yet written.
+		"""
+		self.condition.acquire()
+		try:
+			return dict(self.pending.get(username, {}))
+		finally:
+			self.condition.release()
+
+	def depth(self):
+		"""
+		Returns the number of users with pending updates.
+		"""
+		return len(self.pending)
+
+	def run(self):
+		"""
+		The background thread's loop.
+		"""
+		while True:
+			self.condition.acquire()
+			try:
+				if self.running and len(self.pending) + len(self.statements) < self.batchsize:
+					self.condition.wait(self.interval)
+				running = self.running
+			finally:
+				self.condition.release()
+			if not running:
+				break
+			try:
+				self.flush()
+			except Exception:
+				log.exception('write-behind flush failed')
+		# the thread's connection isn't needed anymore
+		self.manager.release()
+
+	def flush(self):
+		"""
+		Writes all pending updates and statements within one transaction
+		and commits. Returns the number of users and statements written.
+		"""
+		self.flushLock.acquire()
+		try:
+			self.condition.acquire()
+			try:
+				batch, self.pending = self.pending, {}
+				statements, self.statements = self.statements, []
+			finally:
+				self.condition.release()
+			if not batch and not statements:
+				return 0
+			start = time.time()
+			try:
+				self.manager.execute('BEGIN IMMEDIATE')
+				for username, values in batch.iteritems():
+					self.manager.writeUserValues(username, values)
+				for sql, bindings in statements:
+					self.manager.execute(sql, bindings)
+				self.manager.commit()
+			except:
+				self.manager.rollback()
+				self.requeue(batch, statements)
+				self.errors += 1
+				raise
+			latency = time.time() - start
+			self.flushes += 1
+			self.flushed += len(batch) + len(statements)
+			self.lastFlushLatency = latency
+			self.totalFlushLatency += latency
+			self.maxFlushLatency = max(self.maxFlushLatency, latency)
+			return len(batch) + len(statements)
+		finally:
+			self.flushLock.release()
+
+	def requeue(self, batch, statements=()):
+		"""
+		Puts back a batch that couldn't be written, keeping values
+		queued in the meantime as they are newer, and the statements
+		ahead of those queued in the meantime.
+		"""
+		self.condition.acquire()
+		try:
+			self.statements[:0] = statements
+			for username, values in batch.iteritems():
+				values = dict(values)
+				values.update(self.pending.get(username, {}))
+				self.pending[username] = values
+		finally:
+			self.condition.release()
+
+	def stop(self):
+		"""
+		Stops the background thread and writes what is still pending.
+		"""
+		self.condition.acquire()
+		try:
+			self.running = False
+			self.condition.notify()
+		finally:
+			self.condition.release()
+		self.thread.join()
+		self.flush()
+
+	def stats(self):
+		"""
+		Returns the queue's counters as a dictionary.
+		"""
+		if self.flushes:
+			averageFlushLatency = self.totalFlushLatency / self.flushes
+		else:
+			averageFlushLatency = 0.0
+		return {'depth' : self.depth(),
+			'statements' : len(self.statements),
+			'enqueued' : self.enqueued,
+			'coalesced' : self.coalesced,
+			'flushes' : self.flushes,
+			'flushed' : self.flushed,
+			'errors' : self.errors,
+			'lastFlushLatency' : self.lastFlushLatency,
+			'maxFlushLatency' : self.maxFlushLatency,
+			'averageFlushLatency' : averageFlushLatency}